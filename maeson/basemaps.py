@@ -0,0 +1,109 @@
+"""Basemap resolution and persistent basemap layers."""
+
+from .proxy import tile_url
+
+
+def basemap_url(name):
+    """Resolve a basemap name (e.g. "Esri.WorldImagery") to an XYZ template.
+
+    Args:
+        name (str): A provider name known to xyzservices or a url template.
+
+    Returns:
+        str or None: The url template, or None if ``name`` is empty.
+    """
+    if not name:
+        return None
+    if "{z}" in name:
+        return name
+    import xyzservices.providers as xyz
+
+    return xyz.query_name(name).build_url()
+
+
+class BasemapManager:
+    """Keep one tile layer per basemap and switch between them in place.
+
+    Every basemap ever shown stays on the map below the overlays; switching
+    only toggles the layers' ``visible`` flag, so the browser keeps their
+    tiles and the layer list does not churn.  Base layers already on the
+    map (such as the default OpenStreetMap layer) are adopted.
+
+    Args:
+        map_obj: An ipyleaflet-compatible map.
+    """
+
+    def __init__(self, map_obj):
+        self.map = map_obj
+        self.layers = {}
+        self.active = None
+        for layer in map_obj.layers:
+            if getattr(layer, "base", False) and getattr(layer, "url", None):
+                self.layers[layer.url] = layer
+                if getattr(layer, "visible", True) and self.active is None:
+                    self.active = layer
+
+    @classmethod
+    def of(cls, map_obj):
+        """The manager attached to ``map_obj``, created on first use."""
+        manager = getattr(map_obj, "_basemap_manager", None)
+        if manager is None:
+            manager = cls(map_obj)
+            map_obj._basemap_manager = manager
+        return manager
+
+    def is_basemap(self, layer):
+        """Whether ``layer`` is one of the managed basemap layers."""
+        return any(layer is lyr for lyr in self.layers.values())
+
+    def overlays(self):
+        """The map's layers that are not managed basemaps."""
+        return [lyr for lyr in self.map.layers if not self.is_basemap(lyr)]
+
+    def _find(self, name, url=None, proxy=None):
+        for layer in self.layers.values():
+            if layer.name == name:
+                return layer
+        url = url or basemap_url(name)
+        layer = self.layers.get(url)
+        if layer is None:
+            import ipyleaflet
+
+            layer = ipyleaflet.TileLayer(
+                url=tile_url(url, proxy), name=name, base=True, visible=False
+            )
+            self.layers[url] = layer
+        return layer
+
+    def show(self, name, url=None, proxy=None):
+        """Show basemap ``name`` and hide the others.
+
+        Args:
+            name (str): Basemap name (see `basemap_url`) or url template.
+            url (str, optional): Url template, if ``name`` is only a label.
+            proxy (bool, optional): Route a newly created layer through the
+                caching tile proxy (see `maeson.proxy.tile_url`).
+
+        Returns:
+            ipyleaflet.TileLayer: The visible basemap layer.
+        """
+        layer = self._find(name, url, proxy)
+        on_map = any(layer is lyr for lyr in self.map.layers)
+        if layer is self.active and on_map:
+            return layer
+        for lyr in self.layers.values():
+            if lyr is not layer and getattr(lyr, "visible", True):
+                lyr.visible = False
+        layer.visible = True
+        if not on_map:
+            # keep basemaps below the overlays, in a single update
+            bases = [lyr for lyr in self.map.layers if self.is_basemap(lyr)]
+            self.map.layers = tuple(bases + [layer] + self.overlays())
+        self.active = layer
+        return layer
+
+    def hide(self):
+        """Hide every basemap."""
+        for lyr in self.layers.values():
+            lyr.visible = False
+        self.active = None
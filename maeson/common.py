@@ -1,6 +1,136 @@
 """The common module contains common functions and classes used by the other modules."""
 
+import math
+import os
+import tempfile
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.0511287798
+
 
 def hello_world():
     """Prints "Hello World!" to the console."""
     print("Hello World!")
+
+
+def get_cache_dir(*parts):
+    """Return (and create) a maeson cache directory.
+
+    The root is ``$MAESON_CACHE_DIR`` if set, otherwise ``maeson`` inside the
+    system temp directory.
+
+    Args:
+        *parts (str): Sub-directories below the cache root.
+
+    Returns:
+        str: Absolute path of the directory.
+    """
+    root = os.environ.get("MAESON_CACHE_DIR") or os.path.join(
+        tempfile.gettempdir(), "maeson"
+    )
+    path = os.path.join(root, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def lonlat_to_pixel(lon, lat, zoom, tile_size=TILE_SIZE):
+    """Convert a longitude/latitude pair to Web Mercator world pixels.
+
+    Args:
+        lon (float): Longitude in degrees.
+        lat (float): Latitude in degrees.
+        zoom (float): Zoom level (may be fractional).
+        tile_size (int, optional): Tile size in pixels. Defaults to 256.
+
+    Returns:
+        tuple: (x, y) pixel coordinates at the given zoom.
+    """
+    lat = max(min(lat, MAX_LATITUDE), -MAX_LATITUDE)
+    scale = tile_size * 2**zoom
+    x = (lon + 180.0) / 360.0 * scale
+    sin_lat = math.sin(math.radians(lat))
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+def pixel_to_lonlat(x, y, zoom, tile_size=TILE_SIZE):
+    """Convert Web Mercator world pixels back to longitude/latitude.
+
+    Args:
+        x (float): World pixel x coordinate.
+        y (float): World pixel y coordinate.
+        zoom (float): Zoom level (may be fractional).
+        tile_size (int, optional): Tile size in pixels. Defaults to 256.
+
+    Returns:
+        tuple: (lon, lat) in degrees.
+    """
+    scale = tile_size * 2**zoom
+    lon = x / scale * 360.0 - 180.0
+    n = math.pi - 2 * math.pi * y / scale
+    lat = math.degrees(math.atan(math.sinh(n)))
+    return lon, lat
+
+
+def bounds_to_center_zoom(bounds, width=960, height=600, max_zoom=18):
+    """Find the center and largest integer zoom that fits bounds in a viewport.
+
+    This mirrors what Leaflet's ``fitBounds`` computes in the browser, so it
+    can be used where no frontend is available.
+
+    Args:
+        bounds (sequence): ((south, west), (north, east)).
+        width (int, optional): Viewport width in pixels. Defaults to 960.
+        height (int, optional): Viewport height in pixels. Defaults to 600.
+        max_zoom (int, optional): Upper zoom limit. Defaults to 18.
+
+    Returns:
+        tuple: ((lat, lon), zoom)
+    """
+    (south, west), (north, east) = bounds
+    x0, y0 = lonlat_to_pixel(west, north, 0)
+    x1, y1 = lonlat_to_pixel(east, south, 0)
+    center = pixel_to_lonlat((x0 + x1) / 2, (y0 + y1) / 2, 0)
+
+    span_x = max(abs(x1 - x0), 1e-9)
+    span_y = max(abs(y1 - y0), 1e-9)
+    zoom = math.floor(math.log2(min(width / span_x, height / span_y)))
+    zoom = int(max(0, min(zoom, max_zoom)))
+    return (center[1], center[0]), zoom
+
+
+def viewport_bounds(center, zoom, width=960, height=600):
+    """Return the geographic bounds visible in a viewport.
+
+    Args:
+        center (sequence): (lat, lon) of the viewport center.
+        zoom (float): Zoom level.
+        width (int, optional): Viewport width in pixels. Defaults to 960.
+        height (int, optional): Viewport height in pixels. Defaults to 600.
+
+    Returns:
+        tuple: ((south, west), (north, east))
+    """
+    cx, cy = lonlat_to_pixel(center[1], center[0], zoom)
+    west, north = pixel_to_lonlat(cx - width / 2, cy - height / 2, zoom)
+    east, south = pixel_to_lonlat(cx + width / 2, cy + height / 2, zoom)
+    return (south, west), (north, east)
+
+
+def tiles_in_bounds(bounds, zoom):
+    """List the XYZ tiles covering geographic bounds at one zoom level.
+
+    Args:
+        bounds (sequence): ((south, west), (north, east)).
+        zoom (int): Zoom level.
+
+    Returns:
+        list: (x, y) tile coordinates.
+    """
+    (south, west), (north, east) = bounds
+    n = 2**zoom
+    x0, y0 = lonlat_to_pixel(west, north, zoom)
+    x1, y1 = lonlat_to_pixel(east, south, zoom)
+    xs = range(max(0, int(x0 // TILE_SIZE)), min(n - 1, int(x1 // TILE_SIZE)) + 1)
+    ys = range(max(0, int(y0 // TILE_SIZE)), min(n - 1, int(y1 // TILE_SIZE)) + 1)
+    return [(x, y) for x in xs for y in ys]
@@ -1,7 +1,197 @@
 """Folium Module"""
 
+import gzip
+import hashlib
+import json
+import os
+import re
+
 import folium
+from branca.element import Element, JavascriptLink, MacroElement
 from folium import plugins
+from folium.features import GeoJsonStyleMapper
+from jinja2 import Template
+
+from .proxy import tile_url
+
+# Sidecar formats for `Map.export_html`: file suffix and the browser library
+# needed to decode them.
+SIDECAR_FORMATS = {
+    "geojson": (".geojson.gz", None),
+    "topojson": (".topojson.gz", "https://unpkg.com/topojson-client@3"),
+    "flatgeobuf": (
+        ".fgb",
+        "https://unpkg.com/flatgeobuf@3/dist/flatgeobuf-geojson.min.js",
+    ),
+}
+
+# Browser function decoding a sidecar file to GeoJSON.
+SIDECAR_DECODER = """
+function maesonDecodeSidecar(bytes, format) {
+    var raw = Promise.resolve(bytes);
+    if (bytes[0] === 0x1f && bytes[1] === 0x8b) {
+        var stream = new Blob([bytes]).stream()
+            .pipeThrough(new DecompressionStream("gzip"));
+        raw = new Response(stream).arrayBuffer()
+            .then(function(buf) { return new Uint8Array(buf); });
+    }
+    return raw.then(function(buf) {
+        if (format === "flatgeobuf") {
+            var fc = flatgeobuf.deserialize(buf);
+            fc.features.forEach(function(f) {
+                if (f.properties && "__id" in f.properties) {
+                    f.id = f.properties.__id;
+                }
+            });
+            return fc;
+        }
+        var obj = JSON.parse(new TextDecoder().decode(buf));
+        if (format === "topojson") {
+            return topojson.feature(obj, obj.objects.data);
+        }
+        return obj;
+    });
+}
+"""
+
+_SIDECAR_LOADER = Template("""
+(function() {
+    var layer = {{ this.get_name() }}, loaded = false;
+    function load() {
+        if (loaded) return;
+        loaded = true;
+        fetch({{ this.sidecar|tojson }})
+            .then(function(r) { return r.arrayBuffer(); })
+            .then(function(buf) {
+                return maesonDecodeSidecar(new Uint8Array(buf), {{ this.sidecar_format|tojson }});
+            })
+            .then(function(data) {
+                {{ this.get_name() }}_add(data);
+                {%- if not this.style %}
+                layer.setStyle(function(feature) { return feature.properties.style; });
+                {%- endif %}
+            });
+    }
+    layer.on("add", load);
+    if (layer._map) load();
+})();
+""")
+
+
+def write_sidecar(data, directory, name, data_format="geojson"):
+    """Write a GeoJSON FeatureCollection to a compressed sidecar file.
+
+    The file name includes a hash of the content, so identical data is
+    written once.
+
+    Args:
+        data (dict): A GeoJSON FeatureCollection.
+        directory (str): Output directory, created if needed.
+        name (str): Layer name, used as the file name prefix.
+        data_format (str, optional): "geojson" (gzip'd), "topojson" (gzip'd,
+            needs ``pip install maeson[topojson]``) or "flatgeobuf". Defaults
+            to "geojson".
+
+    Returns:
+        str: Path of the written file.
+    """
+    if data_format not in SIDECAR_FORMATS:
+        raise ValueError(
+            f"Unknown sidecar format '{data_format}'. "
+            f"Choose from {sorted(SIDECAR_FORMATS)}."
+        )
+    text = json.dumps(data, separators=(",", ":"))
+    digest = hashlib.sha1(text.encode("utf-8")).hexdigest()[:10]
+    slug = re.sub(r"[^A-Za-z0-9_-]+", "-", name or "layer").strip("-") or "layer"
+    path = os.path.join(directory, f"{slug}-{digest}{SIDECAR_FORMATS[data_format][0]}")
+    if os.path.exists(path):
+        return path
+    os.makedirs(directory, exist_ok=True)
+
+    if data_format == "flatgeobuf":
+        import geopandas as gpd
+
+        features = [
+            (
+                dict(f, properties=dict(f.get("properties") or {}, __id=f["id"]))
+                if "id" in f
+                else f
+            )
+            for f in data["features"]
+        ]
+        gdf = gpd.GeoDataFrame.from_features(features, crs="EPSG:4326")
+        gdf.to_file(path, driver="FlatGeobuf")
+        return path
+
+    if data_format == "topojson":
+        try:
+            import topojson
+        except ImportError:
+            raise ImportError(
+                'data_format="topojson" needs the topojson package. Install it '
+                "with `pip install maeson[topojson]`, or use the default "
+                '"geojson" format.'
+            )
+
+        text = topojson.Topology(data, object_name="data").to_json()
+    with gzip.open(path, "wt", encoding="utf-8", compresslevel=9) as f:
+        f.write(text)
+    return path
+
+
+class SidecarGeoJson(folium.GeoJson):
+    """A `folium.GeoJson` layer whose data can live in a sidecar file.
+
+    While ``sidecar`` is set (see `Map.export_html`) the page holds an empty
+    layer, and a small script fetches and decodes the sidecar the first
+    time the layer is shown, e.g. when it is ticked in the layer control.
+    Styles and highlights are still computed from the full data.
+    """
+
+    sidecar = None
+    sidecar_format = "geojson"
+
+    def render(self, **kwargs):
+        if self.sidecar is None:
+            return super().render(**kwargs)
+        data = self.data
+        if (self.style or self.highlight) and data["features"]:
+            mapper = GeoJsonStyleMapper(data, self.feature_identifier, self)
+            if self.style:
+                self.style_map = mapper.get_style_map(self.style_function)
+            if self.highlight:
+                self.highlight_map = mapper.get_highlight_map(self.highlight_function)
+
+        # render the layer itself without its data, then the children
+        # (tooltips, popups) against the full data
+        children = self._children
+        self._children = type(children)()
+        self.data = {"type": "FeatureCollection", "features": []}
+        try:
+            super().render(**kwargs)
+        finally:
+            self._children = children
+            self.data = data
+        for child in children.values():
+            child.render(**kwargs)
+
+        figure = self.get_root()
+        library = SIDECAR_FORMATS[self.sidecar_format][1]
+        if library:
+            figure.header.add_child(
+                JavascriptLink(library), name=f"maeson_{self.sidecar_format}"
+            )
+        figure.script.add_child(Element(SIDECAR_DECODER), name="maeson_decode_sidecar")
+        figure.script.add_child(
+            Element(_SIDECAR_LOADER.render(this=self)),
+            name=self.get_name() + "_sidecar",
+        )
+
+
+def _iter_elements(element):
+    for child in element._children.values():
+        yield child
+        yield from _iter_elements(child)
 
 
 class Map(folium.Map):
@@ -13,11 +203,13 @@ class Map(folium.Map):
     def __init__(self, center=(0, 0), zoom=2, **kwargs):
         super().__init__(location=center, zoom_start=zoom, **kwargs)
 
-    def add_basemap(self, name: str, **kwargs):
+    def add_basemap(self, name: str, proxy=None, **kwargs):
         """
         Add a basemap to the map using Esri maps.
         Args:
             name (str): Name of the basemap.
+            proxy (bool, optional): Load tiles through maeson's caching tile
+                proxy. Defaults to the `maeson.proxy.proxy_tiles` setting.
             **kwargs: Additional arguments to pass to the folium.TileLayer.
         """
         basemaps = {
@@ -28,19 +220,27 @@ class Map(folium.Map):
         }
         if name in basemaps:
             folium.TileLayer(
-                tiles=basemaps[name],
+                tiles=tile_url(basemaps[name], proxy),
                 attr='&copy; <a href="http://www.esri.com/">Esri</a>',
                 **kwargs,
             ).add_to(self)
         else:
             raise ValueError(f"Basemap '{name}' not found.")
 
-    def add_geojson(self, data, name="GeoJSON Layer", **kwargs):
+    def add_geojson(
+        self, data, name="GeoJSON Layer", aggregate=None, cell_size=32, **kwargs
+    ):
         """Adds a GeoJSON layer to the map.
 
         Args:
             data (str or dict): The GeoJSON data. Can be a file path (str) or a dictionary.
             name (str): Name of the layer to display in the LayerControl. Defaults to "GeoJSON Layer".
+            aggregate (str): "hex" or "grid" to bin dense points into cells
+                instead of drawing one marker per point. Since the saved map
+                has no kernel, cells are computed once, for the map's initial
+                zoom, and are not re-binned when the map is zoomed; use
+                `maeson.Map.add_geojson` for cells that follow the zoom.
+            cell_size (int): Aggregation cell size in pixels. Defaults to 32.
             **kwargs: Additional keyword arguments for the folium.GeoJson layer.
         """
         import geopandas as gpd
@@ -51,7 +251,17 @@ class Map(folium.Map):
         elif isinstance(data, dict):
             geojson = data
 
-        geojson_layer = folium.GeoJson(data=geojson, name=name, **kwargs)
+        if aggregate:
+            from .vector import PointAggregator, cell_style
+
+            aggregator = PointAggregator(geojson, kind=aggregate, cell_size=cell_size)
+            geojson = aggregator.geojson(self.options.get("zoom", 2))
+            kwargs.setdefault("style_function", cell_style)
+            kwargs.setdefault(
+                "tooltip", folium.GeoJsonTooltip(fields=["count"], aliases=["Points"])
+            )
+
+        geojson_layer = SidecarGeoJson(data=geojson, name=name, **kwargs)
         geojson_layer.add_to(self)
 
     def add_shp(self, data, **kwargs):
@@ -106,31 +316,238 @@ class Map(folium.Map):
         """Adds a layer control widget to the map."""
         folium.LayerControl().add_to(self)
 
-    def add_raster(self, data: str, layer_name: str, **kwargs):
+    def export_html(self, path, data_format="geojson", min_bytes=0):
+        """Save the map as HTML with its GeoJSON data in sidecar files.
+
+        The data of layers added with `add_geojson`, `add_gdf`, `add_shp` and
+        `add_vector` is written to compressed files in ``<name>_files/`` next
+        to the page instead of being inlined, and only downloaded when the
+        layer is shown.  The page must be served over HTTP (e.g. ``python -m
+        http.server``), since browsers do not ``fetch`` from ``file://``.
+
+        Args:
+            path (str): Output HTML file.
+            data_format (str, optional): "geojson", "topojson" or
+                "flatgeobuf" (see `write_sidecar`). Defaults to "geojson".
+            min_bytes (int, optional): Keep layers whose GeoJSON is smaller
+                than this inline. Defaults to 0.
+
+        Returns:
+            dict: ``html`` (path), ``html_bytes`` and ``layers``: one dict per
+            layer with its ``name``, ``inline_bytes`` (size if inlined),
+            ``file`` (sidecar path or None) and ``bytes`` (what the browser
+            downloads for it).
+        """
+        directory = os.path.splitext(path)[0] + "_files"
+        layers = [
+            child for child in _iter_elements(self) if isinstance(child, SidecarGeoJson)
+        ]
+        report = []
+        try:
+            for layer in layers:
+                text = json.dumps(layer.data, separators=(",", ":"))
+                inline = len(text.encode("utf-8"))
+                entry = {
+                    "name": layer.layer_name,
+                    "inline_bytes": inline,
+                    "file": None,
+                    "bytes": inline,
+                }
+                if inline >= min_bytes:
+                    sidecar = write_sidecar(
+                        layer.data, directory, layer.layer_name, data_format
+                    )
+                    layer.sidecar = "/".join(
+                        (os.path.basename(directory), os.path.basename(sidecar))
+                    )
+                    layer.sidecar_format = data_format
+                    entry["file"] = sidecar
+                    entry["bytes"] = os.path.getsize(sidecar)
+                report.append(entry)
+            self.save(path)
+        finally:
+            for layer in layers:
+                layer.sidecar = None
+        return {
+            "html": path,
+            "html_bytes": os.path.getsize(path),
+            "layers": report,
+        }
+
+    def add_raster(
+        self,
+        data: str,
+        layer_name: str = "Raster Layer",
+        tiles="server",
+        output_dir=None,
+        colormap="greys",
+        expression=None,
+        zooms=None,
+        workers=None,
+        zoom_to_layer=True,
+        **kwargs,
+    ):
         """
         Add a raster layer to the map.
+
+        GeoTIFFs are delivered as XYZ tiles rather than one embedded image:
+        either rendered on request by maeson's local `maeson.tiles.TileServer`
+        (for use while the kernel runs), or pre-rendered to a static tile
+        pyramid next to the page (see `maeson.raster.export_xyz_tiles`).
+
         Args:
-            data (str): Path to the raster file.
+            data (str): Path or URL of the raster.
             layer_name (str): Name of the layer.
-            **kwargs: Additional arguments to pass to the folium.ImageOverlay.
+            tiles (str, optional): "server", "static", or None to add the
+                image as a single folium.ImageOverlay as before. Defaults
+                to "server".
+            output_dir (str, optional): Pyramid directory for "static",
+                relative to where the HTML will be saved. Defaults to
+                ``tiles/<layer_name>``.
+            colormap (str, optional): Colormap for single-band rasters.
+                Defaults to "greys".
+            expression (str, optional): Band-math expression, e.g.
+                ``"(b4 - b3) / (b4 + b3)"``.
+            zooms (iterable, optional): Zoom levels to pre-render for
+                "static". Defaults to the raster's minimum to native zoom.
+            workers (int, optional): Processes for "static". Defaults to the
+                CPU count.
+            zoom_to_layer (bool, optional): Fit the map to the raster.
+                Defaults to True.
+            **kwargs: Additional arguments to pass to the folium.TileLayer
+                (or folium.ImageOverlay).
         """
-        folium.ImageOverlay(data, name=layer_name, **kwargs).add_to(self)
+        if tiles is None:
+            folium.ImageOverlay(data, name=layer_name, **kwargs).add_to(self)
+            return
+        from .raster import export_xyz_tiles, lonlat_bounds
 
-    def add_split_map(self, left="openstreetmap", right="cartodbpositron", **kwargs):
+        kwargs.setdefault("attr", "maeson")
+        kwargs.setdefault("max_zoom", 24)
+        if tiles == "server":
+            from .tiles import raster_tile_url
 
-        layer_right = folium.TileLayer(left, **kwargs)
-        layer_left = folium.TileLayer(right, **kwargs)
+            url = raster_tile_url(data, colormap=colormap, expression=expression)
+        elif tiles == "static":
+            slug = re.sub(r"[^A-Za-z0-9_-]+", "-", layer_name).strip("-") or "raster"
+            output_dir = output_dir or os.path.join("tiles", slug)
+            stats = export_xyz_tiles(
+                data,
+                output_dir,
+                zooms=zooms,
+                colormap=colormap,
+                expression=expression,
+                workers=workers,
+            )
+            kwargs.setdefault("min_zoom", 0)
+            kwargs.setdefault("max_native_zoom", max(stats["zooms"]))
+            url = output_dir.replace(os.sep, "/") + "/{z}/{x}/{y}.png"
+        else:
+            raise ValueError(f"tiles must be 'server', 'static' or None, not {tiles!r}")
+        folium.TileLayer(tiles=url, name=layer_name, overlay=True, **kwargs).add_to(
+            self
+        )
+        if zoom_to_layer:
+            west, south, east, north = lonlat_bounds(data)
+            self.fit_bounds([[south, west], [north, east]])
+
+    def add_split_map(
+        self, left="openstreetmap", right="cartodbpositron", colormap="greys", **kwargs
+    ):
+        """Compare two layers with a sliding divider.
 
-        sbs = folium.plugins.SideBySideLayers(
+        GeoTIFFs are tiled by maeson's local `maeson.tiles.TileServer`
+        instead of being embedded in the page, and each side only requests
+        the tiles in its visible half; moving the divider loads the rest.
+
+        Args:
+            left (str or folium.TileLayer): Left side: a folium tile provider
+                name, an XYZ url template, a GeoTIFF path or URL, or a layer.
+                Defaults to "openstreetmap".
+            right (str or folium.TileLayer): Right side, as ``left``.
+                Defaults to "cartodbpositron".
+            colormap (str, optional): Colormap for single-band GeoTIFFs.
+                Defaults to "greys".
+            **kwargs: Additional arguments to pass to the folium.TileLayer.
+        """
+        layer_left = self._split_layer(left, colormap, **kwargs)
+        layer_right = self._split_layer(right, colormap, **kwargs)
+        # the layers are added by SplitTileLoader once their tile filter is
+        # in place, so neither side loads the full viewport first
+        for layer in (layer_left, layer_right):
+            layer.show = False
+            layer.add_to(self)
+        control = plugins.SideBySideLayers(
             layer_left=layer_left, layer_right=layer_right
         )
+        control.add_to(self)
+        SplitTileLoader(control).add_to(self)
+
+    @staticmethod
+    def _split_layer(source, colormap="greys", **kwargs):
+        if isinstance(source, folium.TileLayer):
+            return source
+        if source.lower().split("?", 1)[0].endswith((".tif", ".tiff")):
+            from .tiles import raster_tile_url
+
+            kwargs.setdefault("attr", "maeson")
+            kwargs.setdefault("max_zoom", 24)
+            return folium.TileLayer(
+                tiles=raster_tile_url(source, colormap=colormap), **kwargs
+            )
+        if "{z}" in source:
+            kwargs.setdefault("attr", source)
+            return folium.TileLayer(tiles=tile_url(source), **kwargs)
+        return folium.TileLayer(source, **kwargs)
+
+
+class SplitTileLoader(MacroElement):
+    """Restrict the two layers of a split map to their visible halves.
+
+    Each layer's tile filter rejects tiles entirely on the other side of the
+    `folium.plugins.SideBySideLayers` divider, so the hidden half of a layer
+    is never requested.  The layers are added to the map by this element.
+
+    Args:
+        control (folium.plugins.SideBySideLayers): The split control.
+    """
 
-        # Allow for raster TIFs to be added to left or right
-        if isinstance(left, str) and left.endswith(".tif"):
-            layer_left = folium.ImageOverlay(left, **kwargs)
-        if isinstance(right, str) and right.endswith(".tif"):
-            layer_right = folium.ImageOverlay(right, **kwargs)
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var control = {{ this.control.get_name() }};
+            var left = {{ this.layer_left.get_name() }};
+            var right = {{ this.layer_right.get_name() }};
+            function divider() {
+                return control.getPosition ? control.getPosition() : map.getSize().x / 2;
+            }
+            function clip(layer, isLeft) {
+                var isValidTile = layer._isValidTile;
+                layer._isValidTile = function(coords) {
+                    if (!isValidTile.call(this, coords)) return false;
+                    var size = this.getTileSize();
+                    var x0 = map.latLngToContainerPoint(
+                        map.unproject(coords.scaleBy(size), coords.z)).x;
+                    var x1 = map.latLngToContainerPoint(
+                        map.unproject(coords.add([1, 1]).scaleBy(size), coords.z)).x;
+                    return isLeft ? x0 < divider() : x1 > divider();
+                };
+                layer.addTo(map);
+            }
+            clip(left, true);
+            clip(right, false);
+            control.on("dividermove", function() {
+                left._update();
+                right._update();
+            });
+        })();
+        {% endmacro %}
+        """)
 
-        layer_left.add_to(self)
-        layer_right.add_to(self)
-        sbs.add_to(self)
+    def __init__(self, control):
+        super().__init__()
+        self._name = "SplitTileLoader"
+        self.control = control
+        self.layer_left = control.layer_left
+        self.layer_right = control.layer_right
@@ -1,8 +1,15 @@
 import json
+import hashlib
 import ipywidgets as widgets
+import numpy as np
 import traceback
+from array import array
 from IPython.display import display, FileLink
 import copy, json, asyncio
+import collections
+import contextlib
+import functools
+import threading
 from ipyleaflet import (
     Map,
     GeoJSON,
@@ -33,6 +40,141 @@ from ipywidgets import (
     jslink,
 )
 
+from .basemaps import BasemapManager
+from .spatial import StoryIndex
+
+# Basemaps offered by the SceneBuilder picker (xyzservices names).
+BASEMAP_CHOICES = (
+    "OpenStreetMap.Mapnik",
+    "Esri.WorldImagery",
+    "OpenTopoMap",
+    "CartoDB.Positron",
+    "CartoDB.DarkMatter",
+)
+
+# Functions a scene's custom_code may define (see `SceneCode`).
+SCENE_HOOKS = ("setup", "enter", "exit")
+
+# Distinct custom_code snippets kept compiled (see `compile_scene_code`).
+COMPILED_CODE_CACHE_SIZE = 128
+
+
+@contextlib.contextmanager
+def collect_layers(map_obj):
+    """Collect the layers map methods add instead of adding them.
+
+    Inside the block ``map_obj.add`` and ``map_obj.add_layer`` append layers
+    to the yielded list (controls are still added), so the caller can put
+    them on the map with one ``layers`` assignment.
+
+    Args:
+        map_obj: An ipyleaflet-compatible map.
+    """
+    added = []
+    cls = type(map_obj)
+
+    def _add(item, *args, **kwargs):
+        if hasattr(item, "position"):
+            return cls.add(map_obj, item, *args, **kwargs)
+        if not any(item is lyr for lyr in added):
+            added.append(item)
+        return item
+
+    map_obj.add = map_obj.add_layer = _add
+    try:
+        yield added
+    finally:
+        del map_obj.add
+        del map_obj.add_layer
+
+
+def compile_scene_code(code):
+    """Compile a scene's custom_code, once per distinct snippet.
+
+    Args:
+        code (str): Python source.
+
+    Returns:
+        tuple: (sha1 hex digest of ``code``, code object).
+    """
+    digest = hashlib.sha1(code.encode("utf-8")).hexdigest()
+    return digest, _compile_code(code, digest)
+
+
+@functools.lru_cache(maxsize=COMPILED_CODE_CACHE_SIZE)
+def _compile_code(code, digest):
+    return compile(code, f"<scene {digest[:8]}>", "exec")
+
+
+class LayerDef(dict):
+    """
+    An immutable layer definition dict with structural sharing.
+
+    A LayerDef behaves like the plain layer dicts used throughout this module
+    (it *is* a dict, so it serializes to JSON and can be passed anywhere a
+    dict is expected), but it cannot be mutated in place.  Copying one is
+    free and `set`/`set_in` return a new LayerDef that copies only the
+    containers along the changed path; every other value, including large
+    embedded GeoJSON payloads, is shared by reference.  Nested values should
+    therefore be treated as read-only.
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("LayerDef is immutable; use set() or set_in() instead")
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    @classmethod
+    def of(cls, layer_def):
+        """Return ``layer_def`` as a LayerDef, wrapping plain dicts once."""
+        return layer_def if isinstance(layer_def, cls) else cls(layer_def)
+
+    def copy(self):
+        return self
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (LayerDef, (dict(self),))
+
+    def set(self, key, value):
+        """Return a new LayerDef with ``key`` set to ``value``."""
+        new = dict(self)
+        new[key] = value
+        return LayerDef(new)
+
+    def remove(self, key):
+        """Return a new LayerDef without ``key``."""
+        new = dict(self)
+        new.pop(key, None)
+        return LayerDef(new)
+
+    def set_in(self, path, value):
+        """
+        Return a new LayerDef with the nested ``path`` (a sequence of keys)
+        set to ``value``, shallow-copying only the dicts along the path.
+        """
+        key, *rest = path
+        if not rest:
+            return self.set(key, value)
+
+        def _assoc(node, keys):
+            new = dict(node or {})
+            if len(keys) == 1:
+                new[keys[0]] = value
+            else:
+                new[keys[0]] = _assoc(new.get(keys[0]), keys[1:])
+            return new
+
+        return self.set(key, _assoc(self.get(key), rest))
+
 
 class Scene:
     def __init__(
@@ -47,20 +189,195 @@ class Scene:
     ):
         self.center = center
         self.zoom = zoom
-        self.layers = layers or []
+        self.layers = [LayerDef.of(ld) for ld in layers or []]
         self.title = title
         self.order = order
         self.basemap = basemap
         self.custom_code = custom_code
 
 
+class ROIStore:
+    """
+    Shared, deduplicated storage for drawn regions of interest.
+
+    Geometries are kept in columnar form (one flat coordinate buffer plus
+    part/ring offset arrays, as in GeoArrow) instead of as GeoJSON dicts,
+    and identical geometries are stored once.  Scenes reference ROIs by the
+    integer ID returned from `add`.
+    """
+
+    _TYPES = (
+        "Point",
+        "LineString",
+        "Polygon",
+        "MultiPoint",
+        "MultiLineString",
+        "MultiPolygon",
+    )
+
+    def __init__(self):
+        self._next_id = 0
+        self._rows = {}  # roi id -> row
+        self._by_hash = {}  # geometry hash -> roi id
+        self._ids = array("q")
+        self._types = array("b")
+        self._properties = []
+        self._part_offsets = array("q", [0])
+        self._ring_offsets = array("q", [0])
+        self._coord_offsets = array("q", [0])
+        self._coords = array("d")
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, roi_id):
+        return roi_id in self._rows
+
+    @property
+    def coords(self):
+        """All coordinates as an ``(N, 2)`` array view."""
+        return np.frombuffer(self._coords, dtype="float64").reshape(-1, 2)
+
+    @property
+    def nbytes(self):
+        """Approximate memory used by the geometry columns."""
+        return sum(
+            a.itemsize * len(a)
+            for a in (
+                self._ids,
+                self._types,
+                self._part_offsets,
+                self._ring_offsets,
+                self._coord_offsets,
+                self._coords,
+            )
+        )
+
+    @staticmethod
+    def _split(geom):
+        """Return a geometry as a list of parts, each a list of rings."""
+        t, c = geom["type"], geom["coordinates"]
+        if t == "Point":
+            return [[[c]]]
+        if t in ("LineString", "MultiPoint"):
+            return [[c]]
+        if t == "Polygon":
+            return [c]
+        if t == "MultiLineString":
+            return [[line] for line in c]
+        if t == "MultiPolygon":
+            return c
+        raise ValueError(f"Unsupported ROI geometry type: {t}")
+
+    def add(self, feature):
+        """
+        Store a GeoJSON Feature (or geometry) and return its ROI ID.
+
+        Adding a feature whose geometry and properties are already stored
+        returns the existing ID.
+        """
+        geom = feature.get("geometry", feature)
+        properties = dict(feature.get("properties") or {})
+        parts = self._split(geom)
+        flat = np.asarray(
+            [pt[:2] for part in parts for ring in part for pt in ring],
+            dtype="float64",
+        )
+        digest = hashlib.blake2b(
+            geom["type"].encode()
+            + flat.tobytes()
+            + json.dumps(properties, sort_keys=True, default=str).encode(),
+            digest_size=16,
+        ).digest()
+        if digest in self._by_hash:
+            return self._by_hash[digest]
+
+        roi_id = self._next_id
+        self._next_id += 1
+        self._rows[roi_id] = len(self._ids)
+        self._by_hash[digest] = roi_id
+        self._ids.append(roi_id)
+        self._types.append(self._TYPES.index(geom["type"]))
+        self._properties.append(properties)
+        for part in parts:
+            for ring in part:
+                self._coord_offsets.append(self._coord_offsets[-1] + len(ring))
+            self._ring_offsets.append(self._ring_offsets[-1] + len(part))
+        self._part_offsets.append(self._part_offsets[-1] + len(parts))
+        self._coords.frombytes(flat.tobytes())
+        return roi_id
+
+    def feature(self, roi_id):
+        """Rebuild the GeoJSON Feature for one ROI ID."""
+        row = self._rows[roi_id]
+        coords = self.coords
+        parts = []
+        for p in range(self._part_offsets[row], self._part_offsets[row + 1]):
+            rings = []
+            for r in range(self._ring_offsets[p], self._ring_offsets[p + 1]):
+                start, stop = self._coord_offsets[r], self._coord_offsets[r + 1]
+                rings.append(coords[start:stop].tolist())
+            parts.append(rings)
+
+        t = self._TYPES[self._types[row]]
+        if t == "Point":
+            c = parts[0][0][0]
+        elif t in ("LineString", "MultiPoint"):
+            c = parts[0][0]
+        elif t == "Polygon":
+            c = parts[0]
+        elif t == "MultiLineString":
+            c = [part[0] for part in parts]
+        else:
+            c = parts
+        return {
+            "type": "Feature",
+            "id": roi_id,
+            "properties": dict(self._properties[row]),
+            "geometry": {"type": t, "coordinates": c},
+        }
+
+    def to_geojson(self, ids=None):
+        """Return a FeatureCollection of the given ROI IDs (default: all)."""
+        ids = self._ids if ids is None else ids
+        return {
+            "type": "FeatureCollection",
+            "features": [self.feature(i) for i in ids if i in self._rows],
+        }
+
+    def prune(self, keep_ids):
+        """Drop every ROI whose ID is not in ``keep_ids``; IDs stay stable."""
+        keep_ids = set(keep_ids)
+        keep = [self.feature(i) for i in self._ids if i in keep_ids]
+        next_id = self._next_id
+        self.__init__()
+        for feat in keep:
+            self._next_id = feat["id"]
+            self.add(feat)
+        self._next_id = next_id
+
+    @classmethod
+    def from_geojson(cls, collection):
+        """Rebuild a store from `to_geojson` output, keeping feature IDs."""
+        store = cls()
+        for feat in collection.get("features", []):
+            if "id" in feat:
+                store._next_id = int(feat["id"])
+            store.add(feat)
+        store._next_id = max(store._ids, default=-1) + 1
+        return store
+
+
 class Story:
-    def __init__(self, scenes):
+    def __init__(self, scenes, rois=None):
         """
         A sequence of scenes forming a narrative.
+
+        `rois` is the `ROIStore` that "roi" layers in the scenes refer to.
         """
         self.scenes = scenes
         self.index = 0
+        self.rois = rois if rois is not None else ROIStore()
 
     def _current_scene(self):
         return self.scenes[self.index]
@@ -76,6 +393,71 @@ class Story:
         return self._current_scene()
 
 
+class SceneCode:
+    """Run scenes' custom_code in one persistent namespace.
+
+    A snippet's top-level body runs once, the first time a scene with that
+    code is shown, and may define ``setup()`` (called once after the body),
+    ``enter()`` (called on every visit) and ``exit()`` (called when the
+    scene is left).  Layers added while the body and ``setup`` run are kept
+    and returned again on later visits instead of being rebuilt.  Imports
+    and variables stay in the namespace, shared by all scenes, which also
+    holds ``map`` and any extra ``names``.
+
+    Args:
+        map_obj: The map the code works on.
+        **names: Extra names for the namespace (e.g. ``story``).
+    """
+
+    def __init__(self, map_obj, **names):
+        self.map = map_obj
+        self.namespace = {"map": map_obj, **names}
+        self.hooks = {}  # digest -> hooks the snippet defined
+        self.layers = {}  # digest -> layers created by its body/setup
+        self.active = None
+
+    def enter(self, code):
+        """Run ``code`` for the scene being shown.
+
+        The layers the code creates are collected rather than added to the
+        map (see `collect_layers`).
+
+        Args:
+            code (str): The scene's custom_code.
+
+        Returns:
+            list: Layers the caller should put on the map.
+        """
+        if not code or not code.strip():
+            return []
+        digest, compiled = compile_scene_code(code)
+        hooks = self.hooks.get(digest)
+        with collect_layers(self.map) as added:
+            if hooks is None:
+                exec(compiled, self.namespace)
+                hooks = {
+                    name: self.namespace.pop(name)
+                    for name in SCENE_HOOKS
+                    if name in self.namespace
+                }
+                if "setup" in hooks:
+                    hooks["setup"]()
+                self.hooks[digest] = hooks
+                self.layers[digest] = list(added)
+                del added[:]
+            self.active = digest
+            if "enter" in hooks:
+                hooks["enter"]()
+        return self.layers[digest] + added
+
+    def exit(self):
+        """Leave the current scene, calling its ``exit()`` hook if any."""
+        digest, self.active = self.active, None
+        hook = self.hooks.get(digest, {}).get("exit")
+        if hook is not None:
+            hook()
+
+
 class StoryController:
     def __init__(self, story, map_obj: Map):
         """
@@ -83,7 +465,9 @@ class StoryController:
         """
         self.story = story
         self.map = map_obj
+        self.basemaps = BasemapManager.of(map_obj)
         self.current_layers = []
+        self.code = SceneCode(map_obj, story=story)
 
         self.next_button = widgets.Button(description="Next")
         self.back_button = widgets.Button(description="Back")
@@ -97,80 +481,129 @@ class StoryController:
 
     def _update_scene(self):
         scene = self.story._current_scene()
-        # 1) Reset view
-        self.map.center = scene.center
-        self.map.zoom = scene.zoom
-
-        # 2) Clear out any previous overlays
-        self._clear_overlays()
-        self.current_layers.clear()
-
-        # 3) Re‑add each layer using your Map methods
-        for ld in scene.layers:
-            t = ld["type"]
-            name = ld.get("name")
-
-            try:
-                if t == "geojson":
-                    if "data" in ld:
-                        layer = GeoJSON(data=ld["data"], name=name)
-                        self.map.add_layer(layer)
-                    else:
-                        layer = self.map.add_geojson(ld["path"], name=name)
-
-                elif t == "tile":
-                    layer = self.map.add_tile(url=ld["url"], name=name)
-
-                elif t == "image":
-                    layer = self.map.add_image(
-                        url=ld["path"],
-                        bounds=tuple(tuple(c) for c in ld["bounds"]),
-                        name=name,
-                    )
-
-                elif t == "video":
-                    layer = self.map.add_video(
-                        url=ld["path"],
-                        bounds=tuple(tuple(c) for c in ld["bounds"]),
-                        name=name,
-                    )
-
-                elif t == "raster":
-                    layer = self.map.add_raster(
-                        ld["path"], name=name, zoom_to_layer=False
-                    )
-
-                elif t == "wms":
-                    layer = self.map.add_wms_layer(url=ld["url"], name=name)
-
-                elif t == "earthengine":
-                    # your Map.add_earthengine takes ee_object + vis_params
-                    layer = self.map.add_earthengine(
-                        ee_object=ld["ee_id"],
-                        vis_params=ld.get("vis_params", {}),
-                        name=name,
-                    )
-
-                else:
-                    print(f"Unsupported layer type: {t}")
-                    continue
-
-                self.current_layers.append(layer)
+        try:
+            self.code.exit()
+        except Exception as e:
+            print(f"⚠️ Error in scene code: {e}")
+        # The transition is applied as one batch: center, zoom and layers
+        # reach the frontend in a single state update, and the layer tuple is
+        # assigned once instead of removing and adding layers one by one.
+        with self.map.hold_sync():
+            # 1) Reset view and basemap
+            self.map.center = scene.center
+            self.map.zoom = scene.zoom
+            if scene.basemap:
+                try:
+                    self.basemaps.show(scene.basemap)
+                except Exception as e:
+                    print(f"❌ Failed to show basemap “{scene.basemap}”: {e}")
 
-            except Exception as e:
-                print(f"❌ Failed to add {t} layer “{name}”: {e}")
+            # 2) Build each layer using your Map methods, collecting them
+            self.current_layers.clear()
+            with collect_layers(self.map) as added:
+                for ld in scene.layers:
+                    self._add_layer_def(ld)
 
-        # 4) Finally, run any custom code
-        if scene.custom_code.strip():
+            # 3) Run any custom code; its layers join the batch
             try:
-                exec(scene.custom_code, {}, {"map": self.map})
+                code_layers = self.code.enter(scene.custom_code)
             except Exception as e:
+                code_layers = []
                 print(f"⚠️ Error in scene code: {e}")
 
-    def _clear_overlays(self):
-        # 1) Remove map overlays
-        for lyr in list(self.map.layers)[1:]:
-            self.map.remove_layer(lyr)
+            # 4) Replace the previous overlays in one assignment
+            bases = [lyr for lyr in self.map.layers if self.basemaps.is_basemap(lyr)]
+            overlays = list(added)
+            overlays += [lyr for lyr in code_layers if lyr not in overlays]
+            self.map.layers = tuple(bases) + tuple(overlays)
+
+        self._prefetch_next()
+
+    def _prefetch_next(self):
+        """Get the next scene's preprocessed videos ready in the background."""
+        index = self.story.index + 1
+        if index >= len(self.story.scenes):
+            return
+        scene = self.story.scenes[index]
+        if any(ld.get("preprocess") for ld in scene.layers):
+            from .video import prefetch_videos
+
+            prefetch_videos(scene.layers)
+
+    def _add_layer_def(self, ld):
+        """Create the layer for one layer definition on the map."""
+        t = ld["type"]
+        name = ld.get("name")
+
+        try:
+            if t == "geojson":
+                # embedded data, or a url/file in any registered vector kind
+                layer = self.map.add_geojson(
+                    ld["data"] if "data" in ld else ld.get("path") or ld.get("url"),
+                    name=name,
+                )
+
+            elif t == "roi":
+                layer = GeoJSON(data=self.story.rois.to_geojson(ld["ids"]), name=name)
+                self.map.add_layer(layer)
+
+            elif t == "tile":
+                layer = self.map.add_tile(url=ld["url"], name=name)
+
+            elif t == "image":
+                layer = self.map.add_image(
+                    url=ld["path"],
+                    bounds=tuple(tuple(c) for c in ld["bounds"]),
+                    name=name,
+                )
+
+            elif t == "video":
+                layer = self.map.add_video(
+                    url=ld["path"],
+                    bounds=tuple(tuple(c) for c in ld["bounds"]),
+                    name=name,
+                    preprocess=ld.get("preprocess", False),
+                )
+
+            elif t == "raster":
+                layer = self.map.add_raster(
+                    ld["path"],
+                    name=name,
+                    zoom_to_layer=False,
+                    expression=ld.get("expression"),
+                )
+
+            elif t == "stack":
+                layer = self.map.add_raster_stack(
+                    ld["paths"],
+                    labels=ld.get("labels"),
+                    frame=ld.get("frame", 0),
+                    name=name,
+                    zoom_to_layer=False,
+                    slider=False,
+                )
+
+            elif t == "wms":
+                layer = self.map.add_wms_layer(
+                    url=ld["url"], layers=ld.get("layers"), name=name
+                )
+
+            elif t == "earthengine":
+                # your Map.add_earthengine takes ee_object + vis_params
+                layer = self.map.add_earthengine(
+                    ee_object=ld["ee_id"],
+                    vis_params=ld.get("vis_params", {}),
+                    name=name,
+                )
+
+            else:
+                print(f"Unsupported layer type: {t}")
+                return
+
+            self.current_layers.append(layer)
+
+        except Exception as e:
+            print(f"❌ Failed to add {t} layer “{name}”: {e}")
 
     def _next_scene(self, _=None):
         self.story._next_scene()
@@ -194,6 +627,14 @@ class SceneBuilder:
         self.story = []
         self.log_history = []
         self._active_overlay = None
+        self.rois = ROIStore()
+        self.drawn_rois = []
+        self.spatial_index = StoryIndex()
+        self.basemaps = BasemapManager.of(maeson_map)
+        self._syncing = False  # True while a scene is applied as one batch
+        self.code = SceneCode(maeson_map, builder=self)
+        self._code_layer_defs = {}  # code digest -> Earth Engine layer defs
+        self._code_layers = []  # layers the last custom_code run put on the map
 
         # Wire map events
         self._initialize_map_observers()
@@ -217,6 +658,14 @@ class SceneBuilder:
         self.map.observe(self._on_map_center_change, names="center")
         self.map.observe(self._on_map_zoom_change, names="zoom")
         self.map.observe(self._on_map_layers_change, names="layers")
+        # shapes drawn with the map's draw control become the scene's ROIs
+        draw_control = getattr(self.map, "draw_control", None)
+        if draw_control is not None:
+            draw_control.on_draw(self._on_roi_draw)
+
+    def _on_roi_draw(self, target, action, geo_json):
+        if action == "created":
+            self._add_drawn_feature(geo_json)
 
     def _initialize_map_controls(self):
         """Latitude/Longitude/Zoom widget row + Zoom‑to‑layers button."""
@@ -239,8 +688,24 @@ class SceneBuilder:
         )
         self.zoom_to_layers_button.on_click(self._zoom_to_layers)
 
+        # Basemap picker; saved with each scene
+        self.basemap_dropdown = widgets.Dropdown(
+            options=BASEMAP_CHOICES,
+            value=BASEMAP_CHOICES[0],
+            description="Basemap",
+        )
+        self.basemap_dropdown.observe(
+            lambda c: self.basemaps.show(c["new"]), names="value"
+        )
+
         self.coords_controls = HBox(
-            [self.lat, self.lon, self.zoom, self.zoom_to_layers_button],
+            [
+                self.lat,
+                self.lon,
+                self.zoom,
+                self.basemap_dropdown,
+                self.zoom_to_layers_button,
+            ],
             layout=Layout(gap="6px"),
         )
 
@@ -461,13 +926,16 @@ ee.Initialize()\n
 
     def _add_layer(self, _=None, commit=True):
         path = self.layer_src.value.strip()
-        lt = detect_layer_type(path)
+        kind = detect_layer_kind(path)
+        lt = layer_type_of(kind)
         name = f"{lt.upper()}-{len(self.layers)}"
 
         if lt == "tile":
             self.map.add_tile(url=path, name=name)
         elif lt == "geojson":
-            self.map.add_geojson(path=path, name=name)
+            from .render import read_geojson
+
+            self.map.add_geojson(read_geojson(path, kind), name=name)
         elif lt == "image":
             bounds = eval(self.bounds.value)
             self.map.add_image(url=path, bounds=bounds, name=name)
@@ -481,24 +949,31 @@ ee.Initialize()\n
             ee_id = self.ee_id.value.strip()
             vis = json.loads(self.ee_vis.value or "{}")
             self.map.add_earthengine(ee_id=ee_id, vis_params=vis, name=name)
+        elif lt != "unknown":
+            return self._log(f"❌ {kind} layers are not supported: {path}")
         else:
             return self._log(f"❌ Could not detect layer type for: {path}")
 
         # only append if commit
         if commit:
             self.layers.append(
-                {
-                    "type": lt,
-                    "path": path,
-                    "name": name,
-                    "bounds": eval(self.bounds.value) if lt == "image" else None,
-                    "ee_id": self.ee_id.value.strip() if lt == "earthengine" else None,
-                    "vis_params": (
-                        json.loads(self.ee_vis.value or "{}")
-                        if lt == "earthengine"
-                        else None
-                    ),
-                }
+                LayerDef(
+                    {
+                        "type": lt,
+                        "kind": kind,
+                        "path": path,
+                        "name": name,
+                        "bounds": eval(self.bounds.value) if lt == "image" else None,
+                        "ee_id": (
+                            self.ee_id.value.strip() if lt == "earthengine" else None
+                        ),
+                        "vis_params": (
+                            json.loads(self.ee_vis.value or "{}")
+                            if lt == "earthengine"
+                            else None
+                        ),
+                    }
+                )
             )
         self._log(f"✅ Added {lt} layer: {name}")
 
@@ -508,19 +983,8 @@ ee.Initialize()\n
         scene_order = self.order_input.value
         code = self.custom_code.value or ""
 
-        # 2) Prepare layer list, including drawn ROIs if any
-        layers = self.layers.copy()
-        if hasattr(self, "drawn_features") and self.drawn_features:
-            layers.append(
-                {
-                    "type": "geojson",
-                    "data": {
-                        "type": "FeatureCollection",
-                        "features": list(self.drawn_features),
-                    },
-                    "name": "ROIs",
-                }
-            )
+        # 2) Prepare layer list, referencing drawn ROIs by ID if any
+        layers = self._scene_layers()
 
         # 3) Build a new Scene object
         new_scene = Scene(
@@ -549,13 +1013,12 @@ ee.Initialize()\n
         self._refresh_scene_list()
 
         # 6) Clear the map overlays (keep only base)
-        for lyr in list(self.map.layers)[1:]:
+        for lyr in self.basemaps.overlays():
             self.map.remove_layer(lyr)
 
         # 7) Clear internal state and form fields
         self.layers.clear()
-        if hasattr(self, "drawn_features"):
-            self.drawn_features.clear()
+        self.drawn_rois.clear()
 
         self.title.value = ""
         self.order_input.value = len(self.story) + 1
@@ -572,7 +1035,7 @@ ee.Initialize()\n
         2) Validate the URL/path or skip if there’s nothing to add.
         3) Auto‐detect layer type & build a consistent layer_def.
         4) Append the new layer_def to self.layers.
-        5) Clear existing overlays (only keep the base).
+        5) Clear existing overlays (keep the basemaps and the code's layers).
         6) Re‐apply every layer_def via _apply_layer_def,
         enabling on‐map bounds editing for images/videos.
         7) Fit the map to all overlay bounds.
@@ -587,14 +1050,15 @@ ee.Initialize()\n
             return self._log("❌ No URL/path entered")
 
         # 3) detect type
-        lt = detect_layer_type(src) if src else None
+        kind = detect_layer_kind(src) if src else None
+        lt = layer_type_of(kind) if src else None
         if src and lt == "unknown":
             return self._log(f"❌ Could not detect layer type for: {src}")
 
         # 4) build layer_def only if src provided
         if src:
             name = f"{lt.upper()}-{len(self.layers)}"
-            layer_def = {"type": lt, "name": name}
+            layer_def = {"type": lt, "kind": kind, "name": name}
 
             # path vs url
             if lt in ("geojson", "raster", "wms", "tile", "image", "video"):
@@ -606,27 +1070,34 @@ ee.Initialize()\n
             if lt in ("image", "video"):
                 layer_def["bounds"] = self._get_slider_bounds()
 
-            self.layers.append(layer_def)
+            self.layers.append(LayerDef(layer_def))
 
-        # 6) re‐draw every layer
+        # 5) + 6) re‐draw every layer, replacing the previous overlays in one
+        # assignment so a scene loaded just before is not drawn twice
         applied = []
-        for ld in self.layers:
-            try:
-                layer = self._apply_layer_def(ld)
-                if layer and hasattr(layer, "bounds"):
-                    applied.append(layer)
-                    # if image/video, enable on‐map editing
-                    if ld["type"] in ("image", "video"):
-                        self._active_overlay = layer
-                        sw, ne = layer.bounds
-                        # init sliders
-                        self.bound_sliders["south"].value = sw[0]
-                        self.bound_sliders["west"].value = sw[1]
-                        self.bound_sliders["north"].value = ne[0]
-                        self.bound_sliders["east"].value = ne[1]
-                        self.bounds_container.layout.display = "block"
-            except Exception as e:
-                self._log(f"❌ Failed to apply {ld.get('name')}: {e}")
+        bases = [lyr for lyr in self.map.layers if self.basemaps.is_basemap(lyr)]
+        with self.map.hold_sync(), collect_layers(self.map) as added:
+            for ld in self._scene_layers():
+                count = len(added)
+                try:
+                    self._apply_layer_def(ld)
+                    layer = added[-1] if len(added) > count else None
+                    if layer and hasattr(layer, "bounds"):
+                        applied.append(layer)
+                        # if image/video, enable on‐map editing
+                        if ld["type"] in ("image", "video"):
+                            self._active_overlay = layer
+                            sw, ne = layer.bounds
+                            # init sliders
+                            self.bound_sliders["south"].value = sw[0]
+                            self.bound_sliders["west"].value = sw[1]
+                            self.bound_sliders["north"].value = ne[0]
+                            self.bound_sliders["east"].value = ne[1]
+                            self.bounds_container.layout.display = "block"
+                except Exception as e:
+                    self._log(f"❌ Failed to apply {ld.get('name')}: {e}")
+            code_layers = [lyr for lyr in self._code_layers if lyr not in added]
+            self.map.layers = tuple(bases) + tuple(code_layers) + tuple(added)
 
         # 7) zoom to all overlays
         if applied:
@@ -652,8 +1123,8 @@ ee.Initialize()\n
             if s.order >= new_order:
                 s.order += 1
 
-        # 2) Deep‐copy the layer definitions & custom code
-        new_layers = copy.deepcopy(original.layers)
+        # 2) Share the immutable layer definitions & copy custom code
+        new_layers = list(original.layers)
         new_custom = getattr(original, "custom_code", "")
 
         # 3) Build the new Scene
@@ -682,35 +1153,52 @@ ee.Initialize()\n
         if i < 0:
             return
         self.story.pop(i)
+        self.rois.prune(self._referenced_roi_ids() + self.drawn_rois)
         self._refresh_scene_list()
         self._log(f"Deleted scene {i}.")
 
+    def _add_drawn_feature(self, feature):
+        """
+        Record a drawn GeoJSON feature as an ROI of the scene being edited.
+        Identical geometries share one entry in the ROI store.
+        """
+        roi_id = self.rois.add(feature)
+        if roi_id not in self.drawn_rois:
+            self.drawn_rois.append(roi_id)
+        return roi_id
+
+    def _scene_layers(self):
+        """The layer defs of the scene being edited, drawn ROIs included."""
+        layers = list(self.layers)
+        if self.drawn_rois:
+            layers.append(
+                LayerDef({"type": "roi", "ids": list(self.drawn_rois), "name": "ROIs"})
+            )
+        return layers
+
+    def _referenced_roi_ids(self):
+        """All ROI IDs used by saved scenes."""
+        return [
+            i
+            for s in self.story
+            for ld in s.layers
+            if ld["type"] == "roi"
+            for i in ld["ids"]
+        ]
+
     def _export_story(self, _=None):
         """
         Dump all scenes to story.json and display a download link.
+        ROIs are written once under "rois" and referenced by ID from scenes;
+        `load_story` reads the file back.
         """
-        # Build serializable list of dicts
-        out = []
-        for s in self.story:
-            out.append(
-                {
-                    "title": s.title,
-                    "order": s.order,
-                    "center": list(s.center),
-                    "zoom": s.zoom,
-                    "layers": s.layers,
-                }
-            )
-        # Write to file
         fn = "story.json"
-        with open(fn, "w") as f:
-            json.dump(out, f, indent=2)
+        save_story(Story(self.story, rois=self.rois), fn)
         # Log and show link
         self._log(f"✅ Story exported to {fn}")
         display(FileLink(fn))
 
     def _load_scene(self, _=None):
-        self._clear_layers
         # Figure out which scene is selected
         idx = self.scene_selector.index
         if idx < 0:
@@ -722,24 +1210,40 @@ ee.Initialize()\n
         self.order_input.value = scene.order
 
         # Reset your builder state
-        self.layers = [ld.copy() for ld in scene.layers]
-        if hasattr(self, "drawn_features"):
-            self.drawn_features = [
-                feat
-                for ld in scene.layers
-                if ld["type"] == "geojson" and "data" in ld
-                for feat in ld["data"]["features"]
-            ]
-
-        # Re‑apply only this scene’s layers
-        for ld in self.layers:
-            try:
-                self._apply_layer_def(ld)
-            except Exception as e:
-                self._log(f"❌ Failed to load layer {ld.get('name')}: {e}")
-
-        self.map.center = scene.center
-        self.map.zoom = scene.zoom
+        self.layers = [ld for ld in scene.layers if ld["type"] != "roi"]
+        self.drawn_rois = [
+            i for ld in scene.layers if ld["type"] == "roi" for i in ld["ids"]
+        ]
+
+        # Apply the scene as one batch, like StoryController._update_scene,
+        # with the map observers muted so they don't echo into the widgets
+        self._syncing = True
+        try:
+            with self.map.hold_sync():
+                # Re‑apply only this scene’s layers, replacing the overlays
+                with collect_layers(self.map) as added:
+                    for ld in scene.layers:
+                        try:
+                            self._apply_layer_def(ld)
+                        except Exception as e:
+                            self._log(f"❌ Failed to load layer {ld.get('name')}: {e}")
+                bases = [
+                    lyr for lyr in self.map.layers if self.basemaps.is_basemap(lyr)
+                ]
+                self.map.layers = tuple(bases) + tuple(added)
+
+                self.map.center = scene.center
+                self.map.zoom = scene.zoom
+                if scene.basemap:
+                    if scene.basemap not in self.basemap_dropdown.options:
+                        self.basemap_dropdown.options += (scene.basemap,)
+                    self.basemap_dropdown.value = scene.basemap
+
+            # Mirror the final view into the widgets once
+            self.lat.value, self.lon.value = scene.center
+            self.zoom.value = scene.zoom
+        finally:
+            self._syncing = False
 
         # Give the user feedback
         self._log(f"🔄 Loaded scene “{scene.title}” ({len(self.layers)} layers)")
@@ -751,9 +1255,11 @@ ee.Initialize()\n
         scene = Scene(
             center=(self.lat.value, self.lon.value),
             zoom=self.zoom.value,
-            layers=self.layers.copy(),
+            layers=self._scene_layers(),
             title=self.title.value.strip() or f"Scene {i+1}",
             order=self.order_input.value,
+            basemap=self.basemap_dropdown.value,
+            custom_code=self.custom_code.value or "",
         )
         self.story[i] = scene
         self._refresh_scene_list()
@@ -822,33 +1328,46 @@ ee.Initialize()\n
 
     def _run_custom_code(self, _):
         """
-        Exec the user’s Python snippet with `map` in scope,
+        Run the user’s Python snippet through `SceneCode` (`map` in scope),
         intercept add_earthengine calls and record them.
         """
         code = self.custom_code.value
         real_add_ee = self.map.add_earthengine
+        digest = compile_scene_code(code)[0] if code and code.strip() else None
+        # SceneCode runs a snippet's body only once, so when it has run before
+        # the layers it added are taken from the earlier run's record
+        rerun = digest in self.code.hooks
+        recorded = []
 
         def _recording_add_ee(*args, **kwargs):
             layer = real_add_ee(*args, **kwargs)
 
             ee_obj = kwargs.get("ee_object") or (args[0] if args else None)
             vis = kwargs.get("vis_params", {})
-            name = kwargs.get("name") or f"EE-{len(self.layers)}"
-
-            self.layers.append(
-                {
-                    "type": "earthengine",
-                    "ee_id": ee_obj,
-                    "vis_params": vis,
-                    "name": name,
-                }
+            name = kwargs.get("name") or f"EE-{len(self.layers) + len(recorded)}"
+
+            recorded.append(
+                LayerDef(
+                    {
+                        "type": "earthengine",
+                        "ee_id": ee_obj,
+                        "vis_params": vis,
+                        "name": name,
+                    }
+                )
             )
             return layer
 
         self.map.add_earthengine = _recording_add_ee
 
+        self._code_layers = []
         try:
-            exec(code, {}, {"map": self.map})
+            self.code.exit()
+            layers = self.code.enter(code)
+            self._code_layers = list(layers)
+            new = tuple(lyr for lyr in layers if lyr not in self.map.layers)
+            if new:
+                self.map.layers += new
             self._log("✅ Custom code executed")
         except Exception as e:
             import traceback
@@ -857,6 +1376,13 @@ ee.Initialize()\n
             self._log(f"❌ Code error: {tb}")
         finally:
             self.map.add_earthengine = real_add_ee
+            if rerun:
+                recorded = self._code_layer_defs.get(digest, []) + recorded
+            elif digest is not None:
+                self._code_layer_defs[digest] = list(recorded)
+            for ld in recorded:
+                if ld not in self.layers:
+                    self.layers.append(ld)
 
     def _on_scene_select(self, change):
         """Automatically load & preview whenever the dropdown changes."""
@@ -873,41 +1399,40 @@ ee.Initialize()\n
         t = ld["type"]
         name = ld.get("name", None)
 
-        self._log(f"→ Applying {t} layer: {name or ld['path']}")
+        self._log(f"→ Applying {t} layer: {name or ld.get('path')}")
 
         if t == "tile":
             self.map.add_tile(url=ld["path"], name=name)
         elif t == "geojson":
-            if "data" in ld:
-                # If GeoJSON data is embedded
-                layer = GeoJSON(data=ld["data"], name=ld.get("name"))
-            else:
-                # If GeoJSON is a URL, fetch and parse it
-                if ld["path"].startswith("http://") or ld["path"].startswith(
-                    "https://"
-                ):
-                    import requests
-
-                    response = requests.get(ld["path"])
-                    response.raise_for_status()  # Raise an error for bad responses
-                    geojson_data = response.json()  # Parse JSON response
-                    layer = GeoJSON(data=geojson_data, name=ld.get("name"))
-                else:
-                    # Treat as a local file path
-                    import json
-
-                    with open(ld["path"], "r") as f:
-                        geojson_data = json.load(f)  # Parse JSON file
-                        layer = GeoJSON(data=geojson_data, name=ld.get("name"))
-            self.map.add_layer(layer)
+            # embedded data, or a url/file in any registered vector kind
+            self.map.add_geojson(
+                ld["data"] if "data" in ld else ld.get("path") or ld.get("url"),
+                name=name,
+            )
+        elif t == "roi":
+            data = self.rois.to_geojson(ld["ids"])
+            self.map.add_layer(GeoJSON(data=data, name=name))
         elif t == "image":
             self.map.add_image(url=ld["path"], bounds=ld["bounds"], name=name)
         elif t == "raster":
-            self.map.add_raster(ld["path"], name=name)
+            self.map.add_raster(ld["path"], name=name, expression=ld.get("expression"))
+        elif t == "stack":
+            self.map.add_raster_stack(
+                ld["paths"],
+                labels=ld.get("labels"),
+                frame=ld.get("frame", 0),
+                name=name,
+                zoom_to_layer=False,
+            )
         elif t == "wms":
-            self.map.add_wms_layer(url=ld["path"], name=name)
+            self.map.add_wms_layer(url=ld["path"], layers=ld.get("layers"), name=name)
         elif t == "video":
-            self.map.add_video(ld["path"], bounds=ld["bounds"], name=name)
+            self.map.add_video(
+                ld["path"],
+                bounds=ld["bounds"],
+                name=name,
+                preprocess=ld.get("preprocess", False),
+            )
         else:
             self._log(f"❌ Unknown layer type: {t}")
 
@@ -925,16 +1450,10 @@ ee.Initialize()\n
             # Handle GeoJSON layers by calculating bounds from their data
             elif isinstance(layer, GeoJSON) and hasattr(layer, "data"):
                 try:
-                    features = layer.data.get("features", [])
-                    coords = [
-                        coord
-                        for feature in features
-                        for coord in self._extract_geojson_coords(feature)
-                    ]
-                    if coords:
-                        lats = [c[1] for c in coords]
-                        lons = [c[0] for c in coords]
-                        bboxes.append(((min(lats), min(lons)), (max(lats), max(lons))))
+                    # indexed once per payload, so repeated zooms don't rescan
+                    bb = self.spatial_index.index_geojson(layer.data).bounds
+                    if bb:
+                        bboxes.append(bb)
                 except Exception as e:
                     self._log(f"⚠️ Failed to calculate bounds for GeoJSON layer: {e}")
             # Add custom handling for other layer types if needed
@@ -961,22 +1480,6 @@ ee.Initialize()\n
         self.map.fit_bounds([sw, ne])
         self._log("🔍 Zoomed to fit all layers.")
 
-    def _extract_geojson_coords(self, feature):
-        """
-        Extract coordinates from a GeoJSON feature.
-        """
-        geometry = feature.get("geometry", {})
-        coords = geometry.get("coordinates", [])
-        if geometry.get("type") == "Point":
-            return [coords]
-        elif geometry.get("type") in ("LineString", "MultiPoint"):
-            return coords
-        elif geometry.get("type") in ("Polygon", "MultiLineString"):
-            return [pt for ring in coords for pt in ring]
-        elif geometry.get("type") == "MultiPolygon":
-            return [pt for polygon in coords for ring in polygon for pt in ring]
-        return []
-
     def _load_def_into_ui(self, layer_def):
         """
         Copy a saved layer definition back into the builder widgets
@@ -996,7 +1499,7 @@ ee.Initialize()\n
 
     def _enter_present_mode(self, _=None):
         scenes = sorted(self.story, key=lambda s: s.order)
-        story_obj = Story(scenes)
+        story_obj = Story(scenes, rois=self.rois)
         teller = StoryController(story_obj, self.map)
 
         # show the Edit button above the presenter interface
@@ -1011,6 +1514,8 @@ ee.Initialize()\n
 
     def _update_map_center(self, lat=None, lon=None):
         """Re‑center map when one of the text fields changes."""
+        if self._syncing:
+            return
         old_lat, old_lon = self.map.center
         new_lat = lat if lat is not None else old_lat
         new_lon = lon if lon is not None else old_lon
@@ -1019,6 +1524,8 @@ ee.Initialize()\n
 
     def _on_map_center_change(self, change):
         """Update lat/lon fields when the map is panned."""
+        if self._syncing:
+            return
         lat, lon = change["new"]
         # avoid feedback loops by only setting if really different
         if self.lat.value != lat:
@@ -1028,6 +1535,8 @@ ee.Initialize()\n
 
     def _on_map_zoom_change(self, change):
         """Update zoom slider when the map is zoomed."""
+        if self._syncing:
+            return
         z = change["new"]
         if self.zoom.value != z:
             self.zoom.value = z
@@ -1040,8 +1549,9 @@ ee.Initialize()\n
         old = change["old"]
         new = change["new"]
 
-        # only act when layers have been added
-        if len(new) <= len(old):
+        # only act when layers have been added, and not while a saved scene
+        # (with its own center and zoom) is being loaded
+        if len(new) <= len(old) or self._syncing:
             return
 
         try:
@@ -1104,7 +1614,7 @@ ee.Initialize()\n
     def _clear_layers(self, _=None):
         """Remove every overlay (keep only base) and reset the layer list."""
         # 1) Remove map overlays
-        for lyr in list(self.map.layers)[1:]:
+        for lyr in self.basemaps.overlays():
             self.map.remove_layer(lyr)
 
         # 2) Forget our internal defs & active overlay
@@ -1156,20 +1666,309 @@ ee.Initialize()\n
         self._active_overlay.bounds = (sw, ne)
 
 
-def detect_layer_type(path: str) -> str:
-    p = path.lower()
-    if p.startswith("projects/") or (p.count("/") >= 2 and not p.startswith("http")):
-        return "earthengine"
-    if "{z}" in p and "{x}" in p and "{y}" in p:
+def save_story(story, path):
+    """Write a story to a JSON file that `load_story` reads back.
+
+    The file holds ``{"rois": FeatureCollection, "scenes": [...]}``; only
+    the ROIs the scenes reference are written, once each.
+
+    Args:
+        story (Story or list): The story, or a list of scenes.
+        path (str): Output file, e.g. "story.json".
+    """
+    scenes = story.scenes if isinstance(story, Story) else list(story)
+    rois = story.rois if isinstance(story, Story) else ROIStore()
+    ids = sorted(
+        {i for s in scenes for ld in s.layers if ld["type"] == "roi" for i in ld["ids"]}
+    )
+    out = [
+        {
+            "title": s.title,
+            "order": s.order,
+            "center": list(s.center),
+            "zoom": s.zoom,
+            "layers": s.layers,
+            "basemap": s.basemap,
+            "custom_code": s.custom_code,
+        }
+        for s in scenes
+    ]
+    with open(path, "w") as f:
+        json.dump({"rois": rois.to_geojson(ids), "scenes": out}, f, indent=2)
+
+
+def load_story(path):
+    """Read a story written by `save_story` (or the SceneBuilder export).
+
+    Files holding a plain list of scenes, as written by older versions,
+    are read too.
+
+    Args:
+        path (str): The story.json file.
+
+    Returns:
+        Story: The story, with its ROIs in ``story.rois``.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"scenes": data}
+    rois = ROIStore.from_geojson(data.get("rois") or {})
+    scenes = [
+        Scene(
+            center=tuple(sc["center"]),
+            zoom=sc["zoom"],
+            layers=sc.get("layers"),
+            title=sc.get("title"),
+            order=sc.get("order", i + 1),
+            basemap=sc.get("basemap"),
+            custom_code=sc.get("custom_code") or "",
+        )
+        for i, sc in enumerate(data.get("scenes", []))
+    ]
+    return Story(scenes, rois=rois)
+
+
+# Layer kinds `detect_layer_type` recognizes, in registration order.
+LAYER_KINDS = {}
+
+# Detected kinds, keyed by path (and size and modification time for local
+# files), least recently used first.
+_LAYER_KIND_CACHE = collections.OrderedDict()
+_LAYER_KIND_CACHE_LOCK = threading.Lock()
+
+# Paths whose detected kind is kept (see `detect_layer_kind`).
+LAYER_KIND_CACHE_SIZE = 1024
+
+# Bytes read from a file or url to sniff its kind.
+SNIFF_BYTES = 1024
+
+
+def register_layer_kind(
+    kind, base, suffixes=(), magic=(), content_types=(), sniff=None
+):
+    """Register a layer kind for `detect_layer_type`.
+
+    Kinds registered later take precedence over earlier ones.
+
+    Args:
+        kind (str): Kind name, e.g. "flatgeobuf".
+        base (str): Layer type the kind is loaded as, e.g. "geojson".
+        suffixes (tuple, optional): File suffixes, e.g. ``(".fgb",)``.
+        magic (tuple, optional): Byte prefixes, or ``(offset, bytes)``
+            pairs, that identify the content.
+        content_types (tuple, optional): Content types (or prefixes ending
+            in "/") of urls serving this kind.
+        sniff (callable, optional): ``sniff(head) -> bool`` for content
+            that magic bytes cannot identify; ``head`` is the first
+            `SNIFF_BYTES` bytes.
+    """
+    LAYER_KINDS[kind] = {
+        "base": base,
+        "suffixes": tuple(s.lower() for s in suffixes),
+        "magic": tuple(m if isinstance(m, tuple) else (0, m) for m in magic),
+        "content_types": tuple(c.lower() for c in content_types),
+        "sniff": sniff,
+    }
+    with _LAYER_KIND_CACHE_LOCK:
+        _LAYER_KIND_CACHE.clear()
+
+
+def _is_json_object(head):
+    head = head.lstrip()
+    return head.startswith(b"{") and b'"type"' in head
+
+
+def _is_wms_capabilities(head):
+    return b"WMS_Capabilities" in head or b"WMT_MS_Capabilities" in head
+
+
+register_layer_kind(
+    "geojson",
+    "geojson",
+    suffixes=(".geojson", ".json"),
+    content_types=("application/geo+json", "application/vnd.geo+json"),
+    sniff=_is_json_object,
+)
+register_layer_kind(
+    "wms",
+    "wms",
+    suffixes=(".tms", ".wms", ".cgi"),
+    content_types=("application/vnd.ogc.wms_xml",),
+    sniff=_is_wms_capabilities,
+)
+register_layer_kind(
+    "image",
+    "image",
+    suffixes=(".png", ".jpg", ".jpeg", ".gif", ".webp"),
+    magic=(b"\x89PNG", b"\xff\xd8\xff", b"GIF8", (8, b"WEBP")),
+    content_types=("image/png", "image/jpeg", "image/gif", "image/webp"),
+)
+register_layer_kind(
+    "video",
+    "video",
+    suffixes=(".mp4", ".webm", ".ogg"),
+    magic=((4, b"ftyp"), b"\x1a\x45\xdf\xa3", b"OggS"),
+    content_types=("video/",),
+)
+register_layer_kind(
+    "geotiff",
+    "raster",
+    suffixes=(".tif", ".tiff"),
+    magic=(b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"),
+    content_types=("image/tiff", "image/geotiff"),
+)
+register_layer_kind(
+    "flatgeobuf",
+    "geojson",
+    suffixes=(".fgb",),
+    magic=(b"fgb\x03",),
+    content_types=("application/flatgeobuf", "application/x-flatgeobuf"),
+)
+register_layer_kind(
+    "geoparquet",
+    "geojson",
+    suffixes=(".parquet", ".geoparquet"),
+    magic=(b"PAR1",),
+    content_types=("application/vnd.apache.parquet", "application/x-parquet"),
+)
+# no map layer can draw PMTiles archives yet; detecting them avoids loading
+# one as something else
+register_layer_kind(
+    "pmtiles",
+    "pmtiles",
+    suffixes=(".pmtiles",),
+    magic=(b"PMTiles",),
+    content_types=("application/vnd.pmtiles",),
+)
+
+
+def _kind_from_suffix(path):
+    p = path.split("?", 1)[0].split("#", 1)[0].lower()
+    for kind, spec in reversed(LAYER_KINDS.items()):
+        if spec["suffixes"] and p.endswith(spec["suffixes"]):
+            return kind
+    return None
+
+
+def _kind_from_content_type(content_type):
+    content_type = (content_type or "").split(";", 1)[0].strip().lower()
+    if not content_type:
+        return None
+    for kind, spec in reversed(LAYER_KINDS.items()):
+        for ct in spec["content_types"]:
+            if content_type == ct or (ct.endswith("/") and content_type.startswith(ct)):
+                return kind
+    return None
+
+
+def _kind_from_bytes(head):
+    if not head:
+        return None
+    for kind, spec in reversed(LAYER_KINDS.items()):
+        if any(head[o : o + len(m)] == m for o, m in spec["magic"]):
+            return kind
+    for kind, spec in reversed(LAYER_KINDS.items()):
+        if spec["sniff"] is not None and spec["sniff"](head):
+            return kind
+    return None
+
+
+def _sniff_url(url, timeout=5):
+    """Kind of a url from a HEAD request, or the first bytes of its body."""
+    import requests
+
+    try:
+        resp = requests.head(url, allow_redirects=True, timeout=timeout)
+        kind = resp.ok and _kind_from_content_type(resp.headers.get("Content-Type"))
+        if kind:
+            return kind
+        headers = {"Range": f"bytes=0-{SNIFF_BYTES - 1}"}
+        with requests.get(url, headers=headers, stream=True, timeout=timeout) as resp:
+            if not resp.ok:
+                return None
+            # servers that ignore Range still only have SNIFF_BYTES read
+            head = next(resp.iter_content(SNIFF_BYTES), b"")
+            return _kind_from_bytes(head) or _kind_from_content_type(
+                resp.headers.get("Content-Type")
+            )
+    except requests.RequestException:
+        return None
+
+
+def detect_layer_kind(path: str, sniff: bool = True) -> str:
+    """Detect the kind of layer a path or url holds.
+
+    Earth Engine ids, XYZ templates and WMS urls are recognized from the
+    string.  Otherwise local files are identified by their magic bytes, and
+    urls by their suffix or, failing that, by the Content-Type of a HEAD
+    request and the first bytes of a small range GET.  The last
+    `LAYER_KIND_CACHE_SIZE` results are cached per path (and file size and
+    modification time).
+
+    Args:
+        path (str): Path, url, Earth Engine id or url template.
+        sniff (bool, optional): Read the content when needed. If False,
+            only the string is used. Defaults to True.
+
+    Returns:
+        str: A kind from `LAYER_KINDS`, "earthengine", "tile" or "unknown".
+    """
+    import os
+
+    from .tiles import source_stamp
+
+    p = path.strip()
+    lower = p.lower()
+    if "{z}" in lower and "{x}" in lower and "{y}" in lower:
         return "tile"
-    if p.endswith((".tms", ".wms", ".cgi")):
+    is_url = lower.startswith(("http://", "https://"))
+    if is_url and "service=wms" in lower:
         return "wms"
-    if p.endswith((".geojson", ".json")):
-        return "geojson"
-    if p.endswith((".tif", ".tiff")):
-        return "raster"
-    if p.endswith((".png", ".jpg", ".jpeg")):
-        return "image"
-    if p.endswith((".mp4", ".webm", ".ogg")):
-        return "video"
-    return "unknown"
+    is_file = not is_url and os.path.isfile(p)
+    suffix_kind = _kind_from_suffix(p)
+    if lower.startswith("projects/") or (
+        lower.count("/") >= 2 and not (is_url or is_file or suffix_kind)
+    ):
+        return "earthengine"
+
+    key = (p, source_stamp(p) if is_file else None, sniff)
+    with _LAYER_KIND_CACHE_LOCK:
+        kind = _LAYER_KIND_CACHE.get(key)
+        if kind is not None:
+            _LAYER_KIND_CACHE.move_to_end(key)
+            return kind
+    kind = suffix_kind
+    if sniff and is_file:
+        with open(p, "rb") as f:
+            kind = _kind_from_bytes(f.read(SNIFF_BYTES)) or kind
+    elif sniff and is_url and kind is None:
+        kind = _sniff_url(p)
+        if kind is None:
+            # not cached: the server may only have been unreachable
+            return "unknown"
+    kind = kind or "unknown"
+    with _LAYER_KIND_CACHE_LOCK:
+        _LAYER_KIND_CACHE[key] = kind
+        while len(_LAYER_KIND_CACHE) > LAYER_KIND_CACHE_SIZE:
+            _LAYER_KIND_CACHE.popitem(last=False)
+    return kind
+
+
+def detect_layer_type(path: str, sniff: bool = True) -> str:
+    """Detect the layer type to load a path or url as.
+
+    Like `detect_layer_kind`, with registered kinds mapped to their base
+    type (see `layer_type_of`).
+    """
+    return layer_type_of(detect_layer_kind(path, sniff))
+
+
+def layer_type_of(kind: str) -> str:
+    """Layer type a layer kind is loaded as.
+
+    Registered kinds map to their base type (e.g. "geotiff" to "raster",
+    "flatgeobuf" to "geojson"); other kinds are their own type.
+    """
+    spec = LAYER_KINDS.get(kind)
+    return spec["base"] if spec else kind
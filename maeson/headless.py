@@ -0,0 +1,336 @@
+"""Headless map backend for running stories without a browser.
+
+`HeadlessMap` implements the subset of the map surface that
+`maeson.gistory.StoryController` and `SceneBuilder` rely on
+(``add_layer``/``remove_layer``/``fit_bounds``/``center``/``zoom`` plus the
+``add_*`` convenience methods of `maeson.Map`), but instead of talking to a
+frontend it records every operation together with the size of the payload
+that would have been sent.  This makes it possible to validate and benchmark
+stories in batch jobs and CI.
+"""
+
+import glob
+import json
+import os
+import time
+
+import ipywidgets as widgets
+from traitlets import Float, List, Tuple
+
+from .common import bounds_to_center_zoom
+
+OSM_URL = "https://tile.openstreetmap.org/{z}/{x}/{y}.png"
+
+
+class HeadlessLayer:
+    """Lightweight stand-in for an ipyleaflet layer created by `HeadlessMap`."""
+
+    def __init__(self, type, name=None, url=None, data=None, bounds=None, **options):
+        self.type = type
+        self.name = name
+        self.url = url
+        self.data = data
+        self.bounds = bounds
+        self.options = options
+
+    def __repr__(self):
+        return f"HeadlessLayer(type={self.type!r}, name={self.name!r})"
+
+
+class HeadlessOp:
+    """A single recorded map operation."""
+
+    __slots__ = ("op", "name", "nbytes", "timestamp")
+
+    def __init__(self, op, name=None, nbytes=0):
+        self.op = op
+        self.name = name
+        self.nbytes = nbytes
+        self.timestamp = time.perf_counter()
+
+    def __repr__(self):
+        return f"HeadlessOp({self.op!r}, name={self.name!r}, nbytes={self.nbytes})"
+
+
+def payload_size(layer) -> int:
+    """Estimate how many bytes a layer would send to the frontend.
+
+    Args:
+        layer: An ipyleaflet layer or `HeadlessLayer`.
+
+    Returns:
+        int: Size of the serialized payload in bytes.
+    """
+    data = getattr(layer, "data", None)
+    if isinstance(data, dict) and data:
+        return len(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+    url = getattr(layer, "url", None)
+    if isinstance(url, str):
+        return len(url.encode("utf-8"))
+    return 0
+
+
+class HeadlessMap(widgets.Widget):
+    """A map widget without a frontend that records what it is asked to do.
+
+    Args:
+        center (tuple, optional): Initial (lat, lon). Defaults to (0, 0).
+        zoom (float, optional): Initial zoom. Defaults to 2.
+        width (int, optional): Simulated viewport width used by `fit_bounds`.
+        height (int, optional): Simulated viewport height used by `fit_bounds`.
+        basemap (bool, optional): If True, start with a single base layer at
+            index 0 like a regular `maeson.Map`. Defaults to True.
+
+    Changes to ``center``, ``zoom`` and ``layers`` are counted as the state
+    messages a real widget would send (``messages``); inside ``hold_sync``
+    they are coalesced into one, as in ipywidgets.
+    """
+
+    center = List([0.0, 0.0])
+    zoom = Float(2.0)
+    layers = Tuple()
+
+    def __init__(
+        self, center=(0, 0), zoom=2, width=960, height=600, basemap=True, **kwargs
+    ):
+        self.ops = []
+        self.messages = 0
+        super().__init__(center=list(center), zoom=zoom, **kwargs)
+        self.width = width
+        self.height = height
+        self.controls = []
+        self.ops = []
+        self.messages = 0
+        if basemap:
+            base = HeadlessLayer("basemap", name="OpenStreetMap", url=OSM_URL)
+            base.base = True
+            self.layers = (base,)
+        self.observe(self._on_view_change, names=["center", "zoom"])
+        self.observe(self._on_layers_change, names="layers")
+
+    # ------------------------------------------------------------------ #
+    # Recording
+    # ------------------------------------------------------------------ #
+    def _record(self, op, name=None, nbytes=0):
+        self.ops.append(HeadlessOp(op, name=name, nbytes=nbytes))
+
+    def _on_view_change(self, change):
+        self._record(change["name"], nbytes=len(repr(change["new"])))
+
+    def _on_layers_change(self, change):
+        old = {id(lyr) for lyr in change["old"]}
+        new = {id(lyr) for lyr in change["new"]}
+        for lyr in change["old"]:
+            if id(lyr) not in new:
+                self._record("remove_layer", getattr(lyr, "name", None))
+        for lyr in change["new"]:
+            if id(lyr) not in old:
+                self._record("add_layer", getattr(lyr, "name", None), payload_size(lyr))
+
+    def notify_change(self, change):
+        if change["name"] in ("center", "zoom", "layers"):
+            if self._holding_sync:
+                self._states_to_send.add(change["name"])
+            else:
+                self.send_state(change["name"])
+        super().notify_change(change)
+
+    def send_state(self, key=None):
+        """Count a state message instead of sending it."""
+        if key:
+            self.messages += 1
+            self._record("sync", nbytes=len(key) if isinstance(key, set) else 1)
+
+    def reset_ops(self):
+        """Forget all recorded operations and message counts."""
+        self.ops = []
+        self.messages = 0
+
+    def summary(self):
+        """Aggregate the recorded operations.
+
+        Returns:
+            dict: Mapping of operation name to ``{"count": n, "bytes": b}``
+            plus ``"total"`` for all operations.
+        """
+        out = {}
+        for op in self.ops:
+            entry = out.setdefault(op.op, {"count": 0, "bytes": 0})
+            entry["count"] += 1
+            entry["bytes"] += op.nbytes
+        out["total"] = {
+            "count": len(self.ops),
+            "bytes": sum(op.nbytes for op in self.ops),
+        }
+        return out
+
+    # ------------------------------------------------------------------ #
+    # Core map surface
+    # ------------------------------------------------------------------ #
+    def add_layer(self, layer):
+        """Add a layer and record its payload size."""
+        if layer in self.layers:
+            return layer
+        self.layers = self.layers + (layer,)
+        return layer
+
+    def add(self, item):
+        """Add a layer (or control) like `ipyleaflet.Map.add`."""
+        if hasattr(item, "position"):
+            return self.add_control(item)
+        return self.add_layer(item)
+
+    def remove_layer(self, layer):
+        """Remove a layer if present."""
+        if layer not in self.layers:
+            return
+        self.layers = tuple(lyr for lyr in self.layers if lyr is not layer)
+
+    def remove(self, item):
+        """Remove a layer or control."""
+        if item in self.controls:
+            return self.remove_control(item)
+        return self.remove_layer(item)
+
+    def add_control(self, control):
+        """Record a control being added."""
+        self.controls.append(control)
+        self._record("add_control", type(control).__name__)
+
+    def remove_control(self, control):
+        """Record a control being removed."""
+        if control in self.controls:
+            self.controls.remove(control)
+            self._record("remove_control", type(control).__name__)
+
+    def fit_bounds(self, bounds):
+        """Set center and zoom so that ``bounds`` fills the simulated viewport."""
+        self._record("fit_bounds", nbytes=len(repr(bounds)))
+        center, zoom = bounds_to_center_zoom(bounds, self.width, self.height)
+        self.center = list(center)
+        self.zoom = zoom
+
+    # ------------------------------------------------------------------ #
+    # maeson.Map convenience methods
+    # ------------------------------------------------------------------ #
+    def add_tile(self, url, name=None, **kwargs):
+        return self.add_layer(HeadlessLayer("tile", name=name, url=url, **kwargs))
+
+    def add_geojson(self, geojson=None, name=None, path=None, **kwargs):
+        src = path if geojson is None else geojson
+        data = src if isinstance(src, dict) else None
+        url = None
+        if isinstance(src, str):
+            if os.path.exists(src):
+                from .render import read_geojson
+
+                data = read_geojson(src)
+            else:
+                url = src
+        layer = HeadlessLayer("geojson", name=name, url=url, data=data, **kwargs)
+        return self.add_layer(layer)
+
+    def add_vector(self, vector, **kwargs):
+        return self.add_geojson(vector, **kwargs)
+
+    def add_image(self, url, bounds, opacity=1, name=None, **kwargs):
+        layer = HeadlessLayer(
+            "image", name=name, url=url, bounds=bounds, opacity=opacity, **kwargs
+        )
+        self.add_layer(layer)
+        self.center = [
+            (bounds[0][0] + bounds[1][0]) / 2,
+            (bounds[0][1] + bounds[1][1]) / 2,
+        ]
+        return layer
+
+    def add_video(self, url, bounds, name=None, **kwargs):
+        layer = HeadlessLayer("video", name=name, url=url, bounds=bounds, **kwargs)
+        self.add_layer(layer)
+        self.fit_bounds(bounds)
+        return layer
+
+    def add_raster(self, filepath, name=None, zoom_to_layer=True, **kwargs):
+        layer = HeadlessLayer(
+            "raster", name=name or os.path.basename(filepath), url=filepath, **kwargs
+        )
+        return self.add_layer(layer)
+
+    def add_raster_stack(self, sources, labels=None, frame=0, name=None, **kwargs):
+        paths = getattr(sources, "sources", sources)
+        if isinstance(paths, str):
+            paths = sorted(glob.glob(paths))
+        layer = HeadlessLayer(
+            "stack",
+            name=name,
+            url=paths[frame],
+            frame=frame,
+            frames=len(paths),
+            labels=labels,
+        )
+        return self.add_layer(layer)
+
+    def add_wms_layer(self, url, layers=None, name=None, **kwargs):
+        layer = HeadlessLayer("wms", name=name, url=url, layers=layers, **kwargs)
+        return self.add_layer(layer)
+
+    def add_earthengine(
+        self, ee_object=None, vis_params=None, name="EE Layer", **kwargs
+    ):
+        ee_id = kwargs.pop("ee_id", ee_object)
+        layer = HeadlessLayer(
+            "earthengine", name=name, url=str(ee_id), vis_params=vis_params or {}
+        )
+        return self.add_layer(layer)
+
+
+def replay_story(story, map_obj=None, repeat=1):
+    """Replay every scene of a story at full speed and measure it.
+
+    Args:
+        story (maeson.gistory.Story): The story to replay.
+        map_obj (HeadlessMap, optional): Map to replay onto. A new
+            `HeadlessMap` is created if omitted.
+        repeat (int, optional): Number of passes over all scenes. Defaults to 1.
+
+    Returns:
+        dict: Timing and payload statistics with the keys ``scenes``,
+        ``seconds``, ``scenes_per_second``, ``max_scene_seconds``,
+        ``messages``, ``max_scene_messages``, ``failed_layers`` and ``ops``
+        (see `HeadlessMap.summary`).
+    """
+    from .gistory import StoryController
+
+    map_obj = map_obj if map_obj is not None else HeadlessMap()
+    start_index = story.index
+    story.index = 0
+    controller = StoryController(story, map_obj)
+    map_obj.reset_ops()
+
+    timings = []
+    messages = []
+    failed = 0
+    try:
+        for _ in range(repeat):
+            for i, scene in enumerate(story.scenes):
+                story.index = i
+                m0 = map_obj.messages
+                t0 = time.perf_counter()
+                controller._update_scene()
+                timings.append(time.perf_counter() - t0)
+                messages.append(map_obj.messages - m0)
+                failed += len(scene.layers) - len(controller.current_layers)
+    finally:
+        story.index = start_index
+
+    total = sum(timings)
+    return {
+        "scenes": len(timings),
+        "seconds": total,
+        "scenes_per_second": len(timings) / total if total else float("inf"),
+        "max_scene_seconds": max(timings, default=0.0),
+        "messages": sum(messages),
+        "max_scene_messages": max(messages, default=0),
+        "failed_layers": failed,
+        "ops": map_obj.summary(),
+    }
@@ -10,6 +10,10 @@ import localtileserver
 import ee
 import geemap
 from localtileserver import TileClient, get_leaflet_tile_layer
+from .raster import BandMath, RasterMosaic, RasterStack, optimized_path
+from .basemaps import BasemapManager
+from .proxy import tile_url
+from .tiles import LOCALTILESERVER_OPTIONS, TileServer, localtileserver_provider
 from ipywidgets import widgets, Dropdown, Button, VBox
 from ipyleaflet import (
     WidgetControl,
@@ -38,10 +42,22 @@ class Map(Leafmap):
         kwargs.setdefault("layer_control", True)
         super().__init__(*args, **kwargs)
 
-    def add_basemap(self, basemap="Esri.WorldImagery"):
+    @property
+    def basemaps(self):
+        """The map's `maeson.basemaps.BasemapManager`."""
+        return BasemapManager.of(self)
+
+    def add_basemap(self, basemap="Esri.WorldImagery", proxy=None):
         """
+        Show a basemap. Basemaps are kept on the map below the overlays and
+        switched by visibility (see `basemaps`), so showing one again does
+        not reload its tiles.
+
         Args:
             basemap (str): Basemap name. Default is "Esri.WorldImagery".
+            proxy (bool, optional): Load tiles through maeson's caching
+                tile proxy. Defaults to the `maeson.proxy.proxy_tiles`
+                setting.
         """
         """Add a basemap to the map."""
         basemaps = [
@@ -64,8 +80,25 @@ class Map(Leafmap):
             "Google.Terrain",
         ]
         url = eval(f"ipyleaflet.basemaps.{basemap}").build_url()
-        basemap_layer = ipyleaflet.TileLayer(url=url, name=basemap)
-        self.add(basemap_layer)
+        return self.basemaps.show(basemap, url=url, proxy=proxy)
+
+    def add_tile(self, url, name=None, proxy=None, **kwargs):
+        """
+        Add an XYZ tile layer and return it.
+
+        Args:
+            url (str): Url template with {z}, {x} and {y} placeholders.
+            name (str, optional): Layer name. Defaults to "Tiles".
+            proxy (bool, optional): Load tiles through maeson's caching
+                tile proxy. Defaults to the `maeson.proxy.proxy_tiles`
+                setting.
+            **kwargs: Additional arguments for `ipyleaflet.TileLayer`.
+        """
+        layer = ipyleaflet.TileLayer(
+            url=tile_url(url, proxy), name=name or "Tiles", **kwargs
+        )
+        self.add(layer)
+        return layer
 
     def layer(self, layer) -> None:
         """
@@ -95,15 +128,45 @@ class Map(Leafmap):
 
         self.add(ipyleaflet.LayersControl(position=position))
 
-    def add_geojson(self, geojson, **kwargs):
+    def add_geojson(self, geojson, stream=False, aggregate=None, **kwargs):
         """
         Args:
-            geojson (dict): GeoJSON data.
+            geojson (dict or str): GeoJSON data, or the path/url of a
+                GeoJSON, FlatGeobuf or GeoParquet file (see
+                `maeson.render.read_geojson`).
+            stream (bool): If True, only send the features near the current
+                view and keep them in sync as the map moves (see
+                `maeson.vector.StreamingGeoJSON`). Defaults to False.
+            aggregate (str): "hex" or "grid" to show dense points as
+                aggregated cells that update with the view (see
+                `maeson.vector.AggregatedPoints`). Defaults to None.
             **kwargs: Additional arguments for the GeoJSON layer.
+
+        Returns:
+            ipyleaflet.Layer: The layer that was added.
         """
         """Add a GeoJSON layer to the map."""
+        if isinstance(geojson, str):
+            from .render import read_geojson
+
+            geojson = read_geojson(geojson)
+        if aggregate:
+            from .vector import AggregatedPoints
+
+            geojson_layer = AggregatedPoints(geojson, kind=aggregate, **kwargs)
+            self.add(geojson_layer)
+            geojson_layer.attach(self)
+            return geojson_layer
+        if stream:
+            from .vector import StreamingGeoJSON
+
+            geojson_layer = StreamingGeoJSON(geojson, **kwargs)
+            self.add(geojson_layer)
+            geojson_layer.attach(self)
+            return geojson_layer
         geojson_layer = ipyleaflet.GeoJSON(data=geojson, **kwargs)
         self.add(geojson_layer)
+        return geojson_layer
 
     def set_center(self, lat, lon, zoom=6, **kwargs):
         """
@@ -132,13 +195,17 @@ class Map(Leafmap):
         self.center = (obj.location[0], obj.location[1])
         self.zoom = zoom
 
-    def add_vector(self, vector, **kwargs):
+    def add_vector(self, vector, stream=False, **kwargs):
         """
         Args:
             vector (dict): Vector data.
+            stream (bool): If True, stream features with the viewport like
+                `add_geojson`. Defaults to False.
             **kwargs: Additional arguments for the GeoJSON layer.
         """
         """Add a vector layer to the map from Geopandas."""
+        if stream:
+            return self.add_geojson(vector, stream=True, **kwargs)
         vector_layer = ipyleaflet.GeoJSON(data=vector, **kwargs)
         self.add(vector_layer)
 
@@ -149,6 +216,10 @@ class Map(Leafmap):
         colormap="greys",
         opacity: float = 1.0,
         zoom_to_layer: bool = True,
+        optimize: bool = True,
+        optimize_in_background: bool = True,
+        expression: str = None,
+        cache_tiles: bool = False,
         **kwargs,
     ):
         """
@@ -166,8 +237,30 @@ class Map(Leafmap):
             0.0 (transparent) – 1.0 (opaque).
         zoom_to_layer : bool, optional
             If True, fit the map to the raster’s bounds after adding.
+        optimize : bool, optional
+            If True, local rasters of at least 8 MiB that are stored in
+            strips or lack overviews are served from a cached COG copy
+            (see `maeson.raster.optimized_path`).
+        optimize_in_background : bool, optional
+            If True, the COG conversion runs in a process pool so the call
+            returns at once: this layer reads the original file and later
+            calls use the cached COG.  If False, the call blocks until the
+            conversion is done. Defaults to True.
+        expression : str, optional
+            Band-math expression over bands ``b1``, ``b2``, ... such as
+            "(b4-b3)/(b4+b3)". It is evaluated per tile (see
+            `maeson.raster.BandMath`) and the result is shown with
+            ``colormap``.
         **kwargs : dict
-            Extra kwargs passed to `get_leaflet_tile_layer`.
+            Extra kwargs passed to `get_leaflet_tile_layer` (or
+            `ipyleaflet.TileLayer` with an expression).
+        cache_tiles : bool, optional
+            If True, tiles are rendered through maeson's shared memory/disk
+            tile cache (see `maeson.tiles.get_tile_cache`) and served by
+            maeson's local `maeson.tiles.TileServer` instead of being
+            requested from localtileserver directly.  On remote kernels
+            (e.g. JupyterHub) the browser reaches that server only when
+            ``MAESON_SERVER_URL`` is set. Defaults to False.
 
         Returns
         -------
@@ -190,6 +283,11 @@ class Map(Leafmap):
                         f.write(chunk)
             filepath = local_fp
 
+        # 1b) Serve plain striped GeoTIFFs from a cached, tiled COG
+        layer_name = name or os.path.basename(filepath)
+        if optimize:
+            filepath = optimized_path(filepath, background=optimize_in_background)
+
         # 2) Inspect with rasterio: get colormap if needed + bounds
         with rasterio.open(filepath) as src:
             if colormap is None:
@@ -200,11 +298,34 @@ class Map(Leafmap):
             left, bottom, right, top = src.bounds
 
         # 3) Spin up the tile server + leaflet layer
-        client = TileClient(filepath)
-        layer_name = name or os.path.basename(filepath)
-        tile_layer = get_leaflet_tile_layer(
-            client, name=layer_name, colormap=colormap, opacity=opacity, **kwargs
-        )
+        if expression:
+            band_math = BandMath(filepath, expression, colormap=colormap)
+            tile_layer = ipyleaflet.TileLayer(
+                url=TileServer.get().register(band_math.tile),
+                name=layer_name,
+                opacity=opacity,
+                **kwargs,
+            )
+        elif cache_tiles:
+            client = TileClient(filepath)
+            options = {k: kwargs.pop(k) for k in LOCALTILESERVER_OPTIONS if k in kwargs}
+            provider = localtileserver_provider(
+                client, filepath, colormap=colormap, **options
+            )
+            kwargs.setdefault("max_zoom", 30)
+            kwargs.setdefault("max_native_zoom", 30)
+            tile_layer = ipyleaflet.TileLayer(
+                url=TileServer.get().register(provider),
+                name=layer_name,
+                opacity=opacity,
+                **kwargs,
+            )
+            tile_layer.client = client
+        else:
+            client = TileClient(filepath)
+            tile_layer = get_leaflet_tile_layer(
+                client, name=layer_name, colormap=colormap, opacity=opacity, **kwargs
+            )
 
         # 4) Add to the map
         try:
@@ -230,6 +351,166 @@ class Map(Leafmap):
 
         return tile_layer
 
+    def add_raster_mosaic(
+        self,
+        sources,
+        name: str = "Mosaic",
+        colormap="greys",
+        opacity: float = 1.0,
+        zoom_to_layer: bool = True,
+        rescale=None,
+        **kwargs,
+    ):
+        """
+        Add many rasters as a single composited tile layer and return it.
+
+        Tiles are served by maeson's local `TileServer`; each tile reads only
+        the sources whose footprint intersects it.
+
+        Parameters
+        ----------
+        sources : list or str
+            Raster paths/URLs, or a glob pattern such as "scenes/*.tif".
+        name : str, optional
+            Display name for the layer.
+        colormap : dict or str, optional
+            Colormap for single-band mosaics.
+        opacity : float, optional
+            0.0 (transparent) – 1.0 (opaque).
+        zoom_to_layer : bool, optional
+            If True, fit the map to the mosaic's bounds after adding.
+        rescale : tuple, optional
+            (lo, hi) display range. Defaults to the sources' combined range.
+        **kwargs : dict
+            Extra kwargs passed to `ipyleaflet.TileLayer`.
+
+        Returns
+        -------
+        ipyleaflet.TileLayer
+            The tile layer that was added.
+        """
+        mosaic = RasterMosaic(sources, colormap=colormap, rescale=rescale)
+        url = TileServer.get().register(mosaic.tile)
+        (south, west), (north, east) = mosaic.bounds
+        tile_layer = ipyleaflet.TileLayer(
+            url=url,
+            name=name,
+            opacity=opacity,
+            bounds=[[south, west], [north, east]],
+            **kwargs,
+        )
+        tile_layer.mosaic = mosaic
+        self.add(tile_layer)
+        if zoom_to_layer:
+            self.fit_bounds([[south, west], [north, east]])
+        return tile_layer
+
+    def add_raster_stack(
+        self,
+        sources,
+        labels=None,
+        frame: int = 0,
+        name: str = "Stack",
+        colormap="greys",
+        opacity: float = 1.0,
+        zoom_to_layer: bool = True,
+        slider: bool = True,
+        position: str = "bottomright",
+        **kwargs,
+    ):
+        """
+        Add a time series of rasters as one layer with a frame slider.
+
+        All frames share one local tile server and tile cache, and tiles of
+        the frames next to the visible one are prefetched.
+
+        Parameters
+        ----------
+        sources : list, str or maeson.raster.RasterStack
+            Raster paths in time order, a glob pattern, or an existing stack.
+            Stacks are shared, so adding the same paths again reuses the
+            open datasets and warm tile cache.
+        labels : list, optional
+            A label per frame, e.g. dates. Defaults to the file names.
+        frame : int, optional
+            Index of the frame shown first.
+        name : str, optional
+            Display name for the layer.
+        colormap : dict or str, optional
+            Colormap for single-band rasters.
+        opacity : float, optional
+            0.0 (transparent) – 1.0 (opaque).
+        zoom_to_layer : bool, optional
+            If True, fit the map to the stack's bounds after adding.
+        slider : bool, optional
+            If True, add a slider control that switches frames.
+        position : str, optional
+            Position of the slider control.
+        **kwargs : dict
+            Extra kwargs passed to `ipyleaflet.TileLayer`.
+
+        Returns
+        -------
+        ipyleaflet.TileLayer
+            The tile layer; its ``stack`` attribute is the `RasterStack`.
+        """
+        if isinstance(sources, RasterStack):
+            stack = sources
+        else:
+            stack = RasterStack.get(sources, labels=labels, colormap=colormap)
+        stack.frame = frame
+        (south, west), (north, east) = stack.bounds
+        tile_layer = ipyleaflet.TileLayer(
+            url=stack.url,
+            name=name,
+            opacity=opacity,
+            bounds=[[south, west], [north, east]],
+            **kwargs,
+        )
+        tile_layer.stack = stack
+        self.add(tile_layer)
+
+        if slider:
+            frame_slider = widgets.IntSlider(
+                value=frame,
+                min=0,
+                max=len(stack) - 1,
+                description=name,
+                readout=False,
+                continuous_update=False,
+            )
+            label = widgets.Label(stack.labels[frame])
+
+            def _on_frame(change):
+                self.set_stack_frame(tile_layer, change["new"])
+                label.value = stack.labels[change["new"]]
+
+            frame_slider.observe(_on_frame, names="value")
+            self.add(
+                WidgetControl(
+                    widget=widgets.HBox([frame_slider, label]), position=position
+                )
+            )
+
+        if zoom_to_layer:
+            self.fit_bounds([[south, west], [north, east]])
+        return tile_layer
+
+    def set_stack_frame(self, layer, frame: int):
+        """
+        Show another frame of a layer added with `add_raster_stack`.
+
+        Parameters
+        ----------
+        layer : ipyleaflet.TileLayer
+            The stack layer.
+        frame : int
+            Index of the frame to show.
+        """
+        stack = layer.stack
+        stack.frame = frame
+        layer.url = stack.url
+
     def add_image(self, url, bounds, opacity=1, **kwargs):
         """
         Adds an image or animated GIF overlay to the map.
@@ -240,6 +521,9 @@ class Map(Leafmap):
             opacity (float, optional): The transparency level of the overlay (default is 1, fully opaque).
             **kwargs: Additional keyword arguments for ipyleaflet.ImageOverlay.
 
+        Returns:
+            ipyleaflet.ImageOverlay: The overlay.
+
         Raises:
             ValueError: If bounds is not provided or is improperly formatted.
         """
@@ -265,6 +549,73 @@ class Map(Leafmap):
             (bounds[0][0] + bounds[1][0]) / 2,
             (bounds[0][1] + bounds[1][1]) / 2,
         ]
+        return overlay
+
+    def add_raster_animation(
+        self,
+        sources,
+        bounds=None,
+        format: str = "webp",
+        name: str = "Animation",
+        fps: float = 2,
+        colormap="greys",
+        expression=None,
+        max_size: int = 1024,
+        opacity: float = 1.0,
+        **kwargs,
+    ):
+        """
+        Add an animated overlay generated from a raster time series.
+
+        Frames are windowed reads of each raster at the overlay's on-screen
+        resolution, rendered in parallel (see
+        `maeson.raster.export_animation`), and the result is served locally
+        and added with `add_image` (WebP/GIF) or `add_video` (MP4).
+
+        Parameters
+        ----------
+        sources : list, str, dict or maeson.raster.RasterStack
+            Raster paths/URLs in time order, a glob pattern, a
+            ``{time: path}`` dict, or a stack.
+        bounds : tuple, optional
+            ((south, west), (north, east)). Defaults to the rasters' bounds.
+        format : str, optional
+            "webp", "gif" or "mp4".
+        name : str, optional
+            Display name for the layer.
+        fps : float, optional
+            Frames per second.
+        colormap : dict or str, optional
+            Colormap for single-band rasters and expressions.
+        expression : str, optional
+            Band-math expression rendered for every frame.
+        max_size : int, optional
+            Cap on the longer side of the frames, in pixels.
+        opacity : float, optional
+            0.0 (transparent) – 1.0 (opaque).
+        **kwargs : dict
+            Extra kwargs passed to `add_image` or `add_video`.
+
+        Returns
+        -------
+        ipyleaflet.ImageOverlay or ipyleaflet.VideoOverlay
+            The overlay.
+        """
+        from .raster import export_animation
+
+        path, bounds = export_animation(
+            sources,
+            format=format,
+            bounds=bounds,
+            max_size=max_size,
+            fps=fps,
+            colormap=colormap,
+            expression=expression,
+        )
+        url = TileServer.get().register_file(path)
+        if format == "mp4":
+            return self.add_video(url, bounds, opacity=opacity, name=name, **kwargs)
+        return self.add_image(url, bounds, opacity=opacity, name=name, **kwargs)
 
     def add_video(
         self,
@@ -274,10 +625,28 @@ class Map(Leafmap):
         autoplay: bool = True,
         loop: bool = True,
         muted: bool = True,
+        preprocess: bool = False,
+        max_size: int = 1280,
         **kwargs,
     ):
         """
         Adds a video overlay to the map using ipyleaflet.VideoOverlay.
+
+        Args:
+            url (str): Video path or url.
+            bounds (sequence): ((south, west), (north, east)).
+            opacity (float, optional): Overlay opacity. Defaults to 1.0.
+            autoplay (bool, optional): Start playing at once. Defaults to True.
+            loop (bool, optional): Loop the video. Defaults to True.
+            muted (bool, optional): Mute the video. Defaults to True.
+            preprocess (bool, optional): Transcode the video to the overlay's
+                on-screen size and serve it locally with range support (see
+                `maeson.video.video_url`). Defaults to False.
+            max_size (int, optional): Cap on the longer side of a
+                preprocessed video. Defaults to 1280.
+
+        Returns:
+            ipyleaflet.VideoOverlay: The overlay.
         """
         # 1) Validate & normalize bounds
         if not (
@@ -289,6 +658,11 @@ class Map(Leafmap):
 
         bounds = [list(bounds[0]), list(bounds[1])]
 
+        if preprocess:
+            from .video import video_url
+
+            url = video_url(url, bounds, max_size=max_size)
+
         # 2) Create the VideoOverlay (url must be a string)
         overlay = VideoOverlay(
             url=url,
@@ -303,38 +677,78 @@ class Map(Leafmap):
         # 3) Add to map and fit to the bounds
         self.add_layer(overlay)
         self.fit_bounds(bounds)
+        return overlay
 
-    def add_wms_layer(self, url, layers, name, format, transparent, **kwargs):
+    def add_wms_layer(
+        self,
+        url,
+        layers=None,
+        name=None,
+        format=None,
+        transparent=True,
+        proxy=None,
+        **kwargs,
+    ):
         """
-        Adds a WMS (Web Map Service) layer to the map using ipyleaflet.WMSLayer.
+        Adds a WMS (Web Map Service) layer to the map.
+
+        The endpoint's capabilities are read once (see `maeson.wms`) to check
+        the layer names and pick a format and CRS.  The layer is drawn from
+        the service's WMTS tiles when it offers them, from tile-aligned
+        GetMap requests through the local caching proxy when ``proxy`` is
+        on, and otherwise with ipyleaflet.WMSLayer, which is also used when
+        the capabilities cannot be read.
 
         Parameters:
             url (str): Base WMS endpoint.
-            layers (str): Comma-separated layer names.
-            name (str): Display name for the layer.
-            format (str): Image format (e.g., 'image/png').
+            layers (str, optional): Comma-separated layer names. Defaults to
+                the first layer the service advertises.
+            name (str, optional): Display name for the layer.
+            format (str, optional): Image format (e.g., 'image/png').
+                Defaults to PNG if the service offers it.
             transparent (bool): Whether the WMS layer should be transparent.
-            **kwargs: Additional keyword arguments for ipyleaflet.WMSLayer.
+            proxy (bool, optional): Cache GetMap tiles through maeson's local
+                tile proxy. Defaults to the `maeson.proxy.proxy_tiles`
+                setting.
+            **kwargs: Additional keyword arguments for the ipyleaflet layer.
+
+        Returns:
+            ipyleaflet.Layer: The added layer.
         """
+        import xml.etree.ElementTree as ET
 
-        # Create the WMS layer using the provided parameters.
-        wms_layer = WMSLayer(
-            url=url,
-            layers=layers,
-            name=name,
-            format=format,
-            transparent=transparent,
-            **kwargs,
-        )
+        from .wms import wms_layer_url
+
+        styles = kwargs.pop("styles", "")
+        try:
+            info = wms_layer_url(url, layers, format, transparent, styles, proxy)
+        except (requests.RequestException, ValueError, ET.ParseError) as e:
+            print(f"⚠️ Could not read the capabilities of {url}: {e}")
+            info = {"kind": "wms", "url": url, "layers": layers or "", "format": format}
+
+        name = name or info["layers"]
+        if info["kind"] == "wms":
+            layer = WMSLayer(
+                url=info["url"],
+                layers=info["layers"],
+                name=name,
+                format=info["format"] or "image/png",
+                transparent=transparent,
+                styles=styles,
+                **kwargs,
+            )
+        else:
+            kwargs.setdefault("max_zoom", 22)
+            layer = TileLayer(url=info["url"], name=name, **kwargs)
 
-        # Add the WMS layer to the map.
-        self.add(wms_layer)
+        self.add(layer)
+        return layer
 
     def add_basemap_dropdown(self):
         """
         Adds a dropdown + hide button as a map control.
-        Keeps track of the current basemap layer so that selecting
-        a new one removes the old and adds the new immediately.
+        Selecting a basemap shows it through the map's `basemaps` manager,
+        which hides the previous one instead of removing it.
 
         Returns:
             None
@@ -357,20 +771,18 @@ class Map(Leafmap):
         hide_btn = widgets.Button(description="Hide", button_style="danger")
         container = widgets.VBox([dropdown, hide_btn])
 
-        # 3. add the initial basemap layer and remember it
-        initial = basemap_dict[dropdown.value]
-        self._current_basemap = basemap_to_tiles(initial)
-        self.add_layer(self._current_basemap)
+        # 3. show the initial basemap; the manager keeps every basemap layer
+        def _show(label):
+            provider = basemap_dict[label]
+            return self.basemaps.show(provider.name, url=provider.build_url())
+
+        self._current_basemap = _show(dropdown.value)
 
-        # 4. when user picks a new basemap, swap layers
+        # 4. when user picks a new basemap, toggle visibility instead of
+        #    re-creating layers
         def _on_change(change):
             if change["name"] == "value":
-                new_tiles = basemap_to_tiles(basemap_dict[change["new"]])
-                # remove old
-                self.remove_layer(self._current_basemap)
-                # add new & store reference
-                self._current_basemap = new_tiles
-                self.add_layer(self._current_basemap)
+                self._current_basemap = _show(change["new"])
 
         dropdown.observe(_on_change, names="value")
 
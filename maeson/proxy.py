@@ -0,0 +1,255 @@
+"""Local caching proxy for remote XYZ tiles, with offline seeding.
+
+Basemaps and "tile" layers normally point the browser straight at remote
+servers.  With `proxy_tiles` enabled, maeson layers request those tiles from
+the local `maeson.tiles.TileServer` instead, which answers from a bounded
+disk cache and only goes to the network on a miss.  `seed_tiles` and
+`seed_story` download a bounding box / a story's views ahead of time, and
+offline mode serves purely from the cache, for demos without network.
+"""
+
+import hashlib
+import math
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+
+from .common import tiles_in_bounds, viewport_bounds
+from .tiles import TileCache, TileServer, fetch_xyz_tile, get_tile, tile_key
+
+# Default size cap of the basemap cache, in bytes.
+BASEMAP_CACHE_BYTES = 1024 * 2**20
+
+_SETTINGS = {"enabled": False, "offline": False}
+_CACHE = None
+
+
+def get_basemap_cache():
+    """The shared, size-capped disk cache for remote tiles.
+
+    It uses the same directory as the offline renderer (`maeson.render`), so
+    tiles seeded for the map are reused when rendering stills and videos.
+    """
+    global _CACHE
+    if _CACHE is None:
+        _CACHE = TileCache(max_bytes=BASEMAP_CACHE_BYTES)
+    return _CACHE
+
+
+def proxy_tiles(enabled=True, offline=False, cache_dir=None, max_bytes=None):
+    """Route maeson's remote tile layers through the local caching proxy.
+
+    Affects layers created afterwards by `maeson.Map.add_basemap`,
+    `add_basemap_dropdown`, `add_tile`, `maeson.folmap.Map.add_basemap` and
+    story "tile" layers.
+
+    Args:
+        enabled (bool, optional): Turn the proxy on or off. Defaults to True.
+        offline (bool, optional): Never touch the network; tiles missing
+            from the cache come back empty. Implies ``enabled``.
+            Defaults to False.
+        cache_dir (str, optional): Cache directory. Defaults to the shared
+            tile cache directory.
+        max_bytes (int, optional): Disk cap. Defaults to
+            `BASEMAP_CACHE_BYTES`.
+    """
+    global _CACHE
+    _SETTINGS["enabled"] = enabled or offline
+    _SETTINGS["offline"] = offline
+    if cache_dir or max_bytes:
+        _CACHE = TileCache(cache_dir, max_bytes=max_bytes or BASEMAP_CACHE_BYTES)
+
+
+def _extension(template):
+    ext = os.path.splitext(template.split("?", 1)[0])[1].lstrip(".").lower()
+    return ext if ext in ("png", "jpg", "jpeg", "webp") else "png"
+
+
+def coalesce(fetch):
+    """Share one ``fetch`` call among concurrent callers with equal arguments.
+
+    While a call is in flight, other threads asking for the same arguments
+    wait for its result (or exception) instead of issuing a duplicate
+    request, e.g. when the browser asks for a tile again before the first
+    download finished.
+
+    Args:
+        fetch (callable): Function of hashable positional arguments.
+
+    Returns:
+        callable: The wrapped function.
+    """
+    lock = threading.Lock()
+    pending = {}
+
+    def wrapper(*args):
+        with lock:
+            future = pending.get(args)
+            owner = future is None
+            if owner:
+                future = pending[args] = Future()
+        if not owner:
+            return future.result()
+        try:
+            result = fetch(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with lock:
+                pending.pop(args, None)
+
+    return wrapper
+
+
+def proxy_url(template, cache=None, offline=None):
+    """Serve a remote XYZ template through the local caching proxy.
+
+    Args:
+        template (str): Remote url template, e.g.
+            ``https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png``.
+        cache (TileCache, optional): Cache to use. Defaults to
+            `get_basemap_cache`.
+        offline (bool, optional): Serve only cached tiles. Defaults to the
+            `proxy_tiles` setting at request time.
+
+    Returns:
+        str: A local url template for the same tiles.
+    """
+
+    def provider(z, x, y):
+        c = cache if cache is not None else get_basemap_cache()
+        off = _SETTINGS["offline"] if offline is None else offline
+        if off:
+            return c.get(tile_key("xyz", template, z, x, y))
+        try:
+            return get_tile("xyz", template, z, x, y, cache=c)
+        except requests.RequestException:
+            return None
+
+    key = "xyz-" + hashlib.sha1(template.encode("utf-8")).hexdigest()[:12]
+    return TileServer.get().register(
+        coalesce(provider), key=key, ext=_extension(template)
+    )
+
+
+def tile_url(template, proxy=None):
+    """The url a layer should use for a remote XYZ template.
+
+    Args:
+        template (str): Remote url template.
+        proxy (bool, optional): Force the proxy on or off. Defaults to the
+            `proxy_tiles` setting.
+
+    Returns:
+        str: ``template`` itself, or its proxied url.
+    """
+    proxy = _SETTINGS["enabled"] if proxy is None else proxy
+    if not proxy or not template.startswith(("http://", "https://")):
+        return template
+    if template.startswith(TileServer.get().base_url):
+        return template
+    return proxy_url(template)
+
+
+def seed_tiles(
+    template, bounds, zooms, cache=None, workers=8, max_tiles=50000, timeout=10
+):
+    """Download the tiles of a bounding box into the cache.
+
+    Args:
+        template (str): Remote url template.
+        bounds (tuple): ((south, west), (north, east)).
+        zooms (iterable): Zoom levels to seed.
+        cache (TileCache, optional): Cache to fill. Defaults to
+            `get_basemap_cache`.
+        workers (int, optional): Parallel downloads. Defaults to 8.
+        max_tiles (int, optional): Refuse to seed more tiles than this.
+            Defaults to 50000.
+        timeout (float, optional): Per-request timeout. Defaults to 10.
+
+    Returns:
+        dict: Counts of ``tiles``, ``downloaded``, ``cached`` (already
+        present), ``empty`` and ``failed``.
+    """
+    cache = cache if cache is not None else get_basemap_cache()
+    jobs = [(z, x, y) for z in zooms for x, y in tiles_in_bounds(bounds, z)]
+    if len(jobs) > max_tiles:
+        raise ValueError(
+            f"Seeding would download {len(jobs)} tiles (max_tiles={max_tiles}); "
+            "reduce the area or zoom range."
+        )
+
+    def _seed(job):
+        key = tile_key("xyz", template, *job)
+        if key in cache:
+            return "cached"
+        try:
+            data = fetch_xyz_tile(template, *job, timeout=timeout)
+        except requests.RequestException:
+            return "failed"
+        if data is None:
+            return "empty"
+        cache.put(key, data)
+        return "downloaded"
+
+    stats = dict.fromkeys(("downloaded", "cached", "empty", "failed"), 0)
+    stats["tiles"] = len(jobs)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for result in pool.map(_seed, jobs):
+            stats[result] += 1
+    return stats
+
+
+def seed_story(
+    story,
+    basemap="OpenStreetMap.Mapnik",
+    zoom_margin=1,
+    width=1280,
+    height=720,
+    cache=None,
+    **kwargs,
+):
+    """Pre-download the basemap and tile layers for every scene of a story.
+
+    For each scene, the viewport at the scene's center is seeded from one
+    level below to ``zoom_margin`` levels above its zoom.
+
+    Args:
+        story (maeson.gistory.Story): The story.
+        basemap (str, optional): Basemap name or template used for scenes
+            without their own ``basemap``. Defaults to OpenStreetMap.
+        zoom_margin (int, optional): Extra zoom levels to seed above each
+            scene. Defaults to 1.
+        width (int, optional): Viewport width in pixels. Defaults to 1280.
+        height (int, optional): Viewport height in pixels. Defaults to 720.
+        cache (TileCache, optional): Cache to fill. Defaults to
+            `get_basemap_cache`.
+        **kwargs: Passed to `seed_tiles`.
+
+    Returns:
+        dict: Summed `seed_tiles` counts.
+    """
+    from .basemaps import basemap_url
+
+    totals = {}
+    for scene in story.scenes:
+        bounds = viewport_bounds(scene.center, scene.zoom, width, height)
+        lo = max(0, math.floor(scene.zoom) - 1)
+        zooms = range(lo, min(22, math.ceil(scene.zoom) + zoom_margin) + 1)
+        templates = [basemap_url(scene.basemap or basemap)]
+        templates += [
+            ld.get("url") or ld.get("path")
+            for ld in scene.layers
+            if ld.get("type") == "tile"
+        ]
+        for template in filter(None, templates):
+            result = seed_tiles(template, bounds, zooms, cache=cache, **kwargs)
+            for k, v in result.items():
+                totals[k] = totals.get(k, 0) + v
+    return totals
@@ -0,0 +1,1104 @@
+"""Raster preparation and mosaicking helpers used by `maeson.Map`."""
+
+import ast
+import collections
+import contextlib
+import functools
+import glob
+import hashlib
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .common import TILE_SIZE, get_cache_dir, pixel_to_lonlat
+from .tiles import (
+    cached_provider,
+    get_tile_cache,
+    raster_render_params,
+    render_image,
+    source_stamp,
+)
+
+# Lazily created pool and in-flight conversions, keyed by cache path.
+_EXECUTOR = None
+_PENDING = {}
+
+# Files smaller than this are served as they are (see `optimized_path`).
+OPTIMIZE_MIN_BYTES = 8 * 2**20
+
+# Idle open rasterio datasets by path, least recently used first, shared by
+# the tile-server threads (see `_dataset`).
+_DATASETS = collections.OrderedDict()
+_DATASETS_LOCK = threading.Lock()
+MAX_IDLE_DATASETS = 32
+
+# Functions allowed in band-math expressions (masked-array aware).
+EXPRESSION_FUNCTIONS = (
+    "abs",
+    "clip",
+    "exp",
+    "log",
+    "log10",
+    "maximum",
+    "minimum",
+    "sqrt",
+    "where",
+)
+_BAND_NAME = re.compile(r"^b([1-9][0-9]*)$")
+_EXPRESSION_NODES = (
+    ast.Expression,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.Compare,
+    ast.Call,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Pow,
+    ast.USub,
+    ast.UAdd,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+)
+
+
+def needs_optimization(path, min_size=512):
+    """Check whether a raster would tile slowly from a tile server.
+
+    A raster needs optimizing if it is larger than ``min_size`` pixels on a
+    side and is either stored in strips (not internally tiled) or has no
+    overviews.
+
+    Args:
+        path (str): Local raster path.
+        min_size (int, optional): Rasters at most this many pixels on each
+            side are always fine. Defaults to 512.
+
+    Returns:
+        bool: True if converting to a COG would help.
+    """
+    import rasterio
+
+    with rasterio.open(path) as src:
+        if max(src.width, src.height) <= min_size:
+            return False
+        block_h, block_w = src.block_shapes[0]
+        striped = block_w >= src.width and src.width > min_size
+        return striped or not src.overviews(1)
+
+
+def cog_cache_path(path):
+    """Location of the cached COG for ``path``.
+
+    The name depends on the absolute path, size and modification time, so an
+    edited source gets a fresh conversion.
+    """
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}"
+    digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+    return os.path.join(get_cache_dir("cog"), f"{digest}.tif")
+
+
+def optimize_raster(path, dst=None, blocksize=512, compress="DEFLATE"):
+    """Convert a raster to an internally tiled Cloud-Optimized GeoTIFF.
+
+    Uses GDAL's COG driver, which writes tiles and overviews in one pass.
+
+    Args:
+        path (str): Source raster.
+        dst (str, optional): Output path. Defaults to `cog_cache_path`.
+        blocksize (int, optional): Internal tile size. Defaults to 512.
+        compress (str, optional): Compression. Defaults to "DEFLATE".
+
+    Returns:
+        str: The output path.
+    """
+    import rasterio.shutil
+
+    dst = dst or cog_cache_path(path)
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp.tif"
+    try:
+        rasterio.shutil.copy(
+            path,
+            tmp,
+            driver="COG",
+            BLOCKSIZE=blocksize,
+            COMPRESS=compress,
+            OVERVIEWS="AUTO",
+            BIGTIFF="IF_SAFER",
+        )
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return dst
+
+
+def _executor():
+    global _EXECUTOR
+    if _EXECUTOR is None:
+        _EXECUTOR = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2))
+    return _EXECUTOR
+
+
+def optimized_path(path, background=False, min_bytes=OPTIMIZE_MIN_BYTES):
+    """Return the best path to serve ``path`` from, converting it if needed.
+
+    Remote rasters are returned unchanged.  If a cached COG exists it is
+    returned.  Files smaller than ``min_bytes`` and rasters that are already
+    tiled with overviews are returned unchanged.  Otherwise the conversion
+    runs either synchronously, or (``background=True``) in a process pool
+    while the original path is returned for this call; later calls pick up
+    the cached COG.
+
+    Args:
+        path (str): Raster path.
+        background (bool, optional): Convert in the background. Defaults
+            to False.
+        min_bytes (int, optional): Smaller files are cheap enough to tile
+            as they are. Defaults to `OPTIMIZE_MIN_BYTES` (8 MiB).
+
+    Returns:
+        str: Path to use for tiling.
+    """
+    if not os.path.isfile(path):
+        return path
+    cached = cog_cache_path(path)
+    if os.path.exists(cached):
+        return cached
+    if os.path.getsize(path) < min_bytes:
+        return path
+    try:
+        if not needs_optimization(path):
+            return path
+    except Exception:
+        return path
+
+    if not background:
+        return optimize_raster(path, cached)
+
+    future = _PENDING.get(cached)
+    if future is None or (future.done() and future.exception() is not None):
+        future = _executor().submit(optimize_raster, path, cached)
+        _PENDING[cached] = future
+        future.add_done_callback(lambda _: _PENDING.pop(cached, None))
+    return path
+
+
+@contextlib.contextmanager
+def _dataset(path):
+    """Borrow an open rasterio dataset for ``path``.
+
+    The tile server runs each request in a new thread, so datasets are kept
+    in a pool rather than per thread.  A dataset is never used by two
+    threads at once: each caller gets one to itself and returns it when
+    done.  At most `MAX_IDLE_DATASETS` stay open; the least recently used
+    are closed first.
+    """
+    import rasterio
+
+    with _DATASETS_LOCK:
+        idle = _DATASETS.get(path)
+        ds = idle.pop() if idle else None
+    if ds is None or ds.closed:
+        ds = rasterio.open(path)
+    try:
+        yield ds
+    finally:
+        _release_dataset(path, ds)
+
+
+def _release_dataset(path, ds):
+    if ds.closed:
+        return
+    evicted = []
+    with _DATASETS_LOCK:
+        _DATASETS.setdefault(path, []).append(ds)
+        _DATASETS.move_to_end(path)
+        count = sum(len(idle) for idle in _DATASETS.values())
+        while count > MAX_IDLE_DATASETS:
+            oldest = next(iter(_DATASETS))
+            idle = _DATASETS[oldest]
+            if idle:
+                evicted.append(idle.pop(0))
+                count -= 1
+            if not idle:
+                del _DATASETS[oldest]
+    for old in evicted:
+        old.close()
+
+
+def read_tile(path, z, x, y, indexes=None, tile_size=TILE_SIZE):
+    """Read one XYZ tile of a raster with a windowed read.
+
+    Open datasets are reused across tiles (see `_dataset`).
+
+    Returns:
+        rio_tiler.models.ImageData or None: The tile, or None if it lies
+        outside the raster.
+    """
+    from rio_tiler.errors import TileOutsideBounds
+    from rio_tiler.io import Reader
+
+    with _dataset(path) as ds, Reader(path, dataset=ds) as src:
+        try:
+            return src.tile(x, y, z, tilesize=tile_size, indexes=indexes)
+        except TileOutsideBounds:
+            return None
+
+
+def lonlat_bounds(path):
+    """Bounds of a raster as (west, south, east, north) in EPSG:4326."""
+    from rasterio.warp import transform_bounds
+
+    with _dataset(path) as src:
+        return transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+
+
+def shared_range(paths):
+    """Union of the 2–98 percentile ranges of several rasters.
+
+    Returns:
+        tuple: ``(lo, hi)``, or ``()`` when the rasters need no stretching.
+    """
+    ranges = [raster_render_params(p)[1] for p in paths]
+    ranges = [r[0] for r in ranges if r]
+    if not ranges:
+        return ()
+    return min(r[0] for r in ranges), max(r[1] for r in ranges)
+
+
+@functools.lru_cache(maxsize=128)
+def parse_expression(expression):
+    """Validate and compile a band-math expression.
+
+    Bands are named ``b1``, ``b2``, ... (1-based); expressions may use
+    numbers, ``+ - * / **``, comparisons and the functions in
+    `EXPRESSION_FUNCTIONS`, e.g. ``"(b4 - b3) / (b4 + b3)"``.
+
+    Args:
+        expression (str): The expression.
+
+    Returns:
+        tuple: ``(code, bands)`` where ``bands`` are the band indexes used,
+        sorted.
+
+    Raises:
+        ValueError: If the expression is not valid band math.
+    """
+    try:
+        tree = ast.parse(expression, mode="eval")
+    except SyntaxError as e:
+        raise ValueError(f"Invalid band-math expression {expression!r}: {e}")
+    bands = set()
+    for node in ast.walk(tree):
+        if not isinstance(node, _EXPRESSION_NODES):
+            raise ValueError(
+                f"Unsupported syntax in band-math expression: {type(node).__name__}"
+            )
+        if isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"Unsupported constant in band math: {node.value!r}")
+        if isinstance(node, ast.Call):
+            if not (
+                isinstance(node.func, ast.Name)
+                and node.func.id in EXPRESSION_FUNCTIONS
+                and not node.keywords
+            ):
+                raise ValueError("Band math only allows calls to EXPRESSION_FUNCTIONS.")
+        elif isinstance(node, ast.Name) and node.id not in EXPRESSION_FUNCTIONS:
+            match = _BAND_NAME.match(node.id)
+            if not match:
+                raise ValueError(f"Unknown name in band-math expression: {node.id}")
+            bands.add(int(match.group(1)))
+    if not bands:
+        raise ValueError("A band-math expression must use at least one band.")
+    return compile(tree, "<band math>", "eval"), tuple(sorted(bands))
+
+
+def evaluate_expression(expression, data, bands):
+    """Evaluate a band-math expression on a stack of bands.
+
+    Args:
+        expression (str): The expression (see `parse_expression`).
+        data (numpy.ndarray): ``(len(bands), h, w)`` array, masked or not.
+        bands (tuple): Band index of each layer of ``data``.
+
+    Returns:
+        numpy.ma.MaskedArray: ``(h, w)`` float result; pixels that are
+        masked in any input or not finite are masked.
+    """
+    import numpy as np
+
+    code, _ = parse_expression(expression)
+    data = np.ma.asarray(data, dtype="float64")
+    namespace = {name: getattr(np.ma, name) for name in EXPRESSION_FUNCTIONS}
+    namespace.update({f"b{b}": data[i] for i, b in enumerate(bands)})
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        result = eval(code, {"__builtins__": {}}, namespace)
+    result = np.ma.asarray(result, dtype="float64")
+    mask = np.broadcast_to(np.ma.getmaskarray(result), data.shape[1:])
+    values = np.broadcast_to(result.filled(np.nan), data.shape[1:])
+    return np.ma.masked_invalid(np.ma.masked_array(values, mask=mask))
+
+
+class BandMath:
+    """A raster layer derived per tile from an expression over its bands.
+
+    Tiles are computed from windowed reads of only the bands the
+    expression uses, evaluated with vectorized NumPy, and cached per tile
+    and expression in the shared `maeson.tiles.get_tile_cache`, so indices
+    like NDVI can be browsed without writing intermediate files.
+
+    Args:
+        path (str): Multiband raster path or URL.
+        expression (str): Band-math expression, e.g. ``"(b4-b3)/(b4+b3)"``.
+        colormap (str or dict, optional): Colormap for the result. Defaults
+            to "viridis".
+        rescale (tuple, optional): ``(lo, hi)`` display range. Defaults to
+            the 2–98 percentile range of the result on an overview.
+    """
+
+    # shared instances by (path, file stamp, expression, colormap), see `get`
+    _instances = collections.OrderedDict()
+    _instances_lock = threading.Lock()
+    max_instances = 32
+
+    def __init__(self, path, expression, colormap="viridis", rescale=None):
+        self.path = path
+        self.expression = expression
+        self.code, self.bands = parse_expression(expression)
+        with _dataset(path) as src:
+            count = src.count
+        if max(self.bands) > count:
+            raise ValueError(
+                f"Expression uses b{max(self.bands)} but {path} has {count} bands."
+            )
+        self.colormap = colormap
+        self._rescale = rescale
+        key = (
+            path,
+            source_stamp(path),
+            repr(colormap),
+            expression,
+            rescale and tuple(rescale),
+        )
+        self._provider = cached_provider(self.render, key)
+
+    @classmethod
+    def get(cls, path, expression, colormap="viridis"):
+        """Return the shared instance for a raster and expression.
+
+        Callers that render tiles one at a time use it so the display range
+        is estimated once, not on every tile.  At most `max_instances` are
+        kept, least recently used dropped first.
+        """
+        key = (path, source_stamp(path), expression, repr(colormap))
+        with cls._instances_lock:
+            band_math = cls._instances.get(key)
+            if band_math is not None:
+                cls._instances.move_to_end(key)
+                return band_math
+        band_math = cls(path, expression, colormap=colormap)
+        with cls._instances_lock:
+            band_math = cls._instances.setdefault(key, band_math)
+            while len(cls._instances) > cls.max_instances:
+                cls._instances.popitem(last=False)
+        return band_math
+
+    @property
+    def rescale(self):
+        """Display range, estimated from a small overview on first use."""
+        if self._rescale is None:
+            import numpy as np
+
+            with _dataset(self.path) as src:
+                scale = max(1, max(src.width, src.height) / 512)
+                out_shape = (
+                    len(self.bands),
+                    max(1, int(src.height / scale)),
+                    max(1, int(src.width / scale)),
+                )
+                data = src.read(self.bands, out_shape=out_shape, masked=True)
+            valid = evaluate_expression(self.expression, data, self.bands).compressed()
+            lo, hi = np.percentile(valid, (2, 98)) if valid.size else (0, 1)
+            self._rescale = (float(lo), float(hi) if hi > lo else float(lo) + 1)
+        return self._rescale
+
+    def read_tile(self, z, x, y, tile_size=TILE_SIZE):
+        """The expression result for a tile as a single-band ImageData."""
+        from rio_tiler.models import ImageData
+
+        img = read_tile(self.path, z, x, y, self.bands, tile_size)
+        if img is None:
+            return None
+        result = evaluate_expression(self.expression, img.array, self.bands)
+        return ImageData(result[None], bounds=img.bounds, crs=img.crs)
+
+    def tile(self, z, x, y):
+        """Rendered PNG for a tile, or None outside the raster."""
+        return self._provider(z, x, y)
+
+    def render(self, z, x, y):
+        """Render a tile without the cache."""
+        img = self.read_tile(z, x, y)
+        if img is None:
+            return None
+        return render_image(img, (self.rescale,), self.colormap)
+
+
+def _expand_sources(sources):
+    if isinstance(sources, str):
+        sources = sorted(glob.glob(sources))
+    return list(sources)
+
+
+class RasterMosaic:
+    """Many adjacent rasters served as one tiled layer.
+
+    A footprint index (an R-tree over the sources' lon/lat bounds) picks the
+    rasters that intersect each requested tile; only those are read, with
+    windowed reads at the tile's resolution, and composited first-valid-pixel
+    wins in source order.  Rendered tiles are kept in the shared tile cache
+    (see `maeson.tiles.get_tile_cache`).
+
+    Args:
+        sources (list or str): Raster paths/URLs, or a glob pattern.
+        colormap (str or dict, optional): Colormap for single-band mosaics.
+            Defaults to "greys".
+        rescale (tuple, optional): ``(lo, hi)`` display range. Defaults to
+            the union of the sources' 2–98 percentile ranges.
+        cache (optional): Tile cache with ``get``/``put``. Defaults to
+            `maeson.tiles.get_tile_cache`.
+    """
+
+    def __init__(self, sources, colormap="greys", rescale=None, cache=None):
+        from .spatial import LayerIndex
+
+        self.sources = _expand_sources(sources)
+        if not self.sources:
+            raise ValueError("RasterMosaic needs at least one source raster.")
+        self.colormap = colormap
+        self.cache = cache
+        digest = hashlib.sha1("\n".join(self.sources).encode("utf-8")).hexdigest()
+        self._source_key = f"mosaic:{digest[:16]}"
+
+        features = []
+        for path in self.sources:
+            w, s, e, n = lonlat_bounds(path)
+            ring = [[w, s], [e, s], [e, n], [w, n], [w, s]]
+            features.append(
+                {
+                    "type": "Feature",
+                    "properties": {"path": path},
+                    "geometry": {"type": "Polygon", "coordinates": [ring]},
+                }
+            )
+        self.footprints = {"type": "FeatureCollection", "features": features}
+        self.index = LayerIndex(self.footprints)
+
+        self.indexes = raster_render_params(self.sources[0])[0]
+        self._rescale = rescale
+
+    @property
+    def bounds(self):
+        """Union of the footprints as ((south, west), (north, east))."""
+        return self.index.bounds
+
+    @property
+    def rescale(self):
+        """Display range shared by every tile, so there are no seams."""
+        if self._rescale is None:
+            self._rescale = shared_range(self.sources)
+        return self._rescale
+
+    def sources_for_tile(self, z, x, y):
+        """Paths of the sources whose footprint intersects a tile."""
+        west, north = pixel_to_lonlat(x * TILE_SIZE, y * TILE_SIZE, z)
+        east, south = pixel_to_lonlat((x + 1) * TILE_SIZE, (y + 1) * TILE_SIZE, z)
+        hits = self.index.query(((south, west), (north, east)))
+        return [self.sources[i] for i in hits]
+
+    def read_tile(self, z, x, y, tile_size=TILE_SIZE):
+        """Composite the raw data of a tile.
+
+        Returns:
+            rio_tiler.models.ImageData or None: The composited tile, or None
+            if no source covers it.
+        """
+        import numpy as np
+        from rio_tiler.models import ImageData
+
+        out = None
+        for path in self.sources_for_tile(z, x, y):
+            img = read_tile(path, z, x, y, self.indexes, tile_size)
+            if img is None:
+                continue
+            data = img.array
+            if out is None:
+                out = img
+                filled = data
+            else:
+                fill = np.ma.getmaskarray(filled) & ~np.ma.getmaskarray(data)
+                filled = filled.copy()
+                filled[fill] = data[fill]
+            if not np.ma.getmaskarray(filled).any():
+                break
+        if out is None:
+            return None
+        return ImageData(filled, bounds=out.bounds, crs=out.crs)
+
+    def tile(self, z, x, y):
+        """Rendered PNG for a tile, or None outside the mosaic."""
+        cache = self.cache if self.cache is not None else get_tile_cache()
+        key = (self._source_key, z, x, y, repr(self.colormap), self.rescale)
+        data = cache.get(key)
+        if data is None:
+            img = self.read_tile(z, x, y)
+            data = b""
+            if img is not None:
+                data = render_image(
+                    img, self.rescale and (self.rescale,), self.colormap
+                )
+            cache.put(key, data)
+        return data or None
+
+
+class RasterStack:
+    """A time series of rasters served as one layer with switchable frames.
+
+    Every frame shares one tile server, one display range (so frames are
+    comparable) and one metadata cache; rendered tiles go to the shared tile
+    cache (see `maeson.tiles.get_tile_cache`).  When a tile of a
+    frame is requested, the same tile of the neighboring frames is rendered
+    in the background, so stepping through the series hits a warm cache.
+
+    Args:
+        sources (list or str): Raster paths/URLs in time order, or a glob
+            pattern (sorted by name).
+        labels (list, optional): A label per frame, e.g. dates. Defaults to
+            the file names.
+        colormap (str or dict, optional): Colormap for single-band rasters.
+            Defaults to "greys".
+        rescale (tuple, optional): ``(lo, hi)`` display range. Defaults to
+            the union of the frames' 2–98 percentile ranges.
+        cache (optional): Tile cache with ``get``/``put``. Defaults to
+            `maeson.tiles.get_tile_cache`.
+        prefetch (int, optional): Number of frames on each side of a
+            requested one to prefetch. Defaults to 1.
+    """
+
+    # shared stacks by (sources, file stamps, labels, colormap), see `get`
+    _instances = collections.OrderedDict()
+    _instances_lock = threading.Lock()
+    max_instances = 16
+
+    def __init__(
+        self,
+        sources,
+        labels=None,
+        colormap="greys",
+        rescale=None,
+        cache=None,
+        prefetch=1,
+    ):
+        from .spatial import union_bounds
+
+        self.sources = _expand_sources(sources)
+        if not self.sources:
+            raise ValueError("RasterStack needs at least one source raster.")
+        self.labels = (
+            list(labels)
+            if labels
+            else [os.path.splitext(os.path.basename(p))[0] for p in self.sources]
+        )
+        if len(self.labels) != len(self.sources):
+            raise ValueError("RasterStack needs one label per source.")
+        self.colormap = colormap
+        self.cache = cache
+        self.prefetch = prefetch
+        self.frame = 0
+        self.urls = []
+        self.indexes = raster_render_params(self.sources[0])[0]
+        self._rescale = rescale
+        self._pending = set()
+        self._lock = threading.Lock()
+        # threads are only started once something is submitted
+        self._pool = ThreadPoolExecutor(max_workers=2)
+
+        boxes = []
+        for path in self.sources:
+            w, s, e, n = lonlat_bounds(path)
+            boxes.append(((s, w), (n, e)))
+        self.bounds = union_bounds(boxes)
+
+    @classmethod
+    def get(cls, sources, labels=None, colormap="greys"):
+        """Return the shared stack for ``sources``, creating it on first use.
+
+        At most `max_instances` stacks are kept, least recently used dropped
+        first.  Layers still showing a dropped stack keep working; its
+        prefetch threads exit once it is no longer referenced.
+        """
+        sources = _expand_sources(sources)
+        key = (
+            tuple(sources),
+            tuple(source_stamp(p) for p in sources),
+            tuple(labels or ()),
+            repr(colormap),
+        )
+        with cls._instances_lock:
+            stack = cls._instances.get(key)
+            if stack is not None:
+                cls._instances.move_to_end(key)
+                return stack
+        stack = cls(sources, labels, colormap)
+        with cls._instances_lock:
+            stack = cls._instances.setdefault(key, stack)
+            while len(cls._instances) > cls.max_instances:
+                cls._instances.popitem(last=False)
+        return stack
+
+    def __len__(self):
+        return len(self.sources)
+
+    @property
+    def rescale(self):
+        """Display range shared by every frame."""
+        if self._rescale is None:
+            self._rescale = shared_range(self.sources)
+        return self._rescale
+
+    def _cache(self):
+        return self.cache if self.cache is not None else get_tile_cache()
+
+    def cache_key(self, frame, z, x, y):
+        """Key of a frame's tile in the tile cache."""
+        return (
+            self.sources[frame],
+            z,
+            x,
+            y,
+            "stack",
+            source_stamp(self.sources[frame]),
+            repr(self.colormap),
+            self.rescale,
+        )
+
+    def render(self, frame, z, x, y):
+        """Rendered PNG for a tile of one frame, or None outside it."""
+        cache = self._cache()
+        key = self.cache_key(frame, z, x, y)
+        data = cache.get(key)
+        if data is None:
+            img = read_tile(self.sources[frame], z, x, y, self.indexes)
+            data = b""
+            if img is not None:
+                data = render_image(
+                    img, self.rescale and (self.rescale,), self.colormap
+                )
+            cache.put(key, data)
+        return data or None
+
+    def _prefetch(self, frame, z, x, y):
+        cache = self._cache()
+        for step in range(1, self.prefetch + 1):
+            for i in (frame + step, frame - step):
+                if not 0 <= i < len(self):
+                    continue
+                key = (i, z, x, y)
+                if self.cache_key(*key) in cache:
+                    continue
+                with self._lock:
+                    if key in self._pending:
+                        continue
+                    self._pending.add(key)
+                future = self._pool.submit(self.render, *key)
+                future.add_done_callback(lambda _, k=key: self._pending.discard(k))
+
+    def tile(self, frame, z, x, y):
+        """Like `render`, and queue the neighboring frames' tiles."""
+        data = self.render(frame, z, x, y)
+        if self.prefetch:
+            self._prefetch(frame, z, x, y)
+        return data
+
+    def register(self, server=None):
+        """Serve every frame and return the per-frame url templates.
+
+        Args:
+            server (maeson.tiles.TileServer, optional): Server to register
+                with. Defaults to the shared one.
+
+        Returns:
+            list: One XYZ url template per frame.
+        """
+        if not self.urls:
+            from .tiles import TileServer
+
+            server = server or TileServer.get()
+            key = uuid.uuid4().hex[:12]
+            self.urls = [
+                server.register(functools.partial(self.tile, i), key=f"{key}-{i}")
+                for i in range(len(self))
+            ]
+        return self.urls
+
+    @property
+    def url(self):
+        """Url template of the active frame."""
+        return self.register()[self.frame]
+
+
+def _render_tile_batch(args):
+    """Render and write a batch of static tiles (runs in a worker process).
+
+    Returns:
+        list: The ``"z/x/y"`` names of tiles that were empty.
+    """
+    path, directory, colormap, expression, params, tiles = args
+    if expression:
+        band_math = BandMath(path, expression, colormap=colormap, rescale=params)
+    else:
+        indexes, in_range = params
+    empty = []
+    for z, x, y in tiles:
+        if expression:
+            data = band_math.render(z, x, y)
+        else:
+            img = read_tile(path, z, x, y, indexes=indexes)
+            data = img and render_image(img, in_range, colormap)
+        dst = os.path.join(directory, str(z), str(x), f"{y}.png")
+        if not data:
+            empty.append(f"{z}/{x}/{y}")
+            if os.path.exists(dst):
+                os.remove(dst)
+            continue
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        tmp = f"{dst}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, dst)
+    return empty
+
+
+def export_xyz_tiles(
+    path,
+    directory,
+    zooms=None,
+    colormap="greys",
+    expression=None,
+    workers=None,
+    max_tiles=100000,
+    batch_size=64,
+):
+    """Pre-render a raster to a static ``{z}/{x}/{y}.png`` tile pyramid.
+
+    Local rasters are read through their cached COG (see `optimized_path`),
+    so low zooms come from overviews, and tiles are rendered in parallel
+    processes.  Re-exporting is incremental: a ``tiles.json`` manifest
+    records the source and rendering options, and while they are unchanged
+    existing (and known empty) tiles are skipped.
+
+    Args:
+        path (str): GeoTIFF path or URL.
+        directory (str): Output directory.
+        zooms (iterable, optional): Zoom levels. Defaults to the raster's
+            minimum to native zoom.
+        colormap (str, optional): Colormap for single-band rasters.
+            Defaults to "greys".
+        expression (str, optional): Band-math expression (see `BandMath`).
+        workers (int, optional): Processes. Defaults to the CPU count.
+        max_tiles (int, optional): Refuse to render more tiles than this.
+            Defaults to 100000.
+        batch_size (int, optional): Tiles per task. Defaults to 64.
+
+    Returns:
+        dict: ``zooms``, and counts of ``tiles``, ``rendered``, ``skipped``
+        and ``empty``.
+    """
+    import json
+
+    from rio_tiler.io import Reader
+
+    from .common import tiles_in_bounds
+
+    source = optimized_path(path, background=False)
+    with Reader(source) as src:
+        if zooms is None:
+            zooms = range(src.minzoom, src.maxzoom + 1)
+    zooms = list(zooms)
+    west, south, east, north = lonlat_bounds(source)
+    jobs = [
+        (z, x, y)
+        for z in zooms
+        for x, y in tiles_in_bounds(((south, west), (north, east)), z)
+    ]
+    if len(jobs) > max_tiles:
+        raise ValueError(
+            f"Exporting would render {len(jobs)} tiles (max_tiles={max_tiles}); "
+            "reduce the zoom range."
+        )
+
+    stat = os.stat(path) if os.path.isfile(path) else None
+    signature = {
+        "source": path,
+        "mtime": stat and stat.st_mtime,
+        "size": stat and stat.st_size,
+        "colormap": repr(colormap),
+        "expression": expression,
+    }
+    manifest_path = os.path.join(directory, "tiles.json")
+    empty = set()
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest.get("signature") == signature:
+            empty = set(manifest.get("empty", []))
+        else:
+            print(f"🔄 {path} or its options changed; re-rendering all tiles")
+            empty = None
+    todo = [
+        job
+        for job in jobs
+        if empty is None
+        or (
+            "/".join(map(str, job)) not in empty
+            and not os.path.exists(os.path.join(directory, *map(str, job)) + ".png")
+        )
+    ]
+    empty = empty or set()
+
+    if expression:
+        params = BandMath.get(source, expression, colormap=colormap).rescale
+    else:
+        params = raster_render_params(source)
+    batches = [
+        (source, directory, colormap, expression, params, todo[i : i + batch_size])
+        for i in range(0, len(todo), batch_size)
+    ]
+    if batches:
+        workers = min(workers or os.cpu_count() or 1, len(batches))
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for names in pool.map(_render_tile_batch, batches):
+                empty.update(names)
+
+    os.makedirs(directory, exist_ok=True)
+    with open(manifest_path, "w") as f:
+        json.dump({"signature": signature, "empty": sorted(empty)}, f)
+    new_empty = len(empty & {"/".join(map(str, job)) for job in todo})
+    return {
+        "zooms": zooms,
+        "tiles": len(jobs),
+        "rendered": len(todo) - new_empty,
+        "skipped": len(jobs) - len(todo),
+        "empty": len(empty),
+    }
+
+
+def _render_animation_frame(args):
+    """Render one frame of an animation to PNG (runs in a worker process).
+
+    The frame is a windowed read of the raster warped to Web Mercator at
+    the output size, so coarse frames come from overviews.
+
+    Returns:
+        bytes or None: PNG bytes, or None if the raster misses the bounds.
+    """
+    path, bbox, width, height, indexes, in_range, colormap, expression = args
+    from rio_tiler.errors import TileOutsideBounds
+    from rio_tiler.io import Reader
+    from rio_tiler.models import ImageData
+
+    bands = parse_expression(expression)[1] if expression else indexes
+    with _dataset(path) as ds, Reader(path, dataset=ds) as src:
+        try:
+            img = src.part(
+                bbox,
+                dst_crs="EPSG:3857",
+                bounds_crs="EPSG:4326",
+                indexes=bands,
+                width=width,
+                height=height,
+            )
+        except TileOutsideBounds:
+            return None
+    if expression:
+        result = evaluate_expression(expression, img.array, bands)
+        img = ImageData(result[None], bounds=img.bounds, crs=img.crs)
+    return render_image(img, in_range, colormap)
+
+
+def _animation_sources(sources):
+    """Frame paths of a stack, a glob, a list or a ``{time: path}`` dict."""
+    if isinstance(sources, RasterStack):
+        return list(sources.sources)
+    if isinstance(sources, dict):
+        return [p for _, p in sorted(sources.items())]
+    return _expand_sources(sources)
+
+
+def export_animation(
+    sources,
+    path=None,
+    format=None,
+    bounds=None,
+    zoom=None,
+    max_size=1024,
+    fps=2,
+    colormap="greys",
+    expression=None,
+    rescale=None,
+    workers=None,
+):
+    """Render a raster time series to an animated WebP, GIF or MP4.
+
+    Each frame is a windowed read of one raster over ``bounds`` at the
+    output resolution; local rasters are read through their cached COG (see
+    `optimized_path`), so only overview pixels are touched.  Frames render
+    in parallel processes and share one display range, so they are
+    comparable.  Outputs are cached by source files and options.
+
+    Args:
+        sources (list, str, dict or RasterStack): Raster paths/URLs in time
+            order, a glob pattern (sorted by name), a ``{time: path}`` dict
+            (sorted by time) or a `RasterStack`.
+        path (str, optional): Output file. Defaults to a file in the
+            maeson cache directory.
+        format (str, optional): "webp", "gif" or "mp4". Defaults to the
+            extension of ``path``, or "webp".
+        bounds (sequence, optional): ((south, west), (north, east)).
+            Defaults to the union of the rasters' bounds.
+        zoom (float, optional): Zoom the overlay is shown at; sets the
+            output size (see `maeson.video.overlay_size`). Defaults to the
+            zoom that fits ``bounds``.
+        max_size (int, optional): Cap on the longer side. Defaults to 1024.
+        fps (float, optional): Frames per second. Defaults to 2.
+        colormap (str or dict, optional): Colormap for single-band rasters
+            and expressions. Defaults to "greys".
+        expression (str, optional): Band-math expression rendered for every
+            frame (see `BandMath`).
+        rescale (tuple, optional): ``(lo, hi)`` display range. Defaults to
+            the union of the frames' 2–98 percentile ranges.
+        workers (int, optional): Processes. Defaults to the CPU count.
+
+    Returns:
+        tuple: (output path, ((south, west), (north, east))).
+    """
+    import io
+    import json
+    import subprocess
+
+    from PIL import Image
+
+    from .spatial import union_bounds
+    from .video import overlay_size
+
+    paths = _animation_sources(sources)
+    if not paths:
+        raise ValueError("export_animation needs at least one source raster.")
+    if isinstance(sources, RasterStack):
+        rescale = rescale or sources.rescale or None
+    paths = [optimized_path(p, background=False) for p in paths]
+    if bounds is None:
+        boxes = []
+        for p in paths:
+            w, s, e, n = lonlat_bounds(p)
+            boxes.append(((s, w), (n, e)))
+        bounds = union_bounds(boxes)
+    bounds = tuple(tuple(float(v) for v in c) for c in bounds)
+    width, height = overlay_size(bounds, zoom, max_size)
+    fmt = (format or os.path.splitext(path or "")[1].lstrip(".") or "webp").lower()
+    if fmt not in ("webp", "gif", "mp4"):
+        raise ValueError(f"Unsupported animation format: {fmt!r}")
+
+    if path is None:
+        stamps = [
+            (p, os.path.getmtime(p) if os.path.isfile(p) else None) for p in paths
+        ]
+        key = json.dumps(
+            [stamps, bounds, width, height, fps, repr(colormap), expression, rescale]
+        )
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+        path = os.path.join(get_cache_dir("animations"), f"{digest}.{fmt}")
+        if os.path.exists(path):
+            return path, bounds
+
+    indexes = raster_render_params(paths[0])[0]
+    if rescale is None:
+        if expression:
+            ranges = [BandMath.get(p, expression).rescale for p in paths]
+            rescale = min(r[0] for r in ranges), max(r[1] for r in ranges)
+        else:
+            rescale = shared_range(paths) or None
+    in_range = rescale and (tuple(rescale),)
+    (south, west), (north, east) = bounds
+    jobs = [
+        (p, (west, south, east, north), width, height, indexes, in_range)
+        + (colormap, expression)
+        for p in paths
+    ]
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pngs = list(pool.map(_render_animation_frame, jobs))
+
+    blank = Image.new("RGBA", (width, height))
+    frames = [
+        Image.open(io.BytesIO(png)).convert("RGBA") if png else blank for png in pngs
+    ]
+    tmp = f"{path}.{os.getpid()}.tmp.{fmt}"
+    try:
+        if fmt == "mp4":
+            from .render import _find_ffmpeg
+
+            cmd = [
+                _find_ffmpeg(),
+                "-y",
+                "-loglevel",
+                "error",
+                "-f",
+                "rawvideo",
+                "-pix_fmt",
+                "rgb24",
+                "-s",
+                f"{width}x{height}",
+                "-r",
+                str(fps),
+                "-i",
+                "-",
+                "-c:v",
+                "libx264",
+                "-pix_fmt",
+                "yuv420p",
+                "-movflags",
+                "+faststart",
+                tmp,
+            ]
+            frames_rgb = b"".join(f.convert("RGB").tobytes() for f in frames)
+            proc = subprocess.run(cmd, input=frames_rgb, capture_output=True)
+            if proc.returncode:
+                raise RuntimeError(
+                    f"ffmpeg failed: {proc.stderr.decode(errors='replace')}"
+                )
+        else:
+            options = {"disposal": 2} if fmt == "gif" else {"lossless": False}
+            frames[0].save(
+                tmp,
+                save_all=True,
+                append_images=frames[1:],
+                duration=int(1000 / fps),
+                loop=0,
+                **options,
+            )
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return path, bounds
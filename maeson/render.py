@@ -0,0 +1,619 @@
+"""Offline rendering of story scenes to still images.
+
+Scenes are composed from their layer definitions (the same dict schema that
+`maeson.gistory.StoryController` understands) without a browser: basemaps and
+``tile`` layers are fetched as XYZ tiles, ``raster`` layers are tiled locally
+with rio-tiler, and GeoJSON vectors are drawn with Pillow.  Tiles go through a
+shared on-disk `maeson.tiles.TileCache`, so scenes that overlap only fetch
+each tile once even when they are rendered in different processes.
+`export_video` builds on the same machinery to fly between scenes.
+"""
+
+import copy
+import io
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import requests
+
+from .basemaps import basemap_url
+from .common import TILE_SIZE, lonlat_to_pixel
+from .tiles import TileCache, get_tile
+
+DEFAULT_BASEMAP = "OpenStreetMap.Mapnik"
+DEFAULT_COLOR = "#3388ff"
+
+
+# ---------------------------------------------------------------------- #
+# Vector handling
+# ---------------------------------------------------------------------- #
+def read_geojson(path, kind=None):
+    """Read a vector file or url as a GeoJSON dict.
+
+    Args:
+        path (str): Path or url of a GeoJSON, FlatGeobuf or GeoParquet file.
+        kind (str, optional): The file's kind. Defaults to
+            `maeson.gistory.detect_layer_kind`. FlatGeobuf and GeoParquet
+            are read with geopandas and reprojected to EPSG:4326.
+
+    Returns:
+        dict: The GeoJSON data.
+    """
+    if kind is None:
+        from .gistory import detect_layer_kind
+
+        kind = detect_layer_kind(path)
+    if kind in ("flatgeobuf", "geoparquet"):
+        import geopandas as gpd
+
+        gdf = gpd.read_parquet(path) if kind == "geoparquet" else gpd.read_file(path)
+        if gdf.crs is not None:
+            gdf = gdf.to_crs("EPSG:4326")
+        return json.loads(gdf.to_json())
+    if path.startswith(("http://", "https://")):
+        resp = requests.get(path, timeout=30)
+        resp.raise_for_status()
+        return resp.json()
+    with open(path) as f:
+        return json.load(f)
+
+
+def _geojson_data(ld):
+    """Return the GeoJSON dict for a ``geojson`` layer definition."""
+    if "data" in ld:
+        return ld["data"]
+    return read_geojson(ld.get("path") or ld.get("url"), ld.get("kind"))
+
+
+def _iter_geometries(geojson):
+    if geojson.get("type") == "FeatureCollection":
+        for feat in geojson.get("features", []):
+            yield from _iter_geometries(feat)
+    elif geojson.get("type") == "Feature":
+        if geojson.get("geometry"):
+            yield from _iter_geometries(geojson["geometry"])
+    elif geojson.get("type") == "GeometryCollection":
+        for geom in geojson.get("geometries", []):
+            yield from _iter_geometries(geom)
+    else:
+        yield geojson
+
+
+def project_geojson(geojson):
+    """Project GeoJSON geometries to zoom-0 Web Mercator pixels once.
+
+    The result can be drawn at any center and zoom by `draw_vectors` without
+    touching the source coordinates again.
+
+    Args:
+        geojson (dict): A GeoJSON FeatureCollection, Feature or geometry.
+
+    Returns:
+        list: ``(kind, parts)`` tuples where ``kind`` is "point", "line" or
+        "polygon" and ``parts`` is a list of ``(N, 2)`` float arrays.
+    """
+    import numpy as np
+
+    def proj(coords):
+        arr = np.asarray(coords, dtype="float64").reshape(-1, 2)
+        lat = np.clip(arr[:, 1], -85.0511287798, 85.0511287798)
+        x = (arr[:, 0] + 180.0) / 360.0 * TILE_SIZE
+        s = np.sin(np.radians(lat))
+        y = (0.5 - np.log((1 + s) / (1 - s)) / (4 * math.pi)) * TILE_SIZE
+        return np.column_stack([x, y])
+
+    out = []
+    for geom in _iter_geometries(geojson):
+        t = geom.get("type")
+        c = geom.get("coordinates")
+        if not c:
+            continue
+        if t == "Point":
+            out.append(("point", [proj([c])]))
+        elif t == "MultiPoint":
+            out.append(("point", [proj(c)]))
+        elif t == "LineString":
+            out.append(("line", [proj(c)]))
+        elif t == "MultiLineString":
+            out.append(("line", [proj(part) for part in c]))
+        elif t == "Polygon":
+            out.append(("polygon", [proj(ring) for ring in c]))
+        elif t == "MultiPolygon":
+            for poly in c:
+                out.append(("polygon", [proj(ring) for ring in poly]))
+    return out
+
+
+def draw_vectors(image, projected, origin, zoom, color=DEFAULT_COLOR):
+    """Draw pre-projected geometries onto an RGBA image.
+
+    Args:
+        image (PIL.Image.Image): Target image (modified in place).
+        projected (list): Output of `project_geojson`.
+        origin (tuple): World pixel (x, y) of the image's top-left corner at
+            ``zoom``.
+        zoom (float): Zoom level the image is rendered at.
+        color (str, optional): Stroke/fill color. Defaults to Leaflet blue.
+    """
+    from PIL import Image, ImageColor, ImageDraw
+
+    rgb = ImageColor.getrgb(color)[:3]
+    overlay = Image.new("RGBA", image.size, (0, 0, 0, 0))
+    draw = ImageDraw.Draw(overlay)
+    scale = 2**zoom
+    ox, oy = origin
+    for kind, parts in projected:
+        pts = [[tuple(p) for p in part * scale - (ox, oy)] for part in parts]
+        if kind == "point":
+            for x, y in pts[0]:
+                draw.ellipse((x - 4, y - 4, x + 4, y + 4), fill=rgb + (255,))
+        elif kind == "line":
+            for line in pts:
+                if len(line) > 1:
+                    draw.line(line, fill=rgb + (255,), width=3)
+        elif kind == "polygon":
+            if len(pts[0]) > 2:
+                draw.polygon(pts[0], fill=rgb + (51,), outline=rgb + (255,))
+            for hole in pts[1:]:
+                if len(hole) > 2:
+                    draw.polygon(hole, fill=(0, 0, 0, 0))
+    image.alpha_composite(overlay)
+
+
+# ---------------------------------------------------------------------- #
+# Raster handling
+# ---------------------------------------------------------------------- #
+def _compose_tiles(canvas, kind, source, tz, origin, cache, **options):
+    """Paste every tile intersecting ``canvas`` at integer zoom ``tz``."""
+    from PIL import Image
+
+    ox, oy = origin
+    w, h = canvas.size
+    n = 2**tz
+    for ty in range(
+        math.floor(oy / TILE_SIZE), math.floor((oy + h - 1) / TILE_SIZE) + 1
+    ):
+        if ty < 0 or ty >= n:
+            continue
+        for tx in range(
+            math.floor(ox / TILE_SIZE), math.floor((ox + w - 1) / TILE_SIZE) + 1
+        ):
+            try:
+                data = get_tile(kind, source, tz, tx % n, ty, cache=cache, **options)
+            except Exception as e:
+                print(f"⚠️ Tile {tz}/{tx % n}/{ty} of {source} failed: {e}")
+                continue
+            if not data:
+                continue
+            tile = Image.open(io.BytesIO(data)).convert("RGBA")
+            pos = (int(round(tx * TILE_SIZE - ox)), int(round(ty * TILE_SIZE - oy)))
+            canvas.paste(tile, pos, tile)
+
+
+def _paste_image(canvas, ld, origin, zoom, cache):
+    """Stretch an ``image`` layer over its bounds."""
+    from PIL import Image
+
+    src = ld.get("path") or ld.get("url")
+    if src.startswith(("http://", "https://")):
+        data = cache.get(("image", src))
+        if data is None:
+            resp = requests.get(src, timeout=30)
+            resp.raise_for_status()
+            data = resp.content
+            cache.put(("image", src), data)
+        img = Image.open(io.BytesIO(data))
+    else:
+        img = Image.open(src)
+    (south, west), (north, east) = ld["bounds"]
+    x0, y0 = lonlat_to_pixel(west, north, zoom)
+    x1, y1 = lonlat_to_pixel(east, south, zoom)
+    size = (max(1, int(round(x1 - x0))), max(1, int(round(y1 - y0))))
+    img = img.convert("RGBA").resize(size)
+    pos = (int(round(x0 - origin[0])), int(round(y0 - origin[1])))
+    canvas.paste(img, pos, img)
+
+
+# ---------------------------------------------------------------------- #
+# Public API
+# ---------------------------------------------------------------------- #
+def render_view(
+    layers,
+    center,
+    zoom,
+    width=1024,
+    height=768,
+    basemap=DEFAULT_BASEMAP,
+    cache=None,
+    projected=None,
+):
+    """Render a list of layer definitions at a center and zoom.
+
+    Args:
+        layers (list): Layer definition dicts (``type``, ``path``/``url``,
+            ``data``, ``bounds`` ...).
+        center (tuple): (lat, lon) of the view.
+        zoom (float): Zoom level; fractional zooms are rendered from the
+            nearest tile level and resampled.
+        width (int, optional): Output width in pixels. Defaults to 1024.
+        height (int, optional): Output height in pixels. Defaults to 768.
+        basemap (str, optional): Basemap name or url template. None disables
+            the basemap. Defaults to OpenStreetMap.
+        cache (TileCache, optional): Tile cache. A default one is created if
+            omitted.
+        projected (dict, optional): Mapping of a layer's position in
+            ``layers`` to its `project_geojson` output. Missing entries are
+            filled in, so passing the same dict across calls projects each
+            vector layer only once.
+
+    Returns:
+        PIL.Image.Image: The rendered RGBA image.
+    """
+    from PIL import Image
+
+    cache = cache if cache is not None else TileCache()
+    projected = projected if projected is not None else {}
+
+    tz = int(max(0, min(round(zoom), 22)))
+    scale = 2 ** (zoom - tz)
+    cw, ch = int(math.ceil(width / scale)), int(math.ceil(height / scale))
+    cx, cy = lonlat_to_pixel(center[1], center[0], tz)
+    origin = (cx - cw / 2, cy - ch / 2)
+
+    canvas = Image.new("RGBA", (cw, ch), (255, 255, 255, 255))
+    url = basemap_url(basemap)
+    if url:
+        _compose_tiles(canvas, "xyz", url, tz, origin, cache)
+
+    vectors = []
+    for i, ld in enumerate(layers):
+        t = ld.get("type")
+        try:
+            if t == "tile":
+                _compose_tiles(
+                    canvas, "xyz", ld.get("url") or ld["path"], tz, origin, cache
+                )
+            elif t == "raster":
+                options = {"colormap": ld.get("colormap", "greys")}
+                if ld.get("expression"):
+                    options["expression"] = ld["expression"]
+                _compose_tiles(
+                    canvas, "raster", ld["path"], tz, origin, cache, **options
+                )
+            elif t == "stack":
+                from .raster import _expand_sources
+
+                _compose_tiles(
+                    canvas,
+                    "raster",
+                    _expand_sources(ld["paths"])[ld.get("frame", 0)],
+                    tz,
+                    origin,
+                    cache,
+                    colormap=ld.get("colormap", "greys"),
+                )
+            elif t == "image":
+                _paste_image(canvas, ld, origin, tz, cache)
+            elif t == "geojson":
+                if i not in projected:
+                    projected[i] = project_geojson(_geojson_data(ld))
+                vectors.append((projected[i], ld))
+            else:
+                print(f"Skipping unsupported layer type for rendering: {t}")
+        except Exception as e:
+            print(f"❌ Failed to render {t} layer “{ld.get('name')}”: {e}")
+
+    if scale != 1:
+        canvas = canvas.resize((int(round(cw * scale)), int(round(ch * scale))))
+        origin = (origin[0] * scale, origin[1] * scale)
+    canvas = canvas.crop((0, 0, width, height))
+
+    for geoms, ld in vectors:
+        color = (ld.get("style") or {}).get("color", DEFAULT_COLOR)
+        draw_vectors(canvas, geoms, origin, zoom, color=color)
+    return canvas
+
+
+def render_scene(scene, width=1024, height=768, basemap=DEFAULT_BASEMAP, cache=None):
+    """Render a `maeson.gistory.Scene` at its own center and zoom.
+
+    The scene's ``basemap`` is used when set, falling back to ``basemap``.
+
+    Returns:
+        PIL.Image.Image: The rendered RGBA image.
+    """
+    return render_view(
+        scene.layers,
+        scene.center,
+        scene.zoom,
+        width=width,
+        height=height,
+        basemap=getattr(scene, "basemap", None) or basemap,
+        cache=cache,
+    )
+
+
+def _story_scenes(story):
+    """Scenes of a story (or list) with "roi" layers resolved to GeoJSON."""
+    scenes = list(getattr(story, "scenes", story))
+    rois = getattr(story, "rois", None)
+    if rois is None:
+        return scenes
+    out = []
+    for scene in scenes:
+        if any(ld.get("type") == "roi" for ld in scene.layers):
+            scene = copy.copy(scene)
+            scene.layers = [
+                (
+                    {
+                        "type": "geojson",
+                        "name": ld.get("name"),
+                        "data": rois.to_geojson(ld["ids"]),
+                    }
+                    if ld.get("type") == "roi"
+                    else ld
+                )
+                for ld in scene.layers
+            ]
+        out.append(scene)
+    return out
+
+
+def _save_image(image, path, fmt):
+    if fmt.lower() in ("jpg", "jpeg"):
+        image = image.convert("RGB")
+    image.save(path, format="JPEG" if fmt.lower() == "jpg" else fmt.upper())
+
+
+def _render_scene_to_file(args):
+    scene, path, fmt, width, height, basemap, cache_dir = args
+    image = render_scene(
+        scene, width=width, height=height, basemap=basemap, cache=TileCache(cache_dir)
+    )
+    _save_image(image, path, fmt)
+    return path
+
+
+def render_story(
+    story,
+    out_dir,
+    fmt="png",
+    width=1024,
+    height=768,
+    basemap=DEFAULT_BASEMAP,
+    processes=None,
+    cache_dir=None,
+):
+    """Render every scene of a story to an image file.
+
+    Scenes are rendered in parallel with a process pool; tiles shared between
+    scenes are fetched once through a common on-disk cache.
+
+    Args:
+        story (Story or list): A `maeson.gistory.Story` or a list of scenes.
+        out_dir (str): Output directory (created if missing).
+        fmt (str, optional): Image format, e.g. "png" or "webp". Defaults to "png".
+        width (int, optional): Image width. Defaults to 1024.
+        height (int, optional): Image height. Defaults to 768.
+        basemap (str, optional): Fallback basemap for scenes without one.
+        processes (int, optional): Worker processes. Defaults to the CPU count;
+            use 1 to render in the current process.
+        cache_dir (str, optional): Tile cache directory.
+
+    Returns:
+        list: Paths of the written images, in scene order.
+    """
+    scenes = _story_scenes(story)
+    os.makedirs(out_dir, exist_ok=True)
+    cache_dir = TileCache(cache_dir).cache_dir
+    jobs = [
+        (
+            scene,
+            os.path.join(out_dir, f"scene_{i:04d}.{fmt.lower()}"),
+            fmt,
+            width,
+            height,
+            basemap,
+            cache_dir,
+        )
+        for i, scene in enumerate(scenes)
+    ]
+    if processes == 1 or len(jobs) <= 1:
+        return [_render_scene_to_file(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        return list(pool.map(_render_scene_to_file, jobs))
+
+
+# ---------------------------------------------------------------------- #
+# Video export
+# ---------------------------------------------------------------------- #
+def _smoothstep(t):
+    return t * t * (3 - 2 * t)
+
+
+def interpolate_views(scenes, fps=24, transition_seconds=2.0, hold_seconds=2.0):
+    """Yield one view per video frame, flying between consecutive scenes.
+
+    Centers are interpolated in Web Mercator space and zoom linearly, both
+    with an ease-in/ease-out curve.  During a transition the layers of the
+    scene being left are shown for the first half and those of the next
+    scene for the second half.
+
+    Args:
+        scenes (list): `maeson.gistory.Scene` objects in playback order.
+        fps (int, optional): Frames per second. Defaults to 24.
+        transition_seconds (float, optional): Flight time between scenes.
+        hold_seconds (float, optional): Time spent still on each scene.
+
+    Yields:
+        tuple: ``(scene_index, (lat, lon), zoom)`` for each frame.
+    """
+    from .common import pixel_to_lonlat
+
+    hold = max(1, int(round(hold_seconds * fps)))
+    steps = int(round(transition_seconds * fps))
+    for i, scene in enumerate(scenes):
+        for _ in range(hold):
+            yield i, tuple(scene.center), scene.zoom
+        if i + 1 >= len(scenes) or steps <= 0:
+            continue
+        nxt = scenes[i + 1]
+        x0, y0 = lonlat_to_pixel(scene.center[1], scene.center[0], 0)
+        x1, y1 = lonlat_to_pixel(nxt.center[1], nxt.center[0], 0)
+        for k in range(1, steps + 1):
+            t = _smoothstep(k / (steps + 1))
+            lon, lat = pixel_to_lonlat(x0 + (x1 - x0) * t, y0 + (y1 - y0) * t, 0)
+            zoom = scene.zoom + (nxt.zoom - scene.zoom) * t
+            yield (i if t < 0.5 else i + 1), (lat, lon), zoom
+
+
+def _find_ffmpeg():
+    import shutil
+
+    exe = shutil.which("ffmpeg")
+    if exe:
+        return exe
+    try:
+        import imageio_ffmpeg
+
+        return imageio_ffmpeg.get_ffmpeg_exe()
+    except ImportError:
+        raise RuntimeError(
+            "ffmpeg is required for video export. Install it on the PATH or "
+            "`pip install imageio-ffmpeg`."
+        )
+
+
+# Per-worker state for video frame rendering, set by _init_frame_worker.
+_FRAME_STATE = {}
+
+
+def _init_frame_worker(scenes, projected, width, height, basemap, cache_dir):
+    _FRAME_STATE.update(
+        scenes=scenes,
+        projected=projected,
+        width=width,
+        height=height,
+        basemap=basemap,
+        cache=TileCache(cache_dir),
+    )
+
+
+def _render_frame(view):
+    i, center, zoom = view
+    st = _FRAME_STATE
+    scene = st["scenes"][i]
+    image = render_view(
+        scene.layers,
+        center,
+        zoom,
+        width=st["width"],
+        height=st["height"],
+        basemap=getattr(scene, "basemap", None) or st["basemap"],
+        cache=st["cache"],
+        projected=st["projected"][i],
+    )
+    return image.convert("RGB").tobytes()
+
+
+def export_video(
+    story,
+    path,
+    fps=24,
+    transition_seconds=2.0,
+    hold_seconds=2.0,
+    width=1280,
+    height=720,
+    basemap=DEFAULT_BASEMAP,
+    processes=None,
+    cache_dir=None,
+    codec="libx264",
+):
+    """Export a story to a video, flying between scenes.
+
+    Frames are rendered across a process pool from a shared tile cache and
+    vector geometry that is projected once up front.  They are piped to
+    ffmpeg in order as they complete, with only a small window of frames in
+    flight, so the whole video is never held in memory.
+
+    Args:
+        story (Story or list): A `maeson.gistory.Story` or a list of scenes.
+        path (str): Output file, e.g. "story.mp4".
+        fps (int, optional): Frames per second. Defaults to 24.
+        transition_seconds (float, optional): Flight time between scenes.
+        hold_seconds (float, optional): Time spent still on each scene.
+        width (int, optional): Frame width. Defaults to 1280.
+        height (int, optional): Frame height. Defaults to 720.
+        basemap (str, optional): Fallback basemap for scenes without one.
+        processes (int, optional): Worker processes. Defaults to the CPU count.
+        cache_dir (str, optional): Tile cache directory.
+        codec (str, optional): ffmpeg video codec. Defaults to "libx264".
+
+    Returns:
+        str: ``path``.
+    """
+    import collections
+    import subprocess
+
+    scenes = _story_scenes(story)
+    cache_dir = TileCache(cache_dir).cache_dir
+    projected = []
+    for scene in scenes:
+        proj = {}
+        for i, ld in enumerate(scene.layers):
+            if ld.get("type") == "geojson":
+                try:
+                    proj[i] = project_geojson(_geojson_data(ld))
+                except Exception as e:
+                    print(f"❌ Failed to load {ld.get('name')}: {e}")
+                    proj[i] = []
+        projected.append(proj)
+
+    cmd = [
+        _find_ffmpeg(),
+        "-y",
+        "-loglevel",
+        "error",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-s",
+        f"{width}x{height}",
+        "-r",
+        str(fps),
+        "-i",
+        "-",
+        "-c:v",
+        codec,
+        "-pix_fmt",
+        "yuv420p",
+        path,
+    ]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    views = interpolate_views(scenes, fps, transition_seconds, hold_seconds)
+    pool = ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=_init_frame_worker,
+        initargs=(scenes, projected, width, height, basemap, cache_dir),
+    )
+    window = 2 * (processes or os.cpu_count() or 1)
+    pending = collections.deque()
+    try:
+        for view in views:
+            pending.append(pool.submit(_render_frame, view))
+            if len(pending) >= window:
+                proc.stdin.write(pending.popleft().result())
+        while pending:
+            proc.stdin.write(pending.popleft().result())
+    finally:
+        for fut in pending:
+            fut.cancel()
+        pool.shutdown()
+        proc.stdin.close()
+        proc.wait()
+    if proc.returncode:
+        raise RuntimeError(f"ffmpeg exited with status {proc.returncode}")
+    return path
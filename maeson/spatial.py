@@ -0,0 +1,284 @@
+"""Spatial indexing of GeoJSON layers for viewport queries.
+
+Each GeoJSON payload is indexed once with a Sort-Tile-Recursive R-tree
+(`shapely.STRtree`) over its feature bounding boxes.  The index answers
+viewport culling (which features intersect the map bounds plus a margin),
+union-bounds queries used for zoom-to-layer, and click hit-testing.
+`StoryIndex` keeps one index per layer across every scene of a
+`maeson.gistory.Story`, and `ViewportCuller` turns successive viewport
+queries into incremental added/removed feature sets as the map pans.
+"""
+
+import collections
+import json
+
+import numpy as np
+
+
+def _geometry_coords(geometry):
+    """Flatten the coordinates of a GeoJSON geometry into an (N, 2) array."""
+    if not geometry:
+        return np.empty((0, 2))
+    t = geometry.get("type")
+    if t == "GeometryCollection":
+        parts = [_geometry_coords(g) for g in geometry.get("geometries", [])]
+        return np.concatenate(parts) if parts else np.empty((0, 2))
+    flat = []
+
+    def _walk(c):
+        if len(c) and isinstance(c[0], (int, float)):
+            flat.append(c[:2])
+        else:
+            for sub in c:
+                _walk(sub)
+
+    _walk(geometry.get("coordinates", []))
+    return np.asarray(flat, dtype="float64").reshape(-1, 2)
+
+
+def feature_bounds(features):
+    """Bounding box of each GeoJSON feature.
+
+    Args:
+        features (list): GeoJSON Feature dicts.
+
+    Returns:
+        numpy.ndarray: ``(N, 4)`` array of ``minx, miny, maxx, maxy``
+        (lon/lat); rows of features without geometry are NaN.
+    """
+    out = np.full((len(features), 4), np.nan)
+    for i, feat in enumerate(features):
+        xy = _geometry_coords(feat.get("geometry"))
+        if len(xy):
+            out[i, :2] = xy.min(axis=0)
+            out[i, 2:] = xy.max(axis=0)
+    return out
+
+
+def _expand(bounds, margin):
+    """((south, west), (north, east)) -> (minx, miny, maxx, maxy) plus margin."""
+    (south, west), (north, east) = bounds
+    dx = (east - west) * margin
+    dy = (north - south) * margin
+    return west - dx, south - dy, east + dx, north + dy
+
+
+class LayerIndex:
+    """R-tree over the features of one GeoJSON payload.
+
+    Args:
+        geojson (dict): A FeatureCollection (or single Feature).
+    """
+
+    def __init__(self, geojson):
+        import shapely
+
+        if geojson.get("type") == "Feature":
+            self.features = [geojson]
+        else:
+            self.features = list(geojson.get("features", []))
+        self.feature_bounds = feature_bounds(self.features)
+        valid = ~np.isnan(self.feature_bounds).any(axis=1)
+        self._ids = np.flatnonzero(valid)
+        b = self.feature_bounds[valid]
+        self._tree = shapely.STRtree(shapely.box(b[:, 0], b[:, 1], b[:, 2], b[:, 3]))
+        self._geoms = {}
+        if len(b):
+            self._bounds = (
+                (float(b[:, 1].min()), float(b[:, 0].min())),
+                (float(b[:, 3].max()), float(b[:, 2].max())),
+            )
+        else:
+            self._bounds = None
+
+    def __len__(self):
+        return len(self.features)
+
+    @property
+    def bounds(self):
+        """Union bounds ((south, west), (north, east)), or None if empty."""
+        return self._bounds
+
+    def query(self, bounds, margin=0.0):
+        """Indices of features whose bounding box intersects ``bounds``.
+
+        Args:
+            bounds (tuple): ((south, west), (north, east)).
+            margin (float, optional): Extra margin as a fraction of the
+                bounds' width/height on every side. Defaults to 0.
+
+        Returns:
+            numpy.ndarray: Sorted feature indices.
+        """
+        import shapely
+
+        hits = self._tree.query(shapely.box(*_expand(bounds, margin)))
+        return np.sort(self._ids[hits])
+
+    def features_in(self, bounds, margin=0.0):
+        """The features returned by `query`."""
+        return [self.features[i] for i in self.query(bounds, margin)]
+
+    def _geometry(self, i):
+        if i not in self._geoms:
+            import shapely
+
+            self._geoms[i] = shapely.from_geojson(
+                json.dumps(self.features[i]["geometry"])
+            )
+        return self._geoms[i]
+
+    def hit_test(self, lat, lon, tolerance=0.0):
+        """Indices of features under a clicked point.
+
+        Args:
+            lat (float): Latitude of the click.
+            lon (float): Longitude of the click.
+            tolerance (float, optional): Search radius in degrees, so that
+                points and lines can be hit. Defaults to 0.
+
+        Returns:
+            list: Indices of the features hit, nearest first.
+        """
+        import shapely
+
+        pt = shapely.Point(lon, lat)
+        area = pt.buffer(tolerance) if tolerance else pt
+        hits = []
+        for j in self._tree.query(area):
+            i = int(self._ids[j])
+            d = shapely.distance(self._geometry(i), pt)
+            if d <= tolerance:
+                hits.append((d, i))
+        return [i for _, i in sorted(hits)]
+
+
+def union_bounds(bounds_list):
+    """Union of several ((south, west), (north, east)) bounds (None skipped)."""
+    bounds_list = [b for b in bounds_list if b]
+    if not bounds_list:
+        return None
+    return (
+        (min(b[0][0] for b in bounds_list), min(b[0][1] for b in bounds_list)),
+        (max(b[1][0] for b in bounds_list), max(b[1][1] for b in bounds_list)),
+    )
+
+
+class StoryIndex:
+    """Spatial indexes for the GeoJSON layers of every scene in a story.
+
+    Each distinct payload is indexed once: embedded ``data`` is keyed by
+    object identity (so scenes that share a layer definition share its
+    index) and file/URL layers by their path.  Indexes are built lazily on
+    first use.  At most ``max_layers`` indexes are kept, least recently used
+    dropped first, so the payloads of layers that are gone are not kept
+    alive for good.
+
+    Args:
+        story (maeson.gistory.Story, optional): Story whose scenes are
+            indexed. Without a story, use `index_geojson` directly.
+        max_layers (int, optional): Number of indexes kept. Defaults to 64.
+    """
+
+    def __init__(self, story=None, max_layers=64):
+        self.story = story
+        self.max_layers = max_layers
+        self._indexes = collections.OrderedDict()
+
+    def _cached(self, key, data=None, load=None):
+        """The index stored under ``key``, built from ``data`` or ``load()``."""
+        entry = self._indexes.get(key)
+        if entry is None or (data is not None and entry[0] is not data):
+            if data is None:
+                data = load()
+            # the payload is kept with its index so an ``id()`` key stays valid
+            entry = self._indexes[key] = (data, LayerIndex(data))
+            while len(self._indexes) > self.max_layers:
+                self._indexes.popitem(last=False)
+        self._indexes.move_to_end(key)
+        return entry[1]
+
+    def index_geojson(self, data):
+        """Return the (cached) `LayerIndex` for a GeoJSON payload."""
+        return self._cached(id(data), data)
+
+    def layer_index(self, ld):
+        """Return the `LayerIndex` for a layer definition, or None."""
+        t = ld.get("type")
+        if t == "roi" and self.story is not None:
+            ids = ld["ids"]
+            return self._cached(
+                ("roi", tuple(ids)), load=lambda: self.story.rois.to_geojson(ids)
+            )
+        if t != "geojson":
+            return None
+        if "data" in ld:
+            return self.index_geojson(ld["data"])
+        from .render import read_geojson
+
+        path = ld.get("path") or ld.get("url")
+        return self._cached(path, load=lambda: read_geojson(path, ld.get("kind")))
+
+    def _layers(self, scene=None):
+        scenes = [scene] if scene is not None else self.story.scenes
+        for sc in scenes:
+            for ld in sc.layers:
+                index = self.layer_index(ld)
+                if index is not None:
+                    yield ld, index
+
+    def bounds(self, scene=None):
+        """Union bounds of the indexed layers of ``scene`` (or all scenes)."""
+        return union_bounds(index.bounds for _, index in self._layers(scene))
+
+    def query(self, bounds, scene=None, margin=0.0):
+        """Visible feature indices per layer.
+
+        Returns:
+            list: ``(layer_def, indices)`` pairs for layers with hits.
+        """
+        out = []
+        for ld, index in self._layers(scene):
+            hits = index.query(bounds, margin)
+            if len(hits):
+                out.append((ld, hits))
+        return out
+
+    def hit_test(self, lat, lon, scene=None, tolerance=0.0):
+        """Features under a click as ``(layer_def, feature)`` pairs."""
+        return [
+            (ld, index.features[i])
+            for ld, index in self._layers(scene)
+            for i in index.hit_test(lat, lon, tolerance)
+        ]
+
+
+class ViewportCuller:
+    """Track the features of a `LayerIndex` visible in a moving viewport.
+
+    Args:
+        index (LayerIndex): The layer to cull.
+        margin (float, optional): Margin around the viewport, as a fraction
+            of its size, within which features count as visible.
+            Defaults to 0.25.
+    """
+
+    def __init__(self, index, margin=0.25):
+        self.index = index
+        self.margin = margin
+        self.visible = np.empty(0, dtype="int64")
+
+    def update(self, bounds):
+        """Move the viewport and return what changed.
+
+        Args:
+            bounds (tuple): New viewport ((south, west), (north, east)).
+
+        Returns:
+            tuple: ``(added, removed)`` arrays of feature indices.
+        """
+        now = self.index.query(bounds, self.margin)
+        added = np.setdiff1d(now, self.visible, assume_unique=True)
+        removed = np.setdiff1d(self.visible, now, assume_unique=True)
+        self.visible = now
+        return added, removed
@@ -0,0 +1,382 @@
+"""Static website export of stories, loaded scene by scene.
+
+`export_story_site` turns a `maeson.gistory.Story` into a folder that any
+static web server can host, without a kernel::
+
+    index.html            one folium map shell with the story player
+    manifest.json         scene titles, views, basemaps and payload urls
+    scenes/<hash>.json    the layers of one scene
+    assets/<name>-<hash>  GeoJSON sidecars, images, videos, rendered rasters
+
+A scene's payload is fetched when the reader navigates to it, and the next
+scene's payload and vector data are prefetched.  Payloads and assets are
+named by content hash, so data shared by several scenes is written and
+downloaded once.
+"""
+
+import hashlib
+import json
+import os
+
+from branca.element import Element, JavascriptLink, MacroElement
+from jinja2 import Template
+
+from .basemaps import basemap_url
+from .folmap import SIDECAR_DECODER, SIDECAR_FORMATS, Map, write_sidecar
+
+DEFAULT_BASEMAP = "OpenStreetMap.Mapnik"
+
+
+class StoryPlayer(MacroElement):
+    """Scene navigation for a folium map, driven by a story manifest.
+
+    Args:
+        manifest (str, optional): Url of the manifest, relative to the
+            page. Defaults to "manifest.json".
+        title (str, optional): Story title shown in the navigation bar.
+    """
+
+    _template = Template("""
+        {% macro header(this, kwargs) %}
+        <style>
+            .maeson-story-nav {
+                position: absolute; bottom: 24px; left: 50%; z-index: 1000;
+                transform: translateX(-50%); display: flex; gap: 8px;
+                align-items: center; padding: 6px 10px; border-radius: 4px;
+                background: rgba(255, 255, 255, 0.9); font: 14px sans-serif;
+                box-shadow: 0 1px 4px rgba(0, 0, 0, 0.3);
+            }
+            .maeson-story-nav span { min-width: 12em; text-align: center; }
+        </style>
+        {% endmacro %}
+
+        {% macro html(this, kwargs) %}
+        <div class="maeson-story-nav" id="{{ this.get_name() }}">
+            <button class="maeson-prev">&#9664;</button>
+            <span class="maeson-title">{{ this.title|e }}</span>
+            <button class="maeson-next">&#9654;</button>
+        </div>
+        {% endmacro %}
+
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var nav = document.getElementById({{ this.get_name()|tojson }});
+            var title = nav.querySelector(".maeson-title");
+            var manifest = null, index = -1, current = [], basemap = null;
+            var payloads = {}, assets = {}, layers = {}, basemaps = {};
+
+            function fetchPayload(i) {
+                var url = manifest.scenes[i].payload;
+                if (!payloads[url]) {
+                    payloads[url] = fetch(url).then(function(r) { return r.json(); });
+                }
+                return payloads[url];
+            }
+            function fetchAsset(spec) {
+                if (!assets[spec.url]) {
+                    assets[spec.url] = fetch(spec.url)
+                        .then(function(r) { return r.arrayBuffer(); })
+                        .then(function(buf) {
+                            return maesonDecodeSidecar(new Uint8Array(buf), spec.format);
+                        });
+                }
+                return assets[spec.url];
+            }
+            function buildLayer(spec) {
+                var key = JSON.stringify(spec);
+                if (layers[key]) return Promise.resolve(layers[key]);
+                var made;
+                if (spec.type === "geojson") {
+                    made = fetchAsset(spec).then(function(data) {
+                        return L.geoJson(data);
+                    });
+                } else if (spec.type === "tile") {
+                    made = L.tileLayer(spec.url, {maxZoom: 22});
+                } else if (spec.type === "wms") {
+                    made = L.tileLayer.wms(spec.url, {
+                        layers: spec.layers, format: "image/png", transparent: true
+                    });
+                } else if (spec.type === "image") {
+                    made = L.imageOverlay(spec.url, spec.bounds);
+                } else if (spec.type === "video") {
+                    made = L.videoOverlay(spec.url, spec.bounds, {
+                        autoplay: true, loop: true, muted: true
+                    });
+                }
+                return Promise.resolve(made).then(function(layer) {
+                    layers[key] = layer;
+                    return layer;
+                });
+            }
+            function prefetch(i) {
+                if (i < 0 || i >= manifest.scenes.length) return;
+                fetchPayload(i).then(function(payload) {
+                    payload.layers.forEach(function(spec) {
+                        if (spec.type === "geojson") fetchAsset(spec);
+                    });
+                });
+            }
+            function setBasemap(spec) {
+                var layer = spec ? basemaps[spec.url] : null;
+                if (spec && !layer) {
+                    layer = basemaps[spec.url] = L.tileLayer(spec.url, {
+                        attribution: spec.attribution, maxZoom: 22
+                    });
+                }
+                if (layer === basemap) return;
+                if (basemap) map.removeLayer(basemap);
+                if (layer) layer.addTo(map).bringToBack();
+                basemap = layer;
+            }
+            function show(i) {
+                if (!manifest || i < 0 || i >= manifest.scenes.length || i === index) return;
+                index = i;
+                var scene = manifest.scenes[i];
+                title.textContent = scene.title;
+                location.hash = String(i + 1);
+                map.setView(scene.center, scene.zoom);
+                setBasemap(scene.basemap);
+                fetchPayload(i)
+                    .then(function(payload) {
+                        return Promise.all(payload.layers.map(buildLayer));
+                    })
+                    .then(function(made) {
+                        if (index !== i) return;
+                        current.forEach(function(layer) {
+                            if (made.indexOf(layer) < 0) map.removeLayer(layer);
+                        });
+                        made.forEach(function(layer) { layer.addTo(map); });
+                        current = made;
+                        prefetch(i + 1);
+                    });
+            }
+
+            nav.querySelector(".maeson-prev").onclick = function() { show(index - 1); };
+            nav.querySelector(".maeson-next").onclick = function() { show(index + 1); };
+            document.addEventListener("keydown", function(e) {
+                if (e.key === "ArrowLeft") show(index - 1);
+                if (e.key === "ArrowRight") show(index + 1);
+            });
+            fetch({{ this.manifest|tojson }})
+                .then(function(r) { return r.json(); })
+                .then(function(m) {
+                    manifest = m;
+                    show((parseInt(location.hash.slice(1)) || 1) - 1);
+                });
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, manifest="manifest.json", title=""):
+        super().__init__()
+        self._name = "StoryPlayer"
+        self.manifest = manifest
+        self.title = title
+
+
+def _write_asset(directory, data, name):
+    """Write ``data`` to ``assets/`` under a content-hashed name, once."""
+    stem, ext = os.path.splitext(os.path.basename(name))
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    filename = f"{stem}-{digest}{ext}"
+    path = os.path.join(directory, "assets", filename)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(data)
+    return "assets/" + filename
+
+
+def _copy_asset(directory, src):
+    """Copy a local file into the assets; remote urls are kept as they are."""
+    if src.startswith(("http://", "https://")):
+        return src
+    with open(src, "rb") as f:
+        return _write_asset(directory, f.read(), src)
+
+
+def _raster_overlay(path, max_size=1024, colormap="greys", expression=None):
+    """Render a raster to a Web Mercator PNG for an image overlay.
+
+    With an ``expression`` the band-math result is rendered instead of the
+    bands (see `maeson.raster.BandMath`).
+
+    Returns:
+        tuple: (PNG bytes, ((south, west), (north, east))).
+    """
+    from rio_tiler.io import Reader
+    from rio_tiler.models import ImageData
+
+    from .raster import BandMath, evaluate_expression, lonlat_bounds
+    from .tiles import raster_render_params, render_image
+
+    if expression:
+        band_math = BandMath.get(path, expression, colormap=colormap)
+        indexes, in_range = band_math.bands, (band_math.rescale,)
+    else:
+        indexes, in_range = raster_render_params(path)
+    west, south, east, north = lonlat_bounds(path)
+    with Reader(path) as src:
+        img = src.part(
+            (west, south, east, north),
+            dst_crs="EPSG:3857",
+            bounds_crs="EPSG:4326",
+            indexes=indexes,
+            max_size=max_size,
+        )
+    if expression:
+        result = evaluate_expression(expression, img.array, indexes)
+        img = ImageData(result[None], bounds=img.bounds, crs=img.crs)
+    return render_image(img, in_range, colormap), ((south, west), (north, east))
+
+
+def _layer_payload(ld, story, directory, data_format, raster_size):
+    """The browser-side description of one layer definition."""
+    from .render import _geojson_data
+
+    t = ld["type"]
+    name = ld.get("name") or t
+    if t in ("geojson", "roi"):
+        if t == "roi":
+            data = story.rois.to_geojson(ld["ids"])
+        else:
+            data = _geojson_data(ld)
+        sidecar = write_sidecar(
+            data, os.path.join(directory, "assets"), name, data_format
+        )
+        url = "assets/" + os.path.basename(sidecar)
+        return {"type": "geojson", "url": url, "format": data_format}
+    if t == "tile":
+        return {"type": "tile", "url": ld.get("url") or ld.get("path")}
+    if t == "wms":
+        return {"type": "wms", "url": ld["url"], "layers": ld.get("layers", "")}
+    if t in ("image", "video"):
+        bounds = [list(c) for c in ld["bounds"]]
+        src = ld.get("path") or ld.get("url")
+        return {"type": t, "url": _copy_asset(directory, src), "bounds": bounds}
+    if t in ("raster", "stack"):
+        from .raster import _expand_sources
+
+        if t == "raster":
+            path = ld["path"]
+        else:
+            path = _expand_sources(ld["paths"])[ld.get("frame", 0)]
+        png, bounds = _raster_overlay(
+            path, raster_size, ld.get("colormap", "greys"), ld.get("expression")
+        )
+        stem = os.path.splitext(os.path.basename(path))[0]
+        url = _write_asset(directory, png, stem + ".png")
+        return {"type": "image", "url": url, "bounds": [list(c) for c in bounds]}
+    print(f"⚠️ Skipping {t} layer “{name}”: not supported in static sites")
+    return None
+
+
+def _basemap_spec(name):
+    url = basemap_url(name)
+    if url is None:
+        return None
+    attribution = ""
+    if "{z}" not in name:
+        import xyzservices.providers as xyz
+
+        attribution = xyz.query_name(name).html_attribution
+    return {"url": url, "attribution": attribution}
+
+
+def export_story_site(
+    story,
+    directory,
+    title="Story",
+    basemap=DEFAULT_BASEMAP,
+    data_format="geojson",
+    raster_size=1024,
+):
+    """Export a story as a static website with lazily loaded scenes.
+
+    Vector data goes to compressed sidecars (see `maeson.folmap.write_sidecar`),
+    local images and videos are copied, and raster layers are rendered once
+    to PNG overlays.  The site must be served over HTTP, e.g. with
+    ``python -m http.server`` in ``directory``.
+
+    Args:
+        story (maeson.gistory.Story): The story.
+        directory (str): Output folder, created if needed.
+        title (str, optional): Page and story title. Defaults to "Story".
+        basemap (str, optional): Basemap for scenes without their own.
+            Defaults to OpenStreetMap.
+        data_format (str, optional): Vector sidecar format, "geojson",
+            "topojson" or "flatgeobuf". Defaults to "geojson".
+        raster_size (int, optional): Largest side of rendered rasters, in
+            pixels. Defaults to 1024.
+
+    Returns:
+        dict: ``index`` (page path), ``scenes``, ``payloads`` (distinct scene
+        payloads), ``assets`` (files in ``assets/``) and ``bytes`` (total
+        size of the site).
+    """
+    if data_format not in SIDECAR_FORMATS:
+        raise ValueError(
+            f"Unknown sidecar format '{data_format}'. "
+            f"Choose from {sorted(SIDECAR_FORMATS)}."
+        )
+    os.makedirs(os.path.join(directory, "scenes"), exist_ok=True)
+
+    scenes = []
+    payloads = set()
+    for i, scene in enumerate(story.scenes):
+        layers = []
+        for ld in scene.layers:
+            try:
+                spec = _layer_payload(ld, story, directory, data_format, raster_size)
+            except Exception as e:
+                print(f"❌ Failed to export {ld.get('type')} layer: {e}")
+                continue
+            if spec is not None:
+                layers.append(spec)
+        text = json.dumps({"layers": layers}, sort_keys=True).encode("utf-8")
+        payload = f"scenes/{hashlib.sha1(text).hexdigest()[:12]}.json"
+        if payload not in payloads:
+            with open(os.path.join(directory, payload), "wb") as f:
+                f.write(text)
+            payloads.add(payload)
+        scenes.append(
+            {
+                "title": scene.title or f"Scene {i + 1}",
+                "center": list(scene.center),
+                "zoom": scene.zoom,
+                "basemap": _basemap_spec(scene.basemap or basemap),
+                "payload": payload,
+            }
+        )
+
+    with open(os.path.join(directory, "manifest.json"), "w") as f:
+        json.dump({"title": title, "scenes": scenes}, f, indent=1)
+
+    first = story.scenes[0] if story.scenes else None
+    shell = Map(
+        center=first.center if first else (0, 0),
+        zoom=first.zoom if first else 2,
+        tiles=None,
+    )
+    figure = shell.get_root()
+    figure.title = title
+    library = SIDECAR_FORMATS[data_format][1]
+    if library:
+        figure.header.add_child(JavascriptLink(library), name="maeson_sidecar_lib")
+    figure.script.add_child(Element(SIDECAR_DECODER), name="maeson_decode_sidecar")
+    StoryPlayer(title=title).add_to(shell)
+    index = os.path.join(directory, "index.html")
+    shell.save(index)
+
+    assets = os.path.join(directory, "assets")
+    files = [
+        os.path.join(root, f) for root, _, names in os.walk(directory) for f in names
+    ]
+    return {
+        "index": index,
+        "scenes": len(scenes),
+        "payloads": len(payloads),
+        "assets": len(os.listdir(assets)) if os.path.isdir(assets) else 0,
+        "bytes": sum(os.path.getsize(f) for f in files),
+    }
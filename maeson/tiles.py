@@ -0,0 +1,742 @@
+"""Tile fetching, caching and a local tile server.
+
+`TileServer` is a small threaded HTTP server that maeson uses to serve tiles
+it produces itself (mosaics, derived products, cached proxies) to ipyleaflet
+and folium layers.
+"""
+
+import collections
+import functools
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from .common import get_cache_dir
+
+SUBDOMAINS = "abc"
+
+# Shared cache in front of locally served tiles, see `get_tile_cache`.
+_TILE_CACHE = None
+
+
+class TileCache:
+    """Content cache for rendered or downloaded tiles stored on disk.
+
+    Keys are arbitrary tuples such as ``(source, z, x, y)``; they are hashed
+    into a two-level directory layout.  Writes are atomic so several worker
+    processes can share one cache directory.
+
+    Args:
+        cache_dir (str, optional): Directory to store tiles in. Defaults to
+            ``<maeson cache>/tiles``.
+        max_bytes (int, optional): Size cap. When exceeded, the least
+            recently used tiles are deleted down to 80% of the cap.
+            Defaults to no limit.
+    """
+
+    def __init__(self, cache_dir=None, max_bytes=None):
+        self.cache_dir = cache_dir or get_cache_dir("tiles")
+        self.max_bytes = max_bytes
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest[2:])
+
+    def get(self, key):
+        """Return cached bytes for ``key`` or None."""
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        if self.max_bytes:
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return data
+
+    def put(self, key, data):
+        """Store ``data`` under ``key``."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        if self.max_bytes:
+            with self._lock:
+                self._size = (self.nbytes if self._size is None else self._size) + len(
+                    data
+                )
+                if self._size > self.max_bytes:
+                    self.trim(int(self.max_bytes * 0.8))
+
+    def __contains__(self, key):
+        return os.path.exists(self._path(key))
+
+    def _files(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield st.st_mtime, st.st_size, path
+
+    @property
+    def nbytes(self):
+        """Total size of the cached tiles in bytes."""
+        return sum(size for _, size, _ in self._files())
+
+    def trim(self, max_bytes):
+        """Delete least recently used tiles until at most ``max_bytes`` remain."""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self._size = total
+
+
+class MemoryTileCache:
+    """Thread-safe in-memory LRU cache for tiles.
+
+    Args:
+        maxsize (int, optional): Maximum number of tiles kept. Defaults to 512.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return cached bytes for ``key`` or None."""
+        with self._lock:
+            data = self._data.get(key)
+            if data is not None:
+                self._data.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """Store ``data`` under ``key``, evicting the least recently used."""
+        with self._lock:
+            self._data[key] = data
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+class TieredTileCache:
+    """Memory LRU in front of an optional size-capped disk cache.
+
+    Disk hits are promoted to memory.  Hit and miss counts are kept per tier
+    (see `stats`).
+
+    Args:
+        memory_size (int, optional): Tiles kept in memory. Defaults to 1024.
+        disk (bool, optional): Enable the disk tier. Defaults to True.
+        cache_dir (str, optional): Disk tier directory. Defaults to
+            ``<maeson cache>/served``.
+        max_disk_bytes (int, optional): Disk tier size cap. Defaults to
+            512 MB.
+    """
+
+    def __init__(
+        self, memory_size=1024, disk=True, cache_dir=None, max_disk_bytes=512 * 2**20
+    ):
+        self.memory = MemoryTileCache(maxsize=memory_size)
+        self.disk = None
+        if disk:
+            self.disk = TileCache(
+                cache_dir or get_cache_dir("served"), max_bytes=max_disk_bytes
+            )
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the hit/miss counters."""
+        with self._stats_lock:
+            self.memory_hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+
+    def _count(self, counter):
+        # tiles are looked up from many server threads at once
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, key):
+        """Return cached bytes for ``key`` or None."""
+        data = self.memory.get(key)
+        if data is not None:
+            self._count("memory_hits")
+            return data
+        if self.disk is not None:
+            data = self.disk.get(key)
+            if data is not None:
+                self._count("disk_hits")
+                self.memory.put(key, data)
+                return data
+        self._count("misses")
+        return None
+
+    def put(self, key, data):
+        """Store ``data`` under ``key`` in every tier."""
+        self.memory.put(key, data)
+        if self.disk is not None:
+            self.disk.put(key, data)
+
+    def __contains__(self, key):
+        return key in self.memory or (self.disk is not None and key in self.disk)
+
+    @property
+    def stats(self):
+        """Hit/miss counters, hit rate and tier sizes as a dict."""
+        with self._stats_lock:
+            memory_hits, disk_hits, misses = (
+                self.memory_hits,
+                self.disk_hits,
+                self.misses,
+            )
+        requests = memory_hits + disk_hits + misses
+        return {
+            "requests": requests,
+            "memory_hits": memory_hits,
+            "disk_hits": disk_hits,
+            "misses": misses,
+            "hit_rate": (memory_hits + disk_hits) / requests if requests else 0.0,
+            "memory_tiles": len(self.memory),
+        }
+
+
+def get_tile_cache():
+    """The shared `TieredTileCache` used for tiles maeson serves itself."""
+    global _TILE_CACHE
+    if _TILE_CACHE is None:
+        _TILE_CACHE = TieredTileCache()
+    return _TILE_CACHE
+
+
+def configure_tile_cache(memory_size=1024, disk=True, max_disk_bytes=512 * 2**20):
+    """Replace the shared tile cache with one of a different size.
+
+    Args:
+        memory_size (int, optional): Tiles kept in memory. Defaults to 1024.
+        disk (bool, optional): Enable the disk tier. Defaults to True.
+        max_disk_bytes (int, optional): Disk tier size cap. Defaults to
+            512 MB.
+
+    Returns:
+        TieredTileCache: The new shared cache.
+    """
+    global _TILE_CACHE
+    _TILE_CACHE = TieredTileCache(memory_size, disk, max_disk_bytes=max_disk_bytes)
+    return _TILE_CACHE
+
+
+def cached_provider(render, key, cache=None):
+    """Wrap a tile renderer with a cache lookup.
+
+    Args:
+        render (callable): ``render(z, x, y)`` returning bytes or None.
+        key (tuple): Identifies the source and rendering options; the cache
+            key is ``key[:1] + (z, x, y) + key[1:]``.
+        cache (optional): Cache with ``get``/``put``. Defaults to
+            `get_tile_cache`. Empty tiles are cached too.
+
+    Returns:
+        callable: A provider for `TileServer.register`.
+    """
+
+    def provider(z, x, y):
+        c = cache if cache is not None else get_tile_cache()
+        k = key[:1] + (z, x, y) + key[1:]
+        data = c.get(k)
+        if data is None:
+            data = render(z, x, y) or b""
+            c.put(k, data)
+        return data or None
+
+    return provider
+
+
+# Keyword arguments of ``localtileserver.TileClient.tile`` that change pixels.
+LOCALTILESERVER_OPTIONS = ("indexes", "vmin", "vmax", "nodata", "stretch")
+
+
+def localtileserver_provider(client, source, colormap=None, cache=None, **options):
+    """Serve a ``localtileserver.TileClient`` through the shared tile cache.
+
+    Tiles are rendered in-process with ``client.tile`` and cached under
+    ``(source, z, x, y, stamp, colormap, expression, options)`` (see
+    `source_stamp`), so panning back or revisiting a scene does not redo the
+    reads and colormapping.
+
+    Args:
+        client (localtileserver.TileClient): The raster's tile client.
+        source (str): Raster path, used in the cache key.
+        colormap (str or dict, optional): Colormap name or table.
+        cache (optional): Cache to use. Defaults to `get_tile_cache`.
+        **options: `LOCALTILESERVER_OPTIONS` and ``expression``.
+
+    Returns:
+        callable: A provider for `TileServer.register`.
+    """
+    import json
+
+    from rio_tiler.errors import TileOutsideBounds
+
+    if isinstance(colormap, dict):
+        colormap = json.dumps({str(k): list(v) for k, v in colormap.items()})
+    expression = options.pop("expression", None)
+
+    def render(z, x, y):
+        try:
+            return bytes(
+                client.tile(
+                    z, x, y, colormap=colormap, expression=expression, **options
+                )
+            )
+        except TileOutsideBounds:
+            return None
+
+    key = (
+        source,
+        source_stamp(source),
+        colormap,
+        expression,
+        tuple(sorted(options.items())),
+    )
+    return cached_provider(render, key, cache)
+
+
+def format_tile_url(template, z, x, y):
+    """Fill an XYZ url template such as ``https://{s}.host/{z}/{x}/{y}.png``."""
+    s = SUBDOMAINS[(x + y) % len(SUBDOMAINS)]
+    return template.format(z=z, x=x, y=y, s=s, r="")
+
+
+def fetch_xyz_tile(template, z, x, y, timeout=10):
+    """Download a single XYZ tile.
+
+    Args:
+        template (str): Tile url template.
+        z, x, y (int): Tile coordinates.
+        timeout (float, optional): Request timeout in seconds. Defaults to 10.
+
+    Returns:
+        bytes or None: The encoded tile, or None if the server has no tile.
+    """
+    resp = requests.get(
+        format_tile_url(template, z, x, y),
+        timeout=timeout,
+        headers={"User-Agent": "maeson"},
+    )
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.content
+
+
+def source_stamp(path):
+    """``(size, mtime_ns)`` of a local file, or None for urls and templates.
+
+    Cache keys of tiles rendered from local files include it, so tiles of a
+    file that was overwritten are not served again, in this session or from
+    the disk tier in a later one.
+    """
+    try:
+        st = os.stat(path)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def raster_render_params(path):
+    """Band indexes and rescale range for a raster, read from a small overview."""
+    return _raster_render_params(path, source_stamp(path))
+
+
+@functools.lru_cache(maxsize=64)
+def _raster_render_params(path, stamp):
+    import numpy as np
+    import rasterio
+
+    with rasterio.open(path) as src:
+        indexes = (1, 2, 3) if src.count >= 3 else (1,)
+        scale = max(src.width, src.height) / 512
+        out_shape = (
+            len(indexes),
+            max(1, int(src.height / max(scale, 1))),
+            max(1, int(src.width / max(scale, 1))),
+        )
+        arr = src.read(indexes, out_shape=out_shape, masked=True)
+        valid = arr.compressed() if np.ma.is_masked(arr) else arr.ravel()
+        if valid.size == 0 or src.dtypes[0] == "uint8":
+            return indexes, None
+        lo, hi = np.percentile(valid, (2, 98))
+        if lo == hi:
+            hi = lo + 1
+        return indexes, ((float(lo), float(hi)),)
+
+
+def read_raster_tile(path, z, x, y, colormap="greys", tile_size=256, expression=None):
+    """Render one XYZ tile of a GeoTIFF (local path or URL) to PNG.
+
+    Single-band rasters are stretched to their 2–98 percentile range and
+    colored with ``colormap``; rasters with three or more bands are shown
+    as RGB.
+
+    Args:
+        path (str): Raster path or URL.
+        z, x, y (int): Tile coordinates.
+        colormap (str, optional): Registered colormap name. Defaults to "greys".
+        tile_size (int, optional): Output tile size. Defaults to 256.
+        expression (str, optional): Band-math expression to render instead
+            of the bands (see `maeson.raster.BandMath`).
+
+    Returns:
+        bytes or None: PNG bytes, or None if the tile is outside the raster.
+    """
+    from rio_tiler.errors import TileOutsideBounds
+    from rio_tiler.io import Reader
+
+    if expression:
+        from .raster import BandMath
+
+        band_math = BandMath.get(path, expression, colormap=colormap)
+        img = band_math.read_tile(z, x, y, tile_size)
+        return img and render_image(img, (band_math.rescale,), colormap)
+
+    indexes, in_range = raster_render_params(path)
+    with Reader(path) as src:
+        try:
+            img = src.tile(x, y, z, tilesize=tile_size, indexes=indexes)
+        except TileOutsideBounds:
+            return None
+    return render_image(img, in_range, colormap)
+
+
+def render_image(img, in_range=None, colormap="greys"):
+    """Stretch and color a rio-tiler ``ImageData`` and encode it as PNG.
+
+    Args:
+        img (rio_tiler.models.ImageData): Tile data.
+        in_range (tuple, optional): ``((lo, hi),)`` range stretched to 0–255
+            for every band; None leaves the data as is.
+        colormap (str or dict, optional): Colormap name or table applied to
+            single-band data. Defaults to "greys".
+
+    Returns:
+        bytes: PNG bytes.
+    """
+    from rio_tiler.colormap import cmap
+
+    if in_range:
+        img.rescale(in_range=tuple(in_range) * img.count)
+    cm = None
+    if img.count == 1 and isinstance(colormap, str):
+        cm = cmap.get(colormap.lower())
+    elif isinstance(colormap, dict):
+        cm = colormap
+    return img.render(img_format="PNG", colormap=cm)
+
+
+def tile_key(kind, source, z, x, y, **options):
+    """Cache key `get_tile` uses for a tile.
+
+    Keys of local raster tiles also hold the file's `source_stamp`.
+    """
+    key = (kind, source, z, x, y, tuple(sorted(options.items())))
+    if kind == "raster":
+        key += (source_stamp(source),)
+    return key
+
+
+def get_tile(kind, source, z, x, y, cache=None, **options):
+    """Fetch a tile from a remote XYZ template or a raster, through a cache.
+
+    Args:
+        kind (str): Either ``"xyz"`` or ``"raster"``.
+        source (str): Url template (``xyz``) or raster path (``raster``).
+        z, x, y (int): Tile coordinates.
+        cache (TileCache, optional): Cache to read from and write to.
+        **options: Extra keyword arguments for the underlying reader; they
+            are part of the cache key.
+
+    Returns:
+        bytes or None: Encoded tile bytes.
+    """
+    key = tile_key(kind, source, z, x, y, **options)
+    if cache is not None:
+        data = cache.get(key)
+        if data is not None:
+            return data
+    if kind == "xyz":
+        data = fetch_xyz_tile(source, z, x, y, **options)
+    elif kind == "raster":
+        data = read_raster_tile(source, z, x, y, **options)
+    else:
+        raise ValueError(f"Unknown tile source kind: {kind}")
+    if data is not None and cache is not None:
+        cache.put(key, data)
+    return data
+
+
+# ---------------------------------------------------------------------- #
+# Local tile server
+# ---------------------------------------------------------------------- #
+CONTENT_TYPES = {
+    "png": "image/png",
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+
+class _TileRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body=b"", content_type="text/plain", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Access-Control-Allow-Origin", "*")
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def _send_file(self, entry):
+        """Send a registered file, honoring a single-range ``Range`` header."""
+        path = entry["path"]
+        size = os.path.getsize(path)
+        start, end, status = 0, size - 1, 200
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and any(match.groups()):
+            first, last = match.groups()
+            if first:
+                start, end = int(first), min(int(last) if last else end, end)
+            else:
+                start = max(0, size - int(last))
+            if start > end:
+                return self._send(416, headers={"Content-Range": f"bytes */{size}"})
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", entry["type"])
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "max-age=3600")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        if self.command == "HEAD":
+            return
+        head = entry.get("head") or b""
+        try:
+            if end < len(head):
+                self.wfile.write(head[start : end + 1])
+                return
+            with open(path, "rb") as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 2**16))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    remaining -= len(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            # players often drop a connection once they have enough data
+            pass
+
+    def do_GET(self):
+        parts = self.path.split("?", 1)[0].strip("/").split("/")
+        if len(parts) == 3 and parts[0] == "files":
+            entry = self.server.files.get(parts[1])
+            if entry is None:
+                return self._send(404, b"unknown file")
+            return self._send_file(entry)
+        if len(parts) != 5 or parts[0] != "tiles":
+            return self._send(404, b"not found")
+        _, key, z, x, y_ext = parts
+        provider = self.server.providers.get(key)
+        y, _, ext = y_ext.partition(".")
+        if provider is None:
+            return self._send(404, b"unknown layer")
+        try:
+            data = provider(int(z), int(x), int(y))
+        except Exception as e:
+            return self._send(500, str(e).encode("utf-8"))
+        if not data:
+            return self._send(204)
+        self._send(
+            200,
+            data,
+            CONTENT_TYPES.get(ext.lower(), "application/octet-stream"),
+            {"Cache-Control": "max-age=3600"},
+        )
+
+
+class TileServer:
+    """A local, threaded XYZ tile server for tiles produced in Python.
+
+    Providers are callables ``provider(z, x, y) -> bytes | None`` registered
+    under a key; they are served at ``/tiles/<key>/{z}/{x}/{y}.<ext>``.
+    Local files (e.g. videos) can be served too, with HTTP range requests,
+    at ``/files/<key>/<name>``.  Use `TileServer.get` for the shared, lazily
+    started instance.
+
+    Set ``MAESON_SERVER_URL`` (e.g. ``"/proxy/{port}"`` with
+    jupyter-server-proxy) to change the base url that layers use.
+
+    Args:
+        host (str, optional): Interface to bind. Defaults to "127.0.0.1".
+        port (int, optional): Port to bind; 0 picks a free one.
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.httpd = ThreadingHTTPServer((host, port), _TileRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.providers = {}
+        self.httpd.files = {}
+        self.host, self.port = self.httpd.server_address[:2]
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def get(cls):
+        """Return the shared server, starting it on first use."""
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls._instance = cls()
+            return cls._instance
+
+    @property
+    def base_url(self):
+        """Url prefix clients use to reach the server."""
+        template = os.environ.get("MAESON_SERVER_URL")
+        if template:
+            return template.format(port=self.port).rstrip("/")
+        return f"http://{self.host}:{self.port}"
+
+    def register(self, provider, key=None, ext="png"):
+        """Serve ``provider`` and return its XYZ url template.
+
+        Args:
+            provider (callable): ``provider(z, x, y)`` returning encoded tile
+                bytes or None for an empty tile.
+            key (str, optional): Url key. A random one is generated if omitted.
+            ext (str, optional): File extension / format. Defaults to "png".
+
+        Returns:
+            str: Url template with ``{z}``, ``{x}`` and ``{y}`` placeholders.
+        """
+        key = key or uuid.uuid4().hex[:12]
+        self.httpd.providers[key] = provider
+        return f"{self.base_url}/tiles/{key}/{{z}}/{{x}}/{{y}}.{ext}"
+
+    def unregister(self, key):
+        """Stop serving the provider or file registered under ``key``."""
+        self.httpd.providers.pop(key, None)
+        self.httpd.files.pop(key, None)
+
+    def register_file(self, path, key=None, head_bytes=0):
+        """Serve a local file, with support for HTTP range requests.
+
+        Args:
+            path (str): File path.
+            key (str, optional): Url key. Defaults to a hash of ``path``, so
+                registering a file again returns the same url.
+            head_bytes (int, optional): Keep the first bytes of the file in
+                memory, so players can start before touching the disk (see
+                `prefetch_file`). Defaults to 0.
+
+        Returns:
+            str: The file's url.
+        """
+        path = os.path.abspath(path)
+        key = key or hashlib.sha1(path.encode("utf-8")).hexdigest()[:12]
+        entry = self.httpd.files.get(key)
+        if entry is None or entry["path"] != path:
+            content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+            entry = self.httpd.files[key] = {"path": path, "type": content_type}
+        if head_bytes:
+            self.prefetch_file(key, head_bytes)
+        return f"{self.base_url}/files/{key}/{os.path.basename(path)}"
+
+    def prefetch_file(self, key, nbytes):
+        """Keep the first ``nbytes`` of a registered file in memory."""
+        entry = self.httpd.files[key]
+        if len(entry.get("head") or b"") < nbytes:
+            with open(entry["path"], "rb") as f:
+                entry["head"] = f.read(nbytes)
+
+    def shutdown(self):
+        """Stop the server."""
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def raster_tile_url(path, colormap="greys", expression=None, server=None):
+    """Serve a GeoTIFF's tiles from the local `TileServer`.
+
+    Tiles are rendered with `read_raster_tile` when requested and kept in
+    the shared tile cache; registering the same raster again reuses its url
+    unless the file has changed since (see `source_stamp`).
+
+    Args:
+        path (str): GeoTIFF path or URL.
+        colormap (str or dict, optional): Colormap for single-band rasters.
+            Defaults to "greys".
+        expression (str, optional): Band-math expression (see
+            `maeson.raster.BandMath`).
+        server (TileServer, optional): Defaults to the shared server.
+
+    Returns:
+        str: XYZ url template.
+    """
+    server = server or TileServer.get()
+    key = (path, source_stamp(path), repr(colormap), expression)
+    provider = cached_provider(
+        lambda z, x, y: read_raster_tile(
+            path, z, x, y, colormap=colormap, expression=expression
+        ),
+        key,
+    )
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:12]
+    return server.register(provider, key=f"raster-{digest}")
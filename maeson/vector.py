@@ -0,0 +1,463 @@
+"""Viewport-aware vector layers for ipyleaflet maps."""
+
+import numpy as np
+from ipyleaflet import GeoJSON, LayerGroup
+
+from .common import viewport_bounds
+from .spatial import LayerIndex
+
+
+def _as_geojson(data):
+    """Accept a GeoJSON dict or anything with ``__geo_interface__``."""
+    if isinstance(data, dict):
+        return data
+    if hasattr(data, "to_crs"):
+        data = data.to_crs(epsg=4326)
+    return data.__geo_interface__
+
+
+def _map_bounds(map_obj):
+    """Current map bounds, estimated from center/zoom before the first render."""
+    if map_obj.bounds:
+        return tuple(tuple(c) for c in map_obj.bounds)
+    return viewport_bounds(map_obj.center, map_obj.zoom)
+
+
+class StreamingGeoJSON(LayerGroup):
+    """
+    A GeoJSON layer that only sends the features near the current view.
+
+    Features are indexed once (see `maeson.spatial.LayerIndex`).  Whenever
+    the map's ``bounds``/``center``/``zoom`` change, features newly inside
+    the view (plus ``margin``) are streamed to the frontend in batches of
+    ``batch_size``, each batch being its own GeoJSON child layer.  Batches
+    lying entirely outside the view plus ``evict_margin`` are dropped, and
+    the furthest batches are evicted first whenever more than
+    ``max_features`` features would be on the map.
+
+    Args:
+        data (dict or GeoDataFrame): The features to stream.
+        batch_size (int, optional): Features per child layer. Defaults to 500.
+        max_features (int, optional): Upper limit of features in the
+            frontend. Defaults to 5000.
+        margin (float, optional): Prefetch margin around the view, as a
+            fraction of its size. Defaults to 0.25.
+        evict_margin (float, optional): Features further than this fraction
+            of the view size outside it are evicted. Defaults to 1.0.
+        name (str, optional): Layer name. Defaults to "GeoJSON".
+        **kwargs: Styling arguments passed to each `ipyleaflet.GeoJSON` batch
+            (``style``, ``hover_style``, ``point_style`` ...).
+    """
+
+    def __init__(
+        self,
+        data,
+        batch_size=500,
+        max_features=5000,
+        margin=0.25,
+        evict_margin=1.0,
+        name="GeoJSON",
+        **kwargs,
+    ):
+        super().__init__(name=name)
+        self.index = LayerIndex(_as_geojson(data))
+        self.batch_size = batch_size
+        self.max_features = max_features
+        self.margin = margin
+        self.evict_margin = evict_margin
+        self.geojson_kwargs = kwargs
+        self._batches = []  # (layer, indices, (minx, miny, maxx, maxy))
+        self._loaded = np.zeros(len(self.index), dtype=bool)
+        self._map = None
+
+    @property
+    def feature_count(self):
+        """Number of features currently on the map."""
+        return int(self._loaded.sum())
+
+    def attach(self, map_obj):
+        """Start following ``map_obj``'s viewport and load the first view."""
+        self.detach()
+        self._map = map_obj
+        map_obj.observe(self._on_view_change, names=["bounds", "center", "zoom"])
+        self.refresh()
+
+    def detach(self):
+        """Stop following the map viewport."""
+        if self._map is not None:
+            self._map.unobserve(
+                self._on_view_change, names=["bounds", "center", "zoom"]
+            )
+            self._map = None
+
+    def _on_view_change(self, change):
+        self.refresh()
+
+    def refresh(self, bounds=None):
+        """Bring the loaded features in line with ``bounds`` (default: map view)."""
+        if bounds is None:
+            if self._map is None:
+                return
+            bounds = _map_bounds(self._map)
+        (south, west), (north, east) = bounds
+        cx, cy = (west + east) / 2, (south + north) / 2
+
+        # 1) evict batches far outside the view
+        dx = (east - west) * self.evict_margin
+        dy = (north - south) * self.evict_margin
+        keep = []
+        for batch in self._batches:
+            bx0, by0, bx1, by1 = batch[2]
+            if (
+                bx1 < west - dx
+                or bx0 > east + dx
+                or by1 < south - dy
+                or by0 > north + dy
+            ):
+                self._drop(batch)
+            else:
+                keep.append(batch)
+        self._batches = keep
+
+        # 2) newly visible features, nearest to the view center first
+        wanted = self.index.query(bounds, self.margin)
+        new = wanted[~self._loaded[wanted]]
+        if len(new):
+            fb = self.index.feature_bounds[new]
+            d = ((fb[:, 0] + fb[:, 2]) / 2 - cx) ** 2 + (
+                (fb[:, 1] + fb[:, 3]) / 2 - cy
+            ) ** 2
+            new = new[np.argsort(d, kind="stable")]
+
+        # 3) stay under the cap: evict furthest batches, then truncate
+        overflow = self.feature_count + len(new) - self.max_features
+        if overflow > 0 and self._batches:
+            self._batches.sort(key=lambda b: self._distance(b[2], cx, cy))
+            while overflow > 0 and self._batches:
+                batch = self._batches.pop()
+                self._drop(batch)
+                overflow -= len(batch[1])
+        new = new[: max(0, self.max_features - self.feature_count)]
+
+        # 4) stream the rest in batches
+        for start in range(0, len(new), self.batch_size):
+            idx = new[start : start + self.batch_size]
+            fb = self.index.feature_bounds[idx]
+            bbox = (
+                fb[:, 0].min(),
+                fb[:, 1].min(),
+                fb[:, 2].max(),
+                fb[:, 3].max(),
+            )
+            layer = GeoJSON(
+                data={
+                    "type": "FeatureCollection",
+                    "features": [self.index.features[i] for i in idx],
+                },
+                **self.geojson_kwargs,
+            )
+            self._loaded[idx] = True
+            self._batches.append((layer, idx, bbox))
+
+        current = tuple(b[0] for b in self._batches)
+        if current != self.layers:
+            self.layers = current
+
+    @staticmethod
+    def _distance(bbox, cx, cy):
+        return ((bbox[0] + bbox[2]) / 2 - cx) ** 2 + ((bbox[1] + bbox[3]) / 2 - cy) ** 2
+
+    def _drop(self, batch):
+        self._loaded[batch[1]] = False
+
+
+# ---------------------------------------------------------------------- #
+# Point aggregation
+# ---------------------------------------------------------------------- #
+COUNT_COLORS = ["#ffffb2", "#fed976", "#feb24c", "#fd8d3c", "#f03b20", "#bd0026"]
+
+
+def extract_points(data):
+    """Longitude/latitude of every Point/MultiPoint in a GeoJSON layer.
+
+    Args:
+        data (dict or GeoDataFrame): Point features.
+
+    Returns:
+        numpy.ndarray: ``(N, 2)`` array of lon/lat.
+    """
+    data = _as_geojson(data)
+    coords = []
+    for feat in data.get("features", []):
+        geom = feat.get("geometry") or {}
+        if geom.get("type") == "Point":
+            coords.append(geom["coordinates"][:2])
+        elif geom.get("type") == "MultiPoint":
+            coords.extend(c[:2] for c in geom["coordinates"])
+    return np.asarray(coords, dtype="float64").reshape(-1, 2)
+
+
+def _project(lonlat):
+    """lon/lat -> zoom-0 Web Mercator world pixels (vectorized)."""
+    lat = np.clip(lonlat[:, 1], -85.0511287798, 85.0511287798)
+    s = np.sin(np.radians(lat))
+    x = (lonlat[:, 0] + 180.0) / 360.0 * 256
+    y = (0.5 - np.log((1 + s) / (1 - s)) / (4 * np.pi)) * 256
+    return np.column_stack([x, y])
+
+
+def _unproject(xy):
+    """Zoom-0 world pixels -> lon/lat (vectorized)."""
+    lon = xy[..., 0] / 256 * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi - 2 * np.pi * xy[..., 1] / 256)))
+    return np.stack([lon, lat], axis=-1)
+
+
+class PointAggregator:
+    """
+    Bin points into square or hexagonal cells of a fixed on-screen size.
+
+    Points are projected once; each zoom level is then binned with
+    vectorized NumPy and cached.  For square grids, cells at a coarser zoom
+    are derived from any finer cached level by integer-shifting cell indices,
+    so zooming out does not touch the points again.
+
+    Args:
+        data (dict or GeoDataFrame): Point features.
+        kind (str, optional): "hex" or "grid". Defaults to "hex".
+        cell_size (int, optional): Cell size in screen pixels. For square
+            grids this is rounded to a power of two. Defaults to 32.
+    """
+
+    def __init__(self, data, kind="hex", cell_size=32):
+        if kind not in ("hex", "grid"):
+            raise ValueError("kind must be 'hex' or 'grid'")
+        self.kind = kind
+        if kind == "grid":
+            cell_size = 2 ** int(round(np.log2(cell_size)))
+        self.cell_size = cell_size
+        self.xy = _project(extract_points(data))
+        self._bins = {}  # zoom -> (cell indices (M, 2), counts (M,))
+        self._geojson = {}
+
+    def bins(self, zoom):
+        """Cell indices and point counts at an integer zoom."""
+        zoom = int(zoom)
+        if zoom in self._bins:
+            return self._bins[zoom]
+        finer = [z for z in self._bins if z > zoom]
+        if self.kind == "grid" and finer:
+            f = min(finer)
+            idx, counts = self._bins[f]
+            coarse = idx >> (f - zoom)
+            cells, inverse = np.unique(coarse, axis=0, return_inverse=True)
+            result = (cells, np.bincount(inverse.ravel(), weights=counts).astype(int))
+        else:
+            px = self.xy * 2**zoom / self.cell_size
+            if self.kind == "grid":
+                idx = np.floor(px).astype("int64")
+            else:
+                idx = self._hex_round(px)
+            if len(idx):
+                result = np.unique(idx, axis=0, return_counts=True)
+            else:
+                result = (np.empty((0, 2), dtype="int64"), np.empty(0, dtype=int))
+        self._bins[zoom] = result
+        return result
+
+    @staticmethod
+    def _hex_round(px):
+        """Axial coordinates of the pointy-top hexagon (unit size) per point."""
+        x, y = px[:, 0], px[:, 1]
+        q = np.sqrt(3) / 3 * x - y / 3
+        r = 2 / 3 * y
+        s = -q - r
+        rq, rr, rs = np.round(q), np.round(r), np.round(s)
+        dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+        fix_q = (dq > dr) & (dq > ds)
+        fix_r = ~fix_q & (dr > ds)
+        rq = np.where(fix_q, -rr - rs, rq)
+        rr = np.where(fix_r, -rq - rs, rr)
+        return np.column_stack([rq, rr]).astype("int64")
+
+    def _cell_polygons(self, cells, zoom):
+        """Polygon rings (lon/lat) for the given cells."""
+        scale = self.cell_size / 2**zoom
+        if self.kind == "grid":
+            corners = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]])
+            rings = (cells[:, None, :] + corners[None]) * scale
+        else:
+            q, r = cells[:, 0], cells[:, 1]
+            cx = np.sqrt(3) * (q + r / 2)
+            cy = 1.5 * r
+            angles = np.radians(np.arange(30, 420, 60))
+            rings = np.stack(
+                [
+                    cx[:, None] + np.cos(angles)[None],
+                    cy[:, None] + np.sin(angles)[None],
+                ],
+                axis=-1,
+            )
+            rings = rings * scale
+        return _unproject(rings)
+
+    def _cell_centers(self, cells, zoom):
+        """Cell centers in zoom-0 world pixels."""
+        scale = self.cell_size / 2**zoom
+        if self.kind == "grid":
+            return (cells + 0.5) * scale
+        q, r = cells[:, 0], cells[:, 1]
+        return np.column_stack([np.sqrt(3) * (q + r / 2), 1.5 * r]) * scale
+
+    @staticmethod
+    def _in_box(xy, box):
+        x0, y0, x1, y1 = box
+        return (xy[:, 0] >= x0) & (xy[:, 0] <= x1) & (xy[:, 1] >= y0) & (xy[:, 1] <= y1)
+
+    def _view_box(self, bounds, zoom, margin):
+        """``bounds`` plus ``margin`` and one cell, in zoom-0 world pixels."""
+        (south, west), (north, east) = bounds
+        (x0, y0), (x1, y1) = _project(np.array([[west, north], [east, south]]))
+        pad_x = (x1 - x0) * margin + self.cell_size / 2**zoom
+        pad_y = (y1 - y0) * margin + self.cell_size / 2**zoom
+        return (x0 - pad_x, y0 - pad_y, x1 + pad_x, y1 + pad_y)
+
+    def geojson(self, zoom, bounds=None, margin=0.25, max_cells=5000, raw_below=2.0):
+        """The aggregated cells at ``zoom`` as a FeatureCollection.
+
+        Each feature has ``count`` and ``color`` properties.  Without
+        ``bounds`` every cell is returned and the result is cached per zoom.
+        With ``bounds`` only the cells near the view are built, so high zooms
+        stay cheap however many points there are.
+
+        At zooms where the cells barely aggregate (fewer than ``raw_below``
+        points per cell on average) the points themselves are returned as
+        Point features with a count of 1, which are cheaper to draw than
+        the same number of cell polygons.  At most ``max_cells`` cells, the
+        densest ones, are returned.
+
+        Args:
+            zoom (int): Map zoom.
+            bounds (sequence, optional): ((south, west), (north, east)).
+            margin (float, optional): Extra area around ``bounds``, as a
+                fraction of its size. Defaults to 0.25.
+            max_cells (int, optional): Cap on returned cells. Defaults to
+                5000.
+            raw_below (float, optional): Mean points per cell below which
+                raw points are returned. Defaults to 2.0.
+
+        Returns:
+            dict: A FeatureCollection.
+        """
+        zoom = int(zoom)
+        if bounds is None and zoom in self._geojson:
+            return self._geojson[zoom]
+        cells, counts = self.bins(zoom)
+        box = None
+        if bounds is not None:
+            box = self._view_box(bounds, zoom, margin)
+            inside = self._in_box(self._cell_centers(cells, zoom), box)
+            cells, counts = cells[inside], counts[inside]
+
+        if len(counts) and counts.sum() < raw_below * len(counts):
+            xy = self.xy if box is None else self.xy[self._in_box(self.xy, box)]
+            features = [
+                {
+                    "type": "Feature",
+                    "properties": {"count": 1, "color": COUNT_COLORS[0]},
+                    "geometry": {"type": "Point", "coordinates": pt.tolist()},
+                }
+                for pt in _unproject(xy)
+            ]
+        else:
+            if len(counts) > max_cells:
+                densest = np.argsort(counts, kind="stable")[::-1][:max_cells]
+                cells, counts = cells[densest], counts[densest]
+            features = self._cell_features(cells, counts, zoom)
+        fc = {"type": "FeatureCollection", "features": features}
+        if bounds is None:
+            self._geojson[zoom] = fc
+        return fc
+
+    def _cell_features(self, cells, counts, zoom):
+        rings = self._cell_polygons(cells, zoom)
+        if len(counts):
+            level = np.log1p(counts) / np.log1p(counts.max())
+            color_idx = np.minimum(
+                (level * len(COUNT_COLORS)).astype(int), len(COUNT_COLORS) - 1
+            )
+        else:
+            color_idx = counts
+        return [
+            {
+                "type": "Feature",
+                "properties": {
+                    "count": int(c),
+                    "color": COUNT_COLORS[ci],
+                },
+                "geometry": {"type": "Polygon", "coordinates": [ring.tolist()]},
+            }
+            for ring, c, ci in zip(rings, counts, color_idx)
+        ]
+
+
+def cell_style(feature):
+    """Style callback coloring an aggregated cell by its ``color`` property."""
+    return {
+        "color": feature["properties"]["color"],
+        "fillColor": feature["properties"]["color"],
+        "weight": 0.5,
+        "fillOpacity": 0.6,
+    }
+
+
+class AggregatedPoints(GeoJSON):
+    """
+    A GeoJSON layer showing dense points as aggregated hex or grid cells.
+
+    Only the cells near the current view are sent to the frontend.  The
+    layer re-aggregates when the map zoom or bounds change, reusing the
+    binning cached per zoom level (see `PointAggregator`); where cells
+    would hold single points the points are shown instead.
+
+    Args:
+        data (dict or GeoDataFrame): Point features.
+        kind (str, optional): "hex" or "grid". Defaults to "hex".
+        cell_size (int, optional): Cell size in screen pixels. Defaults to 32.
+        name (str, optional): Layer name. Defaults to "Aggregated points".
+        **kwargs: Additional arguments for `ipyleaflet.GeoJSON`.
+    """
+
+    def __init__(
+        self, data, kind="hex", cell_size=32, name="Aggregated points", **kwargs
+    ):
+        kwargs.setdefault("style_callback", cell_style)
+        kwargs.setdefault("point_style", {"radius": 4, "weight": 1})
+        super().__init__(name=name, **kwargs)
+        self.aggregator = PointAggregator(data, kind=kind, cell_size=cell_size)
+        self._map = None
+
+    def attach(self, map_obj):
+        """Follow ``map_obj``'s view and aggregate for the current one."""
+        self.detach()
+        self._map = map_obj
+        map_obj.observe(self._on_view_change, names=["bounds", "center", "zoom"])
+        self.refresh()
+
+    def detach(self):
+        """Stop following the map view."""
+        if self._map is not None:
+            self._map.unobserve(
+                self._on_view_change, names=["bounds", "center", "zoom"]
+            )
+            self._map = None
+
+    def refresh(self):
+        """Re-aggregate for the map's current zoom and bounds."""
+        if self._map is not None:
+            self.data = self.aggregator.geojson(
+                self._map.zoom, bounds=_map_bounds(self._map)
+            )
+
+    def _on_view_change(self, change):
+        self.refresh()
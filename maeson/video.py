@@ -0,0 +1,257 @@
+"""Video overlay preparation: transcoding, local serving and prefetching.
+
+Large source videos make poor overlays: the browser downloads far more
+pixels than the overlay shows, and every scene revisit fetches them again.
+`prepare_video` transcodes a video once to H.264 at the overlay's on-screen
+size and a matching bitrate, into a cache directory, and `video_url` serves
+the result from the local `maeson.tiles.TileServer`, which answers HTTP range
+requests so players can seek and start early.  `prefetch_videos` gets the
+videos of upcoming scenes ready and keeps their first seconds in memory.
+"""
+
+import hashlib
+import json
+import os
+import re
+import subprocess
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import bounds_to_center_zoom, get_cache_dir, lonlat_to_pixel
+from .tiles import TileServer
+
+# Bits per pixel and frame used to derive a bitrate from the output size.
+BITS_PER_PIXEL = 0.08
+ASSUMED_FPS = 30
+
+# Transcodes in flight, keyed by output path, and the pools that run them
+# and the prefetch jobs waiting on them.
+_PENDING = {}
+_PENDING_LOCK = threading.Lock()
+_EXECUTORS = {}
+
+
+def _executor(name="transcode"):
+    with _PENDING_LOCK:
+        if name not in _EXECUTORS:
+            _EXECUTORS[name] = ThreadPoolExecutor(max_workers=2)
+        return _EXECUTORS[name]
+
+
+def overlay_size(bounds, zoom=None, max_size=1280):
+    """On-screen pixel size of an overlay, rounded to even numbers.
+
+    Args:
+        bounds (sequence): ((south, west), (north, east)).
+        zoom (float, optional): Map zoom. Defaults to the zoom that fits
+            the bounds in a 960x600 view, as ``fit_bounds`` does.
+        max_size (int, optional): Cap on the longer side. Defaults to 1280.
+
+    Returns:
+        tuple: (width, height) in pixels.
+    """
+    if zoom is None:
+        zoom = bounds_to_center_zoom(bounds)[1]
+    (south, west), (north, east) = bounds
+    x0, y0 = lonlat_to_pixel(west, north, zoom)
+    x1, y1 = lonlat_to_pixel(east, south, zoom)
+    width, height = abs(x1 - x0), abs(y1 - y0)
+    scale = min(1.0, max_size / max(width, height, 1))
+    return (
+        max(2, int(width * scale) // 2 * 2),
+        max(2, int(height * scale) // 2 * 2),
+    )
+
+
+def video_bitrate(width, height):
+    """Target bitrate in bits per second for a video of this size."""
+    return int(width * height * ASSUMED_FPS * BITS_PER_PIXEL)
+
+
+def video_cache_path(src, width, height):
+    """Cache path of ``src`` transcoded to ``width`` x ``height``."""
+    stamp = ""
+    if os.path.isfile(src):
+        st = os.stat(src)
+        stamp = f"{st.st_mtime_ns}-{st.st_size}"
+    key = hashlib.sha1(f"{src}|{stamp}|{width}x{height}".encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir("video"), f"{key[:16]}.mp4")
+
+
+def transcode_video(src, width, height, dst=None, bitrate=None):
+    """Transcode a video to web-friendly, streamable H.264 MP4.
+
+    The output is scaled to ``width`` x ``height`` (cropping to keep the
+    aspect ratio), has no audio track, and keeps its index at the start of
+    the file (``+faststart``) so playback can begin after the first bytes.
+
+    Args:
+        src (str): Source path or URL (anything ffmpeg reads).
+        width (int): Output width in pixels (even).
+        height (int): Output height in pixels (even).
+        dst (str, optional): Output path. Defaults to `video_cache_path`.
+        bitrate (int, optional): Peak bitrate in bits per second. Defaults
+            to `video_bitrate`.
+
+    Returns:
+        str: The output path.
+    """
+    from .render import _find_ffmpeg
+
+    dst = dst or video_cache_path(src, width, height)
+    bitrate = bitrate or video_bitrate(width, height)
+    tmp = f"{dst}.{uuid.uuid4().hex}.tmp.mp4"
+    cmd = [
+        _find_ffmpeg(),
+        "-y",
+        "-loglevel",
+        "error",
+        "-i",
+        src,
+        "-an",
+        "-vf",
+        f"scale={width}:{height}:force_original_aspect_ratio=increase,"
+        f"crop={width}:{height}",
+        "-c:v",
+        "libx264",
+        "-preset",
+        "veryfast",
+        "-crf",
+        "26",
+        "-maxrate",
+        str(bitrate),
+        "-bufsize",
+        str(2 * bitrate),
+        "-pix_fmt",
+        "yuv420p",
+        "-movflags",
+        "+faststart",
+        tmp,
+    ]
+    try:
+        proc = subprocess.run(cmd, capture_output=True)
+        if proc.returncode != 0:
+            raise RuntimeError(
+                f"ffmpeg failed on {src}: {proc.stderr.decode(errors='replace')}"
+            )
+        with open(dst + ".json", "w") as f:
+            json.dump(
+                {"src": src, "width": width, "height": height, "bitrate": bitrate}, f
+            )
+        os.replace(tmp, dst)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return dst
+
+
+def _transcode_future(src, width, height, dst):
+    """The in-flight transcode of ``src`` to ``dst``, started if needed."""
+    pool = _executor()
+    with _PENDING_LOCK:
+        future = _PENDING.get(dst)
+        if future is None or (future.done() and future.exception() is not None):
+            future = pool.submit(transcode_video, src, width, height, dst)
+            _PENDING[dst] = future
+            future.add_done_callback(lambda _: _PENDING.pop(dst, None))
+    return future
+
+
+def prepare_video(src, bounds, zoom=None, max_size=1280, background=False):
+    """Return the transcoded copy of ``src`` for an overlay over ``bounds``.
+
+    Args:
+        src (str): Source path or URL.
+        bounds (sequence): Overlay bounds, ((south, west), (north, east)).
+        zoom (float, optional): Zoom the overlay is shown at (see
+            `overlay_size`).
+        max_size (int, optional): Cap on the longer side. Defaults to 1280.
+        background (bool, optional): If the video is not cached yet, start
+            transcoding in a background thread and return None instead of
+            waiting. Defaults to False.
+
+    Returns:
+        str or None: Path of the transcoded video.
+    """
+    width, height = overlay_size(bounds, zoom, max_size)
+    dst = video_cache_path(src, width, height)
+    if os.path.exists(dst):
+        return dst
+    # every caller shares one transcode per output, so concurrent requests
+    # for the same clip never run ffmpeg twice on the same file
+    future = _transcode_future(src, width, height, dst)
+    if background:
+        return None
+    return future.result()
+
+
+def video_url(src, bounds, zoom=None, max_size=1280, background=False, server=None):
+    """Url of the transcoded video, served with HTTP range support.
+
+    Args:
+        src (str): Source path or URL.
+        bounds (sequence): Overlay bounds.
+        zoom (float, optional): Zoom the overlay is shown at.
+        max_size (int, optional): Cap on the longer side. Defaults to 1280.
+        background (bool, optional): Return ``src`` itself while the video
+            is transcoded in the background. Defaults to False.
+        server (TileServer, optional): Defaults to the shared server.
+
+    Returns:
+        str: The local url, or ``src`` while it is still being prepared.
+    """
+    path = prepare_video(src, bounds, zoom, max_size, background)
+    if path is None:
+        return src
+    return (server or TileServer.get()).register_file(path)
+
+
+def _head_bytes(path, seconds):
+    meta = path + ".json"
+    bitrate = None
+    if os.path.exists(meta):
+        with open(meta) as f:
+            bitrate = json.load(f).get("bitrate")
+    if bitrate is None:
+        from .render import _find_ffmpeg
+
+        proc = subprocess.run([_find_ffmpeg(), "-i", path], capture_output=True)
+        match = re.search(rb"bitrate: (\d+) kb/s", proc.stderr)
+        bitrate = int(match.group(1)) * 1000 if match else 8 * 2**20
+    return int(bitrate / 8 * seconds) + 2**16
+
+
+def prefetch_videos(layer_defs, zoom=None, seconds=5, max_size=1280, server=None):
+    """Get the videos of upcoming scenes ready to play.
+
+    Each "video" layer definition with ``"preprocess": True`` is transcoded
+    in the background if needed, registered with the server, and its first
+    ``seconds`` are read into memory.
+
+    Args:
+        layer_defs (iterable): Layer definitions, e.g. ``scene.layers``.
+        zoom (float, optional): Zoom the scene is shown at.
+        seconds (float, optional): Playback time to keep in memory.
+            Defaults to 5.
+        max_size (int, optional): Cap on the longer side. Defaults to 1280.
+        server (TileServer, optional): Defaults to the shared server.
+
+    Returns:
+        list: The futures of the prefetch jobs.
+    """
+    server = server or TileServer.get()
+
+    def _prefetch(src, bounds):
+        # waits on the shared transcode (see `prepare_video`)
+        path = prepare_video(src, bounds, zoom, max_size)
+        url = server.register_file(path)
+        key = url.rsplit("/", 2)[-2]
+        server.prefetch_file(key, _head_bytes(path, seconds))
+        return url
+
+    return [
+        _executor("prefetch").submit(_prefetch, ld["path"], ld["bounds"])
+        for ld in layer_defs
+        if ld.get("type") == "video" and ld.get("preprocess")
+    ]
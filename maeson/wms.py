@@ -0,0 +1,402 @@
+"""Capabilities-aware WMS/WMTS layers.
+
+`get_capabilities` fetches and parses an endpoint's WMS (and WMTS) service
+description once, caching it in memory and on disk.  `wms_layer_url` uses
+it to pick the cheapest way to draw a layer as 256 px Web Mercator tiles:
+the service's WMTS tiles when it offers them, otherwise tile-aligned
+GetMap requests served through maeson's local tile server, where they are
+cached and duplicate in-flight requests are coalesced.
+"""
+
+import hashlib
+import math
+import os
+import time
+import xml.etree.ElementTree as ET
+
+import requests
+
+from .common import TILE_SIZE, get_cache_dir
+from .proxy import _SETTINGS, coalesce, get_basemap_cache, tile_url
+from .tiles import TileServer, tile_key
+
+# How long cached capabilities stay valid, in seconds.
+CAPABILITIES_TTL = 24 * 3600
+
+# How long a refused (4xx) capabilities request is remembered, in seconds.
+REFUSED_TTL = 10 * 60
+
+# Identifiers of the Web Mercator CRS, in order of preference.
+MERCATOR_CRS = ("EPSG:3857", "EPSG:900913", "EPSG:102100")
+
+# ScaleDenominator of zoom level 0 in the OGC GoogleMapsCompatible set.
+_ZOOM0_SCALE = 559082264.0287178
+_HALF_WORLD = math.pi * 6378137
+
+_CAPABILITIES = {}
+
+
+def _local(tag):
+    return tag.rsplit("}", 1)[-1]
+
+
+def _child(el, name):
+    return next((c for c in el if _local(c.tag) == name), None)
+
+
+def _children(el, name):
+    return [c for c in el if _local(c.tag) == name]
+
+
+def _text(el, name, default=None):
+    c = _child(el, name) if el is not None else None
+    return c.text.strip() if c is not None and c.text else default
+
+
+def _href(el):
+    for key, value in el.attrib.items():
+        if _local(key) == "href":
+            return value
+    return None
+
+
+def _request_url(url, **params):
+    """``url`` with OGC query parameters added (keeping its own)."""
+    req = requests.Request("GET", url, params=params).prepare()
+    return req.url
+
+
+def _fetch_capabilities_xml(url, service, refresh=False, timeout=10):
+    key = hashlib.sha1(f"{service} {url}".encode("utf-8")).hexdigest()
+    path = os.path.join(get_cache_dir("capabilities"), f"{key}.xml")
+    if not refresh and os.path.exists(path):
+        age = time.time() - os.path.getmtime(path)
+        ttl = CAPABILITIES_TTL if os.path.getsize(path) else REFUSED_TTL
+        if age < ttl:
+            with open(path, "rb") as f:
+                return f.read()
+    resp = requests.get(
+        _request_url(url, SERVICE=service, REQUEST="GetCapabilities"),
+        timeout=timeout,
+        headers={"User-Agent": "maeson"},
+    )
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+    # a refused service (4xx) is cached as empty for `REFUSED_TTL`, so it
+    # is not asked again on every layer
+    content = resp.content if resp.ok else b""
+    with open(path + ".tmp", "wb") as f:
+        f.write(content)
+    os.replace(path + ".tmp", path)
+    return content
+
+
+def _parse_wms(root, url):
+    capability = _child(root, "Capability")
+    if capability is None:
+        raise ValueError(f"{url} did not return WMS capabilities")
+    getmap = _child(_child(capability, "Request"), "GetMap")
+    formats = [f.text.strip() for f in _children(getmap, "Format") if f.text]
+    resource = None
+    for el in getmap.iter():
+        if _local(el.tag) == "OnlineResource":
+            resource = _href(el)
+            break
+
+    layers = {}
+
+    def walk(el, inherited):
+        crs = inherited | {
+            c.text.strip() for c in el if _local(c.tag) in ("CRS", "SRS") and c.text
+        }
+        name = _text(el, "Name")
+        if name:
+            bbox = None
+            geo = _child(el, "EX_GeographicBoundingBox")
+            latlon = _child(el, "LatLonBoundingBox")
+            if geo is not None:
+                bbox = tuple(
+                    float(_text(geo, k))
+                    for k in (
+                        "westBoundLongitude",
+                        "southBoundLatitude",
+                        "eastBoundLongitude",
+                        "northBoundLatitude",
+                    )
+                )
+            elif latlon is not None:
+                bbox = tuple(
+                    float(latlon.get(k)) for k in ("minx", "miny", "maxx", "maxy")
+                )
+            layers[name] = {"title": _text(el, "Title", name), "crs": crs, "bbox": bbox}
+        for child in _children(el, "Layer"):
+            walk(child, crs)
+
+    for layer in _children(capability, "Layer"):
+        walk(layer, set())
+    return {
+        "version": root.get("version", "1.3.0"),
+        "formats": formats,
+        "getmap_url": resource or url,
+        "layers": layers,
+    }
+
+
+def _parse_wmts(root, url):
+    contents = _child(root, "Contents")
+    if contents is None:
+        return None
+    matrix_sets = {}
+    for tms in _children(contents, "TileMatrixSet"):
+        matrices = [
+            (_text(m, "Identifier"), float(_text(m, "ScaleDenominator")))
+            for m in _children(tms, "TileMatrix")
+        ]
+        matrix_sets[_text(tms, "Identifier")] = {
+            "crs": _text(tms, "SupportedCRS", ""),
+            "matrices": matrices,
+        }
+    kvp = None
+    for el in root.iter():
+        if _local(el.tag) == "Operation" and el.get("name") == "GetTile":
+            for get in el.iter():
+                if _local(get.tag) == "Get":
+                    kvp = _href(get)
+                    break
+    layers = {}
+    for layer in _children(contents, "Layer"):
+        styles = _children(layer, "Style")
+        default = next((s for s in styles if s.get("isDefault") == "true"), None)
+        style = default if default is not None else (styles[0] if styles else None)
+        templates = {
+            r.get("format"): r.get("template")
+            for r in _children(layer, "ResourceURL")
+            if r.get("resourceType") == "tile"
+        }
+        layers[_text(layer, "Identifier")] = {
+            "formats": [f.text.strip() for f in _children(layer, "Format") if f.text],
+            "style": _text(style, "Identifier", "default"),
+            "matrix_sets": [
+                _text(link, "TileMatrixSet")
+                for link in _children(layer, "TileMatrixSetLink")
+            ],
+            "templates": templates,
+        }
+    return {"kvp_url": kvp or url, "matrix_sets": matrix_sets, "layers": layers}
+
+
+def get_capabilities(url, refresh=False, timeout=10):
+    """Fetch and parse an endpoint's WMS capabilities, plus WMTS if offered.
+
+    Results are cached in memory and, for `CAPABILITIES_TTL` seconds, on
+    disk, so each endpoint is asked once.
+
+    Args:
+        url (str): Service endpoint.
+        refresh (bool, optional): Ignore the caches. Defaults to False.
+        timeout (float, optional): Request timeout. Defaults to 10.
+
+    Returns:
+        dict: ``version``, ``formats``, ``getmap_url``, ``layers`` (name ->
+        ``title``, ``crs``, ``bbox``) and ``wmts`` (None, or the parsed
+        WMTS contents).
+    """
+    if not refresh and url in _CAPABILITIES:
+        return _CAPABILITIES[url]
+    xml = _fetch_capabilities_xml(url, "WMS", refresh, timeout)
+    if not xml:
+        raise ValueError(f"{url} did not return WMS capabilities")
+    caps = _parse_wms(ET.fromstring(xml), url)
+    try:
+        xml = _fetch_capabilities_xml(url, "WMTS", refresh, timeout)
+        caps["wmts"] = xml and _parse_wmts(ET.fromstring(xml), url) or None
+    except (requests.RequestException, ET.ParseError):
+        caps["wmts"] = None
+    _CAPABILITIES[url] = caps
+    return caps
+
+
+def wmts_template(caps, layer, format="image/png"):
+    """XYZ url template for a WMTS layer in a Web Mercator matrix set.
+
+    Args:
+        caps (dict): `get_capabilities` result.
+        layer (str): Layer identifier.
+        format (str, optional): Preferred image format.
+
+    Returns:
+        str or None: The template, or None if the layer has no matrix set
+        that maps onto XYZ zoom levels.
+    """
+    wmts = caps.get("wmts")
+    info = wmts and wmts["layers"].get(layer)
+    if not info:
+        return None
+    for name in info["matrix_sets"]:
+        tms = wmts["matrix_sets"].get(name)
+        if not tms or not any(c.split(":")[-1] in tms["crs"] for c in MERCATOR_CRS):
+            continue
+        ids, scales = zip(*tms["matrices"]) if tms["matrices"] else ((), ())
+        if not ids:
+            continue
+        z0 = round(math.log2(_ZOOM0_SCALE / scales[0]))
+        # matrix identifiers must be "<prefix><zoom>" to fit in a template
+        prefix = ids[0][: len(ids[0]) - len(str(z0))]
+        if z0 != 0 or any(i != f"{prefix}{z}" for z, i in enumerate(ids)):
+            continue
+        fmt = format if format in info["formats"] else (info["formats"] or [format])[0]
+        template = info["templates"].get(fmt) or next(
+            iter(info["templates"].values()), None
+        )
+        if template:
+            return (
+                template.replace("{TileMatrixSet}", name)
+                .replace("{Style}", info["style"])
+                .replace("{TileMatrix}", prefix + "{z}")
+                .replace("{TileRow}", "{y}")
+                .replace("{TileCol}", "{x}")
+            )
+        query = _request_url(
+            wmts["kvp_url"],
+            SERVICE="WMTS",
+            REQUEST="GetTile",
+            VERSION="1.0.0",
+            LAYER=layer,
+            STYLE=info["style"],
+            TILEMATRIXSET=name,
+            FORMAT=fmt,
+        )
+        return f"{query}&TILEMATRIX={prefix}{{z}}&TILEROW={{y}}&TILECOL={{x}}"
+    return None
+
+
+def tile_bbox(z, x, y):
+    """Web Mercator bounds of an XYZ tile: (minx, miny, maxx, maxy) in m."""
+    span = 2 * _HALF_WORLD / 2**z
+    minx = -_HALF_WORLD + x * span
+    maxy = _HALF_WORLD - y * span
+    return (minx, maxy - span, minx + span, maxy)
+
+
+def getmap_url(caps, layers, z, x, y, crs, format, transparent=True, styles=""):
+    """A 256 px GetMap request for one XYZ tile."""
+    params = {
+        "SERVICE": "WMS",
+        "REQUEST": "GetMap",
+        "VERSION": caps["version"],
+        "LAYERS": layers,
+        "STYLES": styles,
+        "FORMAT": format,
+        "TRANSPARENT": str(bool(transparent)).upper(),
+        "WIDTH": TILE_SIZE,
+        "HEIGHT": TILE_SIZE,
+        "CRS" if caps["version"] >= "1.3" else "SRS": crs,
+        "BBOX": ",".join(f"{v:.6f}" for v in tile_bbox(z, x, y)),
+    }
+    return _request_url(caps["getmap_url"], **params)
+
+
+def wms_tile_provider(
+    caps, layers, crs, format, transparent=True, styles="", cache=None, offline=None
+):
+    """A `TileServer` provider answering XYZ tiles with GetMap requests.
+
+    Tiles go through the basemap cache (see `maeson.proxy`), and concurrent
+    requests for the same tile share one download.
+    """
+
+    def fetch(z, x, y):
+        c = cache if cache is not None else get_basemap_cache()
+        key = tile_key(
+            "wms",
+            caps["getmap_url"],
+            z,
+            x,
+            y,
+            layers=layers,
+            styles=styles,
+            format=format,
+            crs=crs,
+            transparent=bool(transparent),
+        )
+        data = c.get(key)
+        off = _SETTINGS["offline"] if offline is None else offline
+        if data is not None or off:
+            return data
+        try:
+            resp = requests.get(
+                getmap_url(caps, layers, z, x, y, crs, format, transparent, styles),
+                timeout=10,
+                headers={"User-Agent": "maeson"},
+            )
+            resp.raise_for_status()
+        except requests.RequestException:
+            return None
+        if not resp.headers.get("Content-Type", "").startswith("image/"):
+            # a ServiceException document
+            return None
+        c.put(key, resp.content)
+        return resp.content
+
+    return coalesce(fetch)
+
+
+def wms_layer_url(
+    url, layers=None, format=None, transparent=True, styles="", proxy=None
+):
+    """Choose how to draw a WMS layer as XYZ tiles.
+
+    Args:
+        url (str): Service endpoint.
+        layers (str, optional): Comma-separated layer names. Defaults to
+            the first named layer.
+        format (str, optional): Image format. Defaults to PNG if offered.
+        transparent (bool, optional): Request transparent images.
+        styles (str, optional): WMS styles. Defaults to "".
+        proxy (bool, optional): Serve GetMap tiles through the local caching
+            proxy. Defaults to the `maeson.proxy.proxy_tiles` setting.
+
+    Returns:
+        dict: ``kind`` ("wmts", "proxy" or "wms"), ``url`` (an XYZ template,
+        or the GetMap endpoint for "wms"), ``layers``, ``format``, ``crs``
+        and ``version``.
+    """
+    caps = get_capabilities(url)
+    if not layers:
+        if not caps["layers"]:
+            raise ValueError(f"{url} advertises no named layers")
+        layers = next(iter(caps["layers"]))
+    names = [n.strip() for n in layers.split(",")]
+    unknown = [n for n in names if n not in caps["layers"]]
+    if unknown:
+        raise ValueError(
+            f"Unknown WMS layer(s) {unknown}. Choose from {sorted(caps['layers'])}."
+        )
+    if format is None:
+        format = "image/png" if "image/png" in caps["formats"] else caps["formats"][0]
+    crs = next(
+        (c for c in MERCATOR_CRS if all(c in caps["layers"][n]["crs"] for n in names)),
+        None,
+    )
+    result = {
+        "layers": layers,
+        "format": format,
+        "crs": crs,
+        "version": caps["version"],
+    }
+
+    template = wmts_template(caps, names[0], format) if len(names) == 1 else None
+    if template:
+        return dict(result, kind="wmts", url=tile_url(template, proxy))
+    proxy = _SETTINGS["enabled"] if proxy is None else proxy
+    if proxy and crs:
+        provider = wms_tile_provider(caps, layers, crs, format, transparent, styles)
+        digest = hashlib.sha1(
+            repr(
+                (caps["getmap_url"], layers, styles, format, crs, bool(transparent))
+            ).encode("utf-8")
+        ).hexdigest()[:12]
+        ext = "jpg" if "jpeg" in format else "png"
+        server_url = TileServer.get().register(provider, key=f"wms-{digest}", ext=ext)
+        return dict(result, kind="proxy", url=server_url)
+    return dict(result, kind="wms", url=caps["getmap_url"])
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+"""Tests for the `folmap` module."""
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import folium
+import numpy as np
+import rasterio
+import requests
+from rasterio.transform import from_origin
+
+from maeson.folmap import Map, write_sidecar
+
+
+class TestExportHtml(unittest.TestCase):
+    """Tests for `maeson.folmap.Map.export_html`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        features = [
+            {
+                "type": "Feature",
+                "properties": {"name": f"p{i}", "v": i % 3},
+                "geometry": {"type": "Point", "coordinates": [i * 0.01, 0]},
+            }
+            for i in range(500)
+        ]
+        self.data = {"type": "FeatureCollection", "features": features}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_data_goes_to_sidecar(self):
+        m = Map()
+        m.add_geojson(
+            self.data,
+            name="points",
+            tooltip=folium.GeoJsonTooltip(fields=["name"]),
+            style_function=lambda f: {
+                "color": "red" if f["properties"]["v"] else "blue"
+            },
+        )
+        m.add_geojson({"type": "FeatureCollection", "features": []}, name="empty")
+        m.add_layer_control()
+        path = os.path.join(self.tmp, "story.html")
+        report = m.export_html(path, min_bytes=100)
+
+        points, empty = report["layers"]
+        self.assertIsNone(empty["file"])
+        self.assertLess(points["bytes"], points["inline_bytes"])
+        with gzip.open(points["file"], "rt") as f:
+            self.assertEqual(json.load(f), self.data)
+
+        with open(path) as f:
+            html = f.read()
+        self.assertNotIn('"p499"', html)
+        self.assertIn(os.path.basename(points["file"]), html)
+        self.assertEqual(report["html_bytes"], len(html.encode("utf-8")))
+
+        # a regular save still inlines the data
+        m.save(path)
+        with open(path) as f:
+            self.assertIn('"p499"', f.read())
+
+    def test_topojson_needs_the_extra(self):
+        with mock.patch.dict("sys.modules", {"topojson": None}):
+            with self.assertRaisesRegex(ImportError, r"maeson\[topojson\]"):
+                write_sidecar(self.data, self.tmp, "points", data_format="topojson")
+
+
+class TestSplitMap(unittest.TestCase):
+    """Tests for `maeson.folmap.Map.add_split_map`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.tif = os.path.join(self.tmp, "dem.tif")
+        with rasterio.open(
+            self.tif,
+            "w",
+            driver="GTiff",
+            width=64,
+            height=64,
+            count=1,
+            dtype="float32",
+            crs="EPSG:4326",
+            transform=from_origin(0, 1, 1 / 64, 1 / 64),
+        ) as dst:
+            dst.write(np.random.rand(1, 64, 64).astype("float32"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_tif_is_tiled(self):
+        m = Map(center=(0.5, 0.5), zoom=8)
+        m.add_split_map(self.tif, "cartodbpositron")
+        html = m.get_root().render()
+        self.assertNotIn("imageOverlay", html)
+        self.assertNotIn("base64", html)
+
+        control, loader = list(m._children.values())[-2:]
+        self.assertIs(loader.layer_left, control.layer_left)
+        left = control.layer_left
+        self.assertFalse(left.show)
+        resp = requests.get(left.tiles.format(z=8, x=128, y=127), timeout=10)
+        self.assertTrue(resp.content.startswith(b"\x89PNG"))
@@ -0,0 +1,550 @@
+#!/usr/bin/env python
+
+"""Tests for the `gistory` module and its headless backend."""
+
+import copy
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from maeson import gistory
+from maeson.gistory import (
+    LayerDef,
+    ROIStore,
+    Scene,
+    Story,
+    StoryController,
+    detect_layer_kind,
+    detect_layer_type,
+    load_story,
+    save_story,
+)
+from maeson.headless import HeadlessMap, replay_story
+from maeson.spatial import LayerIndex, StoryIndex, ViewportCuller
+
+
+def _point(lon, lat):
+    return {
+        "type": "Feature",
+        "properties": {},
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+    }
+
+
+class TestHeadless(unittest.TestCase):
+    """Tests for `maeson.headless`."""
+
+    def setUp(self):
+        """Set up a small two-scene story."""
+        data = {"type": "FeatureCollection", "features": [_point(10, 20)]}
+        self.story = Story(
+            [
+                Scene(
+                    center=(20, 10),
+                    zoom=5,
+                    layers=[{"type": "geojson", "data": data, "name": "pts"}],
+                    title="One",
+                ),
+                Scene(
+                    center=(0, 0),
+                    zoom=3,
+                    layers=[
+                        {
+                            "type": "tile",
+                            "url": "https://tile.example/{z}/{x}/{y}.png",
+                            "name": "t",
+                        }
+                    ],
+                    title="Two",
+                ),
+            ]
+        )
+
+    def test_replay_records_ops(self):
+        """Replaying a story adds every layer and measures payloads."""
+        m = HeadlessMap()
+        stats = replay_story(self.story, m, repeat=2)
+        self.assertEqual(stats["scenes"], 4)
+        self.assertEqual(stats["failed_layers"], 0)
+        self.assertEqual(stats["ops"]["add_layer"]["count"], 4)
+        self.assertGreater(stats["ops"]["add_layer"]["bytes"], 0)
+        self.assertEqual(self.story.index, 0)
+
+    def test_replay_raster_stack(self):
+        """Stack layers replay on the headless backend."""
+        tmp = tempfile.mkdtemp()
+        try:
+            for month in ("01", "02", "03"):
+                open(os.path.join(tmp, f"2020-{month}.tif"), "wb").close()
+            stack = {
+                "type": "stack",
+                "name": "ndvi",
+                "paths": os.path.join(tmp, "*.tif"),
+                "frame": 1,
+            }
+            self.story.scenes[1].layers = self.story.scenes[1].layers + [stack]
+            m = HeadlessMap()
+            stats = replay_story(self.story, m)
+            self.assertEqual(stats["failed_layers"], 0)
+            self.assertEqual(stats["ops"]["add_layer"]["count"], 3)
+            layer = m.layers[-1]
+            self.assertEqual((layer.type, layer.name), ("stack", "ndvi"))
+            self.assertEqual(layer.url, os.path.join(tmp, "2020-02.tif"))
+            self.assertEqual(layer.options["frames"], 3)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_fit_bounds(self):
+        """fit_bounds centers the simulated viewport on the bounds."""
+        m = HeadlessMap()
+        m.fit_bounds(((-10, -10), (10, 10)))
+        self.assertAlmostEqual(m.center[0], 0, places=6)
+        self.assertAlmostEqual(m.center[1], 0, places=6)
+        self.assertGreater(m.zoom, 2)
+
+
+class TestROIStore(unittest.TestCase):
+    """Tests for `maeson.gistory.ROIStore`."""
+
+    def test_dedup_and_roundtrip(self):
+        """Identical geometries share an ID and rebuild unchanged."""
+        store = ROIStore()
+        poly = {
+            "type": "Feature",
+            "properties": {"name": "a"},
+            "geometry": {
+                "type": "Polygon",
+                "coordinates": [[[0, 0], [1, 0], [1, 1], [0, 0]]],
+            },
+        }
+        a = store.add(poly)
+        b = store.add(poly)
+        c = store.add(_point(3, 4))
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.feature(a)["geometry"], poly["geometry"])
+
+        store.prune([c])
+        self.assertNotIn(a, store)
+        self.assertEqual(store.feature(c)["geometry"]["coordinates"], [3, 4])
+
+        copy = ROIStore.from_geojson(store.to_geojson())
+        self.assertEqual(copy.to_geojson(), store.to_geojson())
+
+    def test_dedup_keeps_properties(self):
+        """The same shape with other properties is a separate ROI."""
+        store = ROIStore()
+        a = store.add(_point(1, 2))
+        labelled = dict(_point(1, 2), properties={"label": "well"})
+        b = store.add(labelled)
+        self.assertNotEqual(a, b)
+        self.assertEqual(store.add(labelled), b)
+        self.assertEqual(store.feature(b)["properties"], {"label": "well"})
+
+    def test_story_file_roundtrip(self):
+        """`load_story` reads `save_story` output and old list files."""
+        store = ROIStore()
+        roi = store.add(_point(5, 6))
+        story = Story(
+            [
+                Scene(
+                    center=(6, 5),
+                    zoom=7,
+                    layers=[{"type": "roi", "ids": [roi], "name": "ROIs"}],
+                    title="A",
+                    basemap="OpenTopoMap",
+                )
+            ],
+            rois=store,
+        )
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "story.json")
+            save_story(story, path)
+            loaded = load_story(path)
+            scene = loaded.scenes[0]
+            self.assertEqual((scene.title, scene.zoom), ("A", 7))
+            self.assertEqual(scene.basemap, "OpenTopoMap")
+            ids = scene.layers[0]["ids"]
+            self.assertEqual(
+                loaded.rois.to_geojson(ids)["features"][0]["geometry"],
+                {"type": "Point", "coordinates": [5.0, 6.0]},
+            )
+
+            with open(path, "w") as f:
+                json.dump([{"title": "Old", "center": [1, 2], "zoom": 3}], f)
+            old = load_story(path)
+            self.assertEqual(old.scenes[0].title, "Old")
+            self.assertEqual(len(old.rois), 0)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_builder_update_keeps_rois(self):
+        """Updating a loaded scene keeps its ROI references."""
+        from maeson import Map
+        from maeson.gistory import SceneBuilder
+
+        builder = SceneBuilder(Map())
+        builder._on_roi_draw(None, "created", _point(1, 1))
+        builder._save_scene()
+        builder.scene_selector.index = 0
+        builder._load_scene()
+        builder._update_scene(None)
+        self.assertEqual(builder._referenced_roi_ids(), [0])
+        builder.rois.prune(builder._referenced_roi_ids())
+        self.assertIn(0, builder.rois)
+
+    def test_builder_select_draws_each_layer_once(self):
+        """Selecting a scene (load, then preview) does not stack layers."""
+        from maeson import Map
+        from maeson.gistory import SceneBuilder
+
+        empty = {"type": "FeatureCollection", "features": []}
+        builder = SceneBuilder(Map())
+        roi = builder.rois.add(_point(1, 1))
+        layers = [
+            {"type": "geojson", "name": "a", "data": empty},
+            {"type": "geojson", "name": "b", "data": empty},
+            {"type": "roi", "name": "ROIs", "ids": [roi]},
+        ]
+        builder.story.append(Scene((0, 0), 3, layers=layers, title="S"))
+        builder._refresh_scene_list()
+        builder.custom_code.value = (
+            "from ipyleaflet import GeoJSON\n"
+            "map.add(GeoJSON(data={'type': 'FeatureCollection', 'features': []},"
+            " name='code'))"
+        )
+        for _ in range(2):
+            builder.scene_selector.index = 0
+            builder._on_scene_select({"new": builder.scene_selector.value})
+            names = [lyr.name for lyr in builder.basemaps.overlays()]
+            self.assertEqual(sorted(names), ["ROIs", "a", "b", "code"])
+
+
+class TestLayerDef(unittest.TestCase):
+    """Tests for `maeson.gistory.LayerDef`."""
+
+    def test_copy_shares_payload(self):
+        """Copies share payloads and edits only copy the changed path."""
+        data = {"type": "FeatureCollection", "features": [_point(0, 0)]}
+        ld = LayerDef({"type": "geojson", "data": data, "style": {"color": "red"}})
+        self.assertIs(copy.deepcopy(ld), ld)
+        with self.assertRaises(TypeError):
+            ld["name"] = "x"
+
+        edited = ld.set_in(("style", "color"), "blue")
+        self.assertEqual(ld["style"]["color"], "red")
+        self.assertEqual(edited["style"]["color"], "blue")
+        self.assertIs(edited["data"], data)
+
+        scene = Scene(center=(0, 0), zoom=2, layers=[ld])
+        self.assertIs(scene.layers[0], ld)
+
+
+class TestSpatialIndex(unittest.TestCase):
+    """Tests for `maeson.spatial`."""
+
+    def test_query_and_cull(self):
+        """Viewport queries, union bounds and incremental culling."""
+        data = {
+            "type": "FeatureCollection",
+            "features": [_point(lon, 0) for lon in range(-50, 51, 10)],
+        }
+        index = LayerIndex(data)
+        self.assertEqual(index.bounds, ((0, -50), (0, 50)))
+        self.assertEqual(list(index.query(((-1, -5), (1, 15)))), [5, 6])
+        self.assertEqual(index.hit_test(0, 20.01, tolerance=0.1), [7])
+
+        culler = ViewportCuller(index, margin=0)
+        added, removed = culler.update(((-1, -5), (1, 15)))
+        self.assertEqual(list(added), [5, 6])
+        added, removed = culler.update(((-1, 5), (1, 25)))
+        self.assertEqual((list(added), list(removed)), ([7], [5]))
+
+        ld = LayerDef({"type": "geojson", "data": data})
+        story = Story([Scene((0, 0), 2, [ld]), Scene((0, 0), 3, [ld])])
+        story_index = StoryIndex(story)
+        self.assertIs(story_index.layer_index(ld), story_index.layer_index(ld))
+        self.assertEqual(story_index.bounds(), index.bounds)
+
+        # indexes of payloads no longer in use are dropped, oldest first
+        story_index = StoryIndex(max_layers=2)
+        payloads = [json.loads(json.dumps(data)) for _ in range(3)]
+        first = story_index.index_geojson(payloads[0])
+        story_index.index_geojson(payloads[1])
+        self.assertIs(story_index.index_geojson(payloads[0]), first)
+        story_index.index_geojson(payloads[2])
+        self.assertEqual(len(story_index._indexes), 2)
+        self.assertIs(story_index.index_geojson(payloads[0]), first)
+        self.assertNotIn(id(payloads[1]), story_index._indexes)
+
+    def test_index_flatgeobuf_path(self):
+        """File layers are read like the renderer reads them."""
+        import geopandas as gpd
+        from shapely.geometry import Point
+
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "pts.fgb")
+            points = [Point(lon, 0) for lon in (-10, 0, 10)]
+            gdf = gpd.GeoDataFrame(geometry=points, crs="EPSG:4326")
+            gdf.to_file(path, driver="FlatGeobuf")
+            index = StoryIndex().layer_index({"type": "geojson", "path": path})
+            self.assertEqual(index.bounds, ((0, -10), (0, 10)))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestBasemapManager(unittest.TestCase):
+    """Tests for `maeson.basemaps.BasemapManager` in story playback."""
+
+    def test_scene_basemaps_are_reused(self):
+        layer = {
+            "type": "geojson",
+            "name": "pts",
+            "data": {"type": "FeatureCollection", "features": []},
+        }
+        scenes = [
+            Scene(center=(0, 0), zoom=3, basemap=name, layers=[layer])
+            for name in ("Esri.WorldImagery", "OpenTopoMap", "Esri.WorldImagery")
+        ]
+        map_obj = HeadlessMap()
+        controller = StoryController(Story(scenes), map_obj)
+        first = controller.basemaps.active
+        controller._next_scene()
+        controller._next_scene()
+        self.assertIs(controller.basemaps.active, first)
+        # the headless map's own base layer is adopted, not removed
+        self.assertEqual(len(controller.basemaps.layers), 3)
+        bases = [lyr for lyr in map_obj.layers if controller.basemaps.is_basemap(lyr)]
+        self.assertEqual(
+            [lyr.name for lyr in bases if lyr.visible], ["Esri.WorldImagery"]
+        )
+        # overlays are replaced, basemaps stay below them
+        self.assertEqual(map_obj.layers[-1].name, "pts")
+        self.assertEqual(len(map_obj.layers), 4)
+
+    def test_transition_is_one_message(self):
+        layer = {
+            "type": "geojson",
+            "name": "pts",
+            "data": {"type": "FeatureCollection", "features": []},
+        }
+        story = Story(
+            [Scene(center=(i, i), zoom=3 + i, layers=[layer]) for i in range(3)]
+        )
+        stats = replay_story(story)
+        self.assertEqual(stats["max_scene_messages"], 1)
+        self.assertEqual(stats["messages"], 3)
+
+
+class TestSceneCode(unittest.TestCase):
+    """Tests for `maeson.gistory.SceneCode`."""
+
+    def test_code_runs_once_and_layers_are_reused(self):
+        code = (
+            "from ipyleaflet import GeoJSON\n"
+            "visits = []\n"
+            "pts = GeoJSON(data={'type': 'FeatureCollection', 'features': []})\n"
+            "map.add(pts)\n"
+            "def enter():\n"
+            "    visits.append('enter')\n"
+            "def exit():\n"
+            "    visits.append('exit')\n"
+        )
+        story = Story(
+            [Scene(center=(0, 0), zoom=2, custom_code=code), Scene((1, 1), 3)]
+        )
+        m = HeadlessMap()
+        controller = StoryController(story, m)
+        pts = controller.code.namespace["pts"]
+        self.assertIn(pts, m.layers)
+        controller._next_scene()
+        self.assertNotIn(pts, m.layers)
+        controller._previous_scene()
+        self.assertIn(pts, m.layers)
+        self.assertIs(controller.code.namespace["pts"], pts)
+        self.assertEqual(
+            controller.code.namespace["visits"], ["enter", "exit", "enter"]
+        )
+        # code layers join the scene's single layers assignment
+        story.scenes[0].layers = [
+            {
+                "type": "geojson",
+                "name": "other",
+                "data": {"type": "FeatureCollection", "features": []},
+            }
+        ]
+        controller._next_scene()
+        assignments = []
+        m.observe(assignments.append, names="layers")
+        controller._previous_scene()
+        self.assertEqual(len(assignments), 1)
+        self.assertEqual([lyr.name for lyr in m.layers[-2:]], ["other", pts.name])
+
+    def test_builder_keeps_code_layers_on_rerun(self):
+        """Previewing unchanged code again still records its EE layers."""
+        from ipyleaflet import TileLayer
+
+        from maeson import Map
+        from maeson.gistory import SceneBuilder
+
+        m = Map()
+        m.add_earthengine = lambda ee_object, vis_params=None, name="EE": m.add(
+            TileLayer(url="https://example.com/{z}/{x}/{y}.png", name=name)
+        )
+        builder = SceneBuilder(m)
+        builder.custom_code.value = (
+            "map.add_earthengine('USGS/SRTMGL1_003', name='dem')"
+        )
+        for _ in range(2):
+            builder._run_custom_code(None)
+            self.assertEqual(
+                [ld["name"] for ld in builder.layers if ld["type"] == "earthengine"],
+                ["dem"],
+            )
+            builder.layers.clear()
+
+    def test_compiled_code_is_bounded(self):
+        from maeson import gistory
+
+        gistory._compile_code.cache_clear()
+        for i in range(gistory.COMPILED_CODE_CACHE_SIZE + 5):
+            gistory.compile_scene_code(f"x = {i}")
+        digest, compiled = gistory.compile_scene_code("x = 0")
+        self.assertIs(gistory.compile_scene_code("x = 0")[1], compiled)
+        info = gistory._compile_code.cache_info()
+        self.assertEqual(info.currsize, gistory.COMPILED_CODE_CACHE_SIZE)
+
+
+class _FeatureAPI(BaseHTTPRequestHandler):
+    """Serves GeoJSON as plain ``application/json`` at a suffix-less path."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.server.requests.append(self.command)
+        body = json.dumps({"type": "FeatureCollection", "features": []}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command == "GET":
+            self.wfile.write(body)
+
+    do_GET = do_HEAD
+
+
+class TestDetectLayerType(unittest.TestCase):
+    """Tests for `maeson.gistory.detect_layer_type`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_strings(self):
+        self.assertEqual(detect_layer_type("https://t/{z}/{x}/{y}.png"), "tile")
+        self.assertEqual(detect_layer_type("projects/a/assets/b"), "earthengine")
+        self.assertEqual(
+            detect_layer_type("https://host/ows?SERVICE=WMS&request=x"), "wms"
+        )
+        self.assertEqual(detect_layer_kind("https://h/a/b.fgb?x=1"), "flatgeobuf")
+        self.assertEqual(detect_layer_type("https://h/a/b.fgb", sniff=False), "geojson")
+        self.assertEqual(detect_layer_type("data/sub/scene.tif"), "raster")
+
+    def test_magic_bytes(self):
+        self.assertEqual(detect_layer_kind(self._write("a.dat", b"II*\x00")), "geotiff")
+        self.assertEqual(detect_layer_kind(self._write("b", b"PMTiles\x03")), "pmtiles")
+        features = self._write("c.txt", b' {"type": "FeatureCollection"}')
+        self.assertEqual(detect_layer_type(features), "geojson")
+        # the suffix is only a fallback for local files
+        self.assertEqual(
+            detect_layer_kind(self._write("d.json", b"PAR1")), "geoparquet"
+        )
+
+    def test_cache_is_bounded_and_sees_rewrites(self):
+        path = self._write("e.dat", b"II*\x00")
+        self.assertEqual(detect_layer_kind(path), "geotiff")
+        # rewritten in place, same name and suffix
+        self._write("e.dat", b"PMTiles\x03")
+        self.assertEqual(detect_layer_kind(path), "pmtiles")
+        with mock.patch.object(gistory, "LAYER_KIND_CACHE_SIZE", 2):
+            for name in ("f.tif", "g.tif", "h.tif"):
+                detect_layer_kind(self._write(name, b"II*\x00"))
+            self.assertEqual(len(gistory._LAYER_KIND_CACHE), 2)
+
+    def test_sniff_url_cached(self):
+        httpd = ThreadingHTTPServer(("127.0.0.1", 0), _FeatureAPI)
+        httpd.requests = []
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{httpd.server_address[1]}/api/features"
+            self.assertEqual(detect_layer_type(url), "geojson")
+            self.assertEqual(httpd.requests, ["HEAD", "GET"])
+            self.assertEqual(detect_layer_type(url), "geojson")
+            self.assertEqual(len(httpd.requests), 2)
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_register_kind(self):
+        try:
+            gistory.register_layer_kind("csvpoints", "geojson", suffixes=(".csv",))
+            self.assertEqual(detect_layer_kind("https://h/p.csv"), "csvpoints")
+            self.assertEqual(detect_layer_type("https://h/p.csv"), "geojson")
+        finally:
+            gistory.LAYER_KINDS.pop("csvpoints")
+            gistory._LAYER_KIND_CACHE.clear()
+
+    def test_builder_detects_once(self):
+        from maeson import Map
+        from maeson.gistory import SceneBuilder
+
+        path = self._write(
+            "pts.geojson",
+            json.dumps(
+                {"type": "FeatureCollection", "features": [_point(1, 2)]}
+            ).encode(),
+        )
+        builder = SceneBuilder(Map())
+        builder.layer_src.value = path
+        with mock.patch.object(
+            gistory, "detect_layer_kind", wraps=gistory.detect_layer_kind
+        ) as detect:
+            builder._add_layer()
+        self.assertEqual(detect.call_count, 1)
+        self.assertEqual(
+            (builder.layers[-1]["type"], builder.layers[-1]["kind"]),
+            ("geojson", "geojson"),
+        )
+
+    def test_story_loads_vector_files(self):
+        import geopandas as gpd
+
+        fgb = os.path.join(self.tmp, "pts.fgb")
+        gpd.GeoDataFrame.from_features([_point(1, 2)], crs="EPSG:4326").to_file(
+            fgb, driver="FlatGeobuf"
+        )
+        ld = {"type": "geojson", "kind": "flatgeobuf", "name": "pts", "path": fgb}
+        m = HeadlessMap()
+        controller = StoryController(Story([Scene((0, 0), 2, layers=[ld])]), m)
+        (layer,) = controller.current_layers
+        self.assertIn(layer, m.layers)
+        self.assertEqual(
+            layer.data["features"][0]["geometry"]["coordinates"], [1.0, 2.0]
+        )
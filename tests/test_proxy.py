@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+"""Tests for the `proxy` module against a local fake tile server."""
+
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from maeson.gistory import Scene, Story
+from maeson.proxy import proxy_url, seed_story, seed_tiles
+from maeson.tiles import TileCache
+
+
+class _FakeTiles(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        z, x, y = self.path.strip("/").split(".")[0].split("/")
+        if z == "9":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = f"{z}/{x}/{y}".encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class TestTileProxy(unittest.TestCase):
+    """Tests for `maeson.proxy`."""
+
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _FakeTiles)
+        self.httpd.requests = []
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        port = self.httpd.server_address[1]
+        self.template = f"http://127.0.0.1:{port}/{{z}}/{{x}}/{{y}}.png"
+        self.tmp = tempfile.mkdtemp()
+        self.cache = TileCache(self.tmp, max_bytes=10000)
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        shutil.rmtree(self.tmp)
+
+    def test_seed_then_serve_offline(self):
+        bounds = ((0.1, 0.1), (0.9, 0.9))
+        stats = seed_tiles(self.template, bounds, [5, 6], cache=self.cache)
+        self.assertEqual(stats["tiles"], 2)
+        self.assertEqual(stats["downloaded"], 2)
+        again = seed_tiles(self.template, bounds, [5, 6], cache=self.cache)
+        self.assertEqual(again["cached"], 2)
+        self.assertEqual(len(self.httpd.requests), 2)
+
+        url = proxy_url(self.template, cache=self.cache, offline=True)
+        resp = requests.get(url.format(z=6, x=32, y=31), timeout=5)
+        self.assertEqual(resp.content, b"6/32/31")
+        resp = requests.get(url.format(z=7, x=0, y=0), timeout=5)
+        self.assertEqual(resp.status_code, 204)
+        self.assertEqual(len(self.httpd.requests), 2)
+
+    def test_proxy_fetches_and_caches(self):
+        url = proxy_url(self.template + "?online", cache=self.cache)
+        for _ in range(2):
+            resp = requests.get(url.format(z=3, x=1, y=2), timeout=5)
+            self.assertEqual(resp.content, b"3/1/2")
+        self.assertEqual(len(self.httpd.requests), 1)
+        resp = requests.get(url.format(z=9, x=1, y=2), timeout=5)
+        self.assertEqual(resp.status_code, 204)
+
+    def test_seed_story_bounded(self):
+        story = Story([Scene(center=(0.5, 0.5), zoom=4, basemap=self.template)])
+        stats = seed_story(story, width=256, height=256, cache=self.cache)
+        self.assertGreater(stats["downloaded"], 0)
+        self.assertEqual(stats["failed"], 0)
+        self.assertLessEqual(self.cache.nbytes, 10000)
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+
+"""Tests for the `raster` and `tiles` modules."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import numpy as np
+import rasterio
+import requests
+from rasterio.transform import from_origin
+
+from maeson import raster
+from maeson.raster import (
+    RasterMosaic,
+    RasterStack,
+    evaluate_expression,
+    export_animation,
+    export_xyz_tiles,
+    needs_optimization,
+    optimize_raster,
+    optimized_path,
+    parse_expression,
+    read_tile,
+)
+from maeson.tiles import (
+    MemoryTileCache,
+    TieredTileCache,
+    TileCache,
+    TileServer,
+    cached_provider,
+    get_tile_cache,
+    raster_tile_url,
+    tile_key,
+)
+
+
+def _write_raster(path, value, west, north, size=100, res=0.01):
+    with rasterio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=size,
+        height=size,
+        count=1,
+        dtype="float32",
+        crs="EPSG:4326",
+        transform=from_origin(west, north, res, res),
+        nodata=-1,
+    ) as dst:
+        dst.write(np.full((1, size, size), value, dtype="float32"))
+
+
+class TestRasterMosaic(unittest.TestCase):
+    """Tests for `maeson.raster.RasterMosaic`."""
+
+    def setUp(self):
+        """Write three adjacent one-degree rasters."""
+        self.tmp = tempfile.mkdtemp()
+        for i in range(3):
+            _write_raster(os.path.join(self.tmp, f"r{i}.tif"), i + 1, i, 1.0)
+        self.mosaic = RasterMosaic(os.path.join(self.tmp, "*.tif"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_footprint_index(self):
+        self.assertEqual(len(self.mosaic.sources), 3)
+        (south, west), (north, east) = self.mosaic.bounds
+        self.assertAlmostEqual(west, 0)
+        self.assertAlmostEqual(east, 3)
+        # a zoom-9 tile spanning lon 0-0.7 only touches the first raster
+        self.assertEqual(len(self.mosaic.sources_for_tile(9, 256, 255)), 1)
+
+    def test_composite_tile(self):
+        img = self.mosaic.read_tile(7, 64, 63)
+        values = np.unique(img.array.compressed())
+        self.assertEqual(values.tolist(), [1.0, 2.0, 3.0])
+        self.assertIsNone(self.mosaic.read_tile(7, 10, 10))
+
+    def test_tile_cache(self):
+        cache = get_tile_cache()
+        data = self.mosaic.tile(7, 64, 63)
+        self.assertTrue(data.startswith(b"\x89PNG"))
+        hits = cache.stats["memory_hits"]
+        self.assertIs(self.mosaic.tile(7, 64, 63), data)
+        self.assertEqual(cache.stats["memory_hits"], hits + 1)
+        # another mosaic of other rasters does not see these tiles
+        other = RasterMosaic(self.mosaic.sources[:1])
+        self.assertIsNot(other.tile(7, 64, 63), data)
+
+
+class TestOptimizeRaster(unittest.TestCase):
+    """Tests for the COG conversion in `maeson.raster`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cache_dir = os.environ.get("MAESON_CACHE_DIR")
+        os.environ["MAESON_CACHE_DIR"] = os.path.join(self.tmp, "cache")
+        # a plain GeoTIFF: stored in strips, no overviews
+        self.path = os.path.join(self.tmp, "striped.tif")
+        _write_raster(self.path, 1, 0, 1.0, size=1024, res=0.001)
+
+    def tearDown(self):
+        if self._cache_dir is None:
+            del os.environ["MAESON_CACHE_DIR"]
+        else:
+            os.environ["MAESON_CACHE_DIR"] = self._cache_dir
+        shutil.rmtree(self.tmp)
+
+    def test_needs_optimization(self):
+        self.assertTrue(needs_optimization(self.path))
+        small = os.path.join(self.tmp, "small.tif")
+        _write_raster(small, 1, 0, 1.0)
+        self.assertFalse(needs_optimization(small))
+        cog = optimize_raster(self.path, os.path.join(self.tmp, "cog.tif"))
+        self.assertFalse(needs_optimization(cog))
+        with rasterio.open(cog) as src:
+            self.assertEqual(src.block_shapes[0], (512, 512))
+            self.assertTrue(src.overviews(1))
+
+    def test_cached_cog_is_reused(self):
+        cog = optimized_path(self.path, min_bytes=0)
+        self.assertNotEqual(cog, self.path)
+        self.assertTrue(os.path.exists(cog))
+        with mock.patch.object(raster, "optimize_raster") as convert:
+            self.assertEqual(optimized_path(self.path, min_bytes=0), cog)
+            self.assertEqual(optimized_path(self.path, background=True), cog)
+        convert.assert_not_called()
+        # an edited source gets a fresh conversion
+        os.utime(self.path, (time.time() + 10, time.time() + 10))
+        self.assertNotEqual(optimized_path(self.path, min_bytes=0), cog)
+
+    def test_small_files_are_served_as_they_are(self):
+        self.assertLess(os.path.getsize(self.path), raster.OPTIMIZE_MIN_BYTES)
+        with mock.patch.object(raster, "optimize_raster") as convert:
+            self.assertEqual(optimized_path(self.path), self.path)
+        convert.assert_not_called()
+
+    def test_background_conversion(self):
+        self.assertEqual(optimized_path(self.path, True, min_bytes=0), self.path)
+        cached = raster.cog_cache_path(self.path)
+        future = raster._PENDING.get(cached)
+        if future is not None:
+            future.result(timeout=60)
+        self.assertEqual(optimized_path(self.path, True, min_bytes=0), cached)
+
+    def test_add_raster_does_not_block_on_conversion(self):
+        from maeson import Map
+        from maeson import maeson as maeson_module
+
+        with mock.patch.object(
+            maeson_module, "optimized_path", wraps=optimized_path
+        ) as optimize:
+            Map().add_raster(self.path, expression="b1")
+        self.assertTrue(optimize.call_args.kwargs["background"])
+
+
+class TestDatasetPool(unittest.TestCase):
+    """Tests for the open datasets shared by tile-server threads."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmp, f"r{i}.tif")
+            _write_raster(path, i + 1, i, 1.0)
+            self.paths.append(path)
+
+    def tearDown(self):
+        for path in self.paths:
+            for ds in raster._DATASETS.pop(path, []):
+                ds.close()
+        shutil.rmtree(self.tmp)
+
+    def _read_in_threads(self, path, n):
+        threads = [
+            threading.Thread(target=read_tile, args=(path, 7, 64, 63)) for _ in range(n)
+        ]
+        for t in threads:
+            t.start()
+            t.join()
+
+    def test_one_thread_per_request_reuses_datasets(self):
+        with mock.patch.object(rasterio, "open", wraps=rasterio.open) as opened:
+            self._read_in_threads(self.paths[0], 10)
+        self.assertEqual(opened.call_count, 1)
+        self.assertEqual(len(raster._DATASETS[self.paths[0]]), 1)
+
+    def test_concurrent_readers_get_their_own_dataset(self):
+        with raster._dataset(self.paths[0]) as first:
+            with raster._dataset(self.paths[0]) as second:
+                self.assertIsNot(first, second)
+        self.assertEqual(len(raster._DATASETS[self.paths[0]]), 2)
+
+    def test_idle_datasets_are_bounded(self):
+        with mock.patch.object(raster, "MAX_IDLE_DATASETS", 2):
+            borrowed = []
+            for path in self.paths:
+                with raster._dataset(path) as ds:
+                    borrowed.append(ds)
+        self.assertNotIn(self.paths[0], raster._DATASETS)
+        self.assertTrue(borrowed[0].closed)
+        self.assertFalse(borrowed[2].closed)
+
+
+class TestTileServer(unittest.TestCase):
+    """Tests for `maeson.tiles.TileServer`."""
+
+    def test_serves_provider(self):
+        server = TileServer.get()
+        url = server.register(lambda z, x, y: b"tile" if z == 1 else None)
+        resp = requests.get(url.format(z=1, x=0, y=0), timeout=5)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.content, b"tile")
+        self.assertEqual(resp.headers["Access-Control-Allow-Origin"], "*")
+        resp = requests.get(url.format(z=2, x=0, y=0), timeout=5)
+        self.assertEqual(resp.status_code, 204)
+
+    def test_overwritten_raster_is_not_served_stale(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, "dem.tif")
+            _write_raster(path, 1, 0, 1.0)
+            url = raster_tile_url(path)
+            before = requests.get(url.format(z=0, x=0, y=0), timeout=10).content
+            key = tile_key("raster", path, 0, 0, 0)
+            _write_raster(path, 1, 50, 40.0)
+            os.utime(path, ns=(time.time_ns(), time.time_ns() + 10**9))
+            new_url = raster_tile_url(path)
+            self.assertNotEqual(new_url, url)
+            after = requests.get(new_url.format(z=0, x=0, y=0), timeout=10).content
+            self.assertNotEqual(after, before)
+            self.assertNotEqual(tile_key("raster", path, 0, 0, 0), key)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_memory_cache_evicts(self):
+        cache = MemoryTileCache(maxsize=2)
+        cache.put("a", b"1")
+        cache.put("b", b"2")
+        cache.get("a")
+        cache.put("c", b"3")
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+
+
+class TestRasterStack(unittest.TestCase):
+    """Tests for `maeson.raster.RasterStack`."""
+
+    def setUp(self):
+        """Write three frames of the same one-degree raster."""
+        self.tmp = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmp, f"2020-0{i + 1}.tif")
+            _write_raster(path, i + 1, 0, 1.0)
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shared_stack(self):
+        stack = RasterStack.get(self.paths)
+        self.assertIs(RasterStack.get(list(self.paths)), stack)
+        self.assertEqual(stack.labels, ["2020-01", "2020-02", "2020-03"])
+        self.assertEqual(stack.rescale, (1.0, 4.0))
+        urls = stack.register()
+        self.assertEqual(len(set(urls)), 3)
+        stack.frame = 2
+        self.assertEqual(stack.url, urls[2])
+
+    def test_shared_stacks_are_bounded(self):
+        with mock.patch.object(RasterStack, "max_instances", 2):
+            RasterStack._instances.clear()
+            first = RasterStack.get(self.paths[:1])
+            RasterStack.get(self.paths[1:2])
+            self.assertIs(RasterStack.get(self.paths[:1]), first)
+            RasterStack.get(self.paths[2:])
+            self.assertEqual(len(RasterStack._instances), 2)
+            # the least recently used stack was dropped
+            self.assertNotIn(self.paths[1], {k[0][0] for k in RasterStack._instances})
+            self.assertIs(RasterStack.get(self.paths[:1]), first)
+
+    def test_prefetch_neighbors(self):
+        stack = RasterStack(self.paths)
+        self.assertTrue(stack.tile(1, 7, 64, 63).startswith(b"\x89PNG"))
+        stack._pool.shutdown(wait=True)
+        cache = get_tile_cache()
+        self.assertIn(stack.cache_key(0, 7, 64, 63), cache)
+        self.assertIn(stack.cache_key(2, 7, 64, 63), cache)
+
+
+class TestTieredTileCache(unittest.TestCase):
+    """Tests for `maeson.tiles.TieredTileCache`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_tiers_and_stats(self):
+        cache = TieredTileCache(memory_size=1, cache_dir=self.tmp)
+        calls = []
+
+        def render(z, x, y):
+            calls.append((z, x, y))
+            return b"tile" if x == 0 else None
+
+        provider = cached_provider(render, ("src", "viridis", None), cache)
+        self.assertEqual(provider(1, 0, 0), b"tile")
+        self.assertIsNone(provider(1, 1, 0))
+        self.assertIsNone(provider(1, 1, 0))
+        # evicted from memory by the empty tile, served from disk
+        self.assertEqual(provider(1, 0, 0), b"tile")
+        self.assertEqual(calls, [(1, 0, 0), (1, 1, 0)])
+        self.assertIn(("src", 1, 0, 0, "viridis", None), cache)
+        stats = cache.stats
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["memory_hits"] + stats["disk_hits"], 2)
+        self.assertEqual(stats["disk_hits"], 1)
+
+    def test_stats_from_many_threads(self):
+        from concurrent.futures import ThreadPoolExecutor
+
+        cache = TieredTileCache(memory_size=4, disk=False)
+        cache.put("hit", b"tile")
+        keys = ["hit", "miss"] * 2000
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            list(pool.map(cache.get, keys))
+        stats = cache.stats
+        self.assertEqual(stats["requests"], len(keys))
+        self.assertEqual(stats["memory_hits"], stats["misses"])
+
+    def test_disk_size_cap(self):
+        disk = TileCache(self.tmp, max_bytes=1000)
+        for i in range(5):
+            disk.put(("t", i), b"x" * 300)
+            time.sleep(0.02)
+        self.assertLessEqual(disk.nbytes, 1000)
+        self.assertIsNotNone(disk.get(("t", 4)))
+        self.assertIsNone(disk.get(("t", 0)))
+
+
+class TestBandMath(unittest.TestCase):
+    """Tests for band-math expressions in `maeson.raster`."""
+
+    def test_parse_expression(self):
+        _, bands = parse_expression("(b4 - b3) / (b4 + b3)")
+        self.assertEqual(bands, (3, 4))
+        for bad in ("__import__('os')", "b1.real", "b0 + 1", "x * 2", "'b1'"):
+            with self.assertRaises(ValueError):
+                parse_expression(bad)
+
+    def _two_bands(self, tmp):
+        path = os.path.join(tmp, "bands.tif")
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=64,
+            height=64,
+            count=2,
+            dtype="float32",
+            crs="EPSG:4326",
+            transform=from_origin(0, 1, 1 / 64, 1 / 64),
+        ) as dst:
+            ramp = np.tile(np.linspace(0, 1, 64, dtype="float32"), (64, 1))
+            dst.write(np.stack([ramp, np.ones_like(ramp)]))
+        return path
+
+    def test_rescale_is_part_of_the_cache_key(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = self._two_bands(tmp)
+            wide = raster.BandMath(path, "b1 / b2", rescale=(0, 10))
+            narrow = raster.BandMath(path, "b1 / b2", rescale=(0, 1))
+            self.assertNotEqual(wide.tile(7, 64, 63), narrow.tile(7, 64, 63))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_tiles_share_one_instance(self):
+        from maeson.tiles import read_raster_tile
+
+        tmp = tempfile.mkdtemp()
+        try:
+            path = self._two_bands(tmp)
+            shared = raster.BandMath.get(path, "b1 * 2", colormap="greys")
+            self.assertIs(raster.BandMath.get(path, "b1 * 2", "greys"), shared)
+            with mock.patch.object(
+                raster, "evaluate_expression", wraps=raster.evaluate_expression
+            ) as evaluate:
+                for _ in range(2):
+                    read_raster_tile(path, 7, 64, 63, "greys", expression="b1 * 2")
+            # one overview for the display range, then one call per tile
+            self.assertEqual(evaluate.call_count, 3)
+            self.assertIsNotNone(shared._rescale)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_evaluate_masks_invalid(self):
+        data = np.ma.masked_array(np.ones((2, 2, 2)), mask=False)
+        data.mask[0, 0, 0] = True
+        data[1, 1, 1] = 0
+        result = evaluate_expression("b1 / b2", data, (1, 2))
+        self.assertEqual(result.mask.tolist(), [[True, False], [False, True]])
+        self.assertEqual(result[0, 1], 1.0)
+
+
+class TestExportXYZTiles(unittest.TestCase):
+    """Tests for `maeson.raster.export_xyz_tiles`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, "r.tif")
+        _write_raster(self.path, 5, 0, 1.0)
+        self.out = os.path.join(self.tmp, "tiles")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_incremental_export(self):
+        stats = export_xyz_tiles(self.path, self.out, zooms=[6, 7], workers=2)
+        n = stats["tiles"]
+        self.assertGreater(stats["rendered"], 0)
+        self.assertEqual(stats["rendered"] + stats["empty"], n)
+        tile = os.path.join(self.out, "7", "64", "63.png")
+        with open(tile, "rb") as f:
+            self.assertTrue(f.read().startswith(b"\x89PNG"))
+
+        again = export_xyz_tiles(self.path, self.out, zooms=[6, 7])
+        self.assertEqual(again["skipped"], n)
+        self.assertEqual(again["rendered"], 0)
+
+        recolored = export_xyz_tiles(
+            self.path, self.out, zooms=[6, 7], colormap="viridis"
+        )
+        self.assertEqual(recolored["skipped"], 0)
+
+
+class TestExportAnimation(unittest.TestCase):
+    """Tests for `maeson.raster.export_animation`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cache = os.environ.get("MAESON_CACHE_DIR")
+        os.environ["MAESON_CACHE_DIR"] = self.tmp
+        self.frames = {}
+        for i in range(3):
+            path = os.path.join(self.tmp, f"f{i}.tif")
+            _write_raster(path, i + 1, 0, 1.0)
+            self.frames[f"2020-0{i + 1}"] = path
+
+    def tearDown(self):
+        if self._cache is None:
+            os.environ.pop("MAESON_CACHE_DIR", None)
+        else:
+            os.environ["MAESON_CACHE_DIR"] = self._cache
+        shutil.rmtree(self.tmp)
+
+    def test_webp(self):
+        from PIL import Image
+
+        path, bounds = export_animation(self.frames, max_size=64, workers=2)
+        np.testing.assert_allclose(bounds, ((0, 0), (1, 1)), atol=1e-6)
+        with Image.open(path) as im:
+            self.assertEqual(im.n_frames, 3)
+            self.assertEqual(max(im.size), 64)
+            first = np.asarray(im.convert("RGB"))
+            im.seek(2)
+            self.assertFalse(np.array_equal(first, np.asarray(im.convert("RGB"))))
+        mtime = os.path.getmtime(path)
+        self.assertEqual(export_animation(self.frames, max_size=64)[0], path)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+    def test_mp4(self):
+        out = os.path.join(self.tmp, "anim.mp4")
+        path, _ = export_animation(
+            list(self.frames.values()), out, bounds=((0.2, 0.2), (0.8, 0.8))
+        )
+        self.assertEqual(path, out)
+        self.assertGreater(os.path.getsize(out), 0)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+
+"""Tests for the `render` module against a local fake tile provider."""
+
+import io
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import unittest
+from unittest import mock
+
+from PIL import Image
+
+from maeson.gistory import Scene, Story
+from maeson.render import (
+    _find_ffmpeg,
+    export_video,
+    interpolate_views,
+    render_scene,
+    render_story,
+    render_view,
+)
+from maeson.tiles import TileCache, TileServer
+
+RED = (200, 30, 30, 255)
+
+
+def _tile_png(color=RED):
+    buf = io.BytesIO()
+    Image.new("RGBA", (256, 256), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class TestRenderStory(unittest.TestCase):
+    """Tests for `render_view`, `render_scene` and `render_story`."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = TileServer()
+        cls.requested = []
+        tile = _tile_png()
+
+        def provider(z, x, y):
+            cls.requested.append((z, x, y))
+            return tile
+
+        cls.basemap = cls.server.register(provider)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        point = {
+            "type": "Feature",
+            "properties": {},
+            "geometry": {"type": "Point", "coordinates": [10, 20]},
+        }
+        self.scene = Scene(
+            center=(20, 10),
+            zoom=4,
+            layers=[
+                {
+                    "type": "geojson",
+                    "name": "pts",
+                    "data": {"type": "FeatureCollection", "features": [point]},
+                }
+            ],
+            title="One",
+            basemap=self.basemap,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_render_view_fractional_zoom(self):
+        del self.requested[:]
+        image = render_view(
+            [],
+            (0, 0),
+            2.4,
+            width=300,
+            height=200,
+            basemap=self.basemap,
+            cache=TileCache(os.path.join(self.tmp, "cache")),
+        )
+        self.assertEqual(image.size, (300, 200))
+        self.assertEqual(image.mode, "RGBA")
+        self.assertEqual(image.getpixel((5, 5)), RED)
+        # drawn from the nearest tile level, each tile fetched once
+        self.assertTrue(self.requested)
+        self.assertEqual({z for z, _, _ in self.requested}, {2})
+        self.assertEqual(len(self.requested), len(set(self.requested)))
+
+    def test_render_view_stack_glob(self):
+        for month in ("01", "02", "03"):
+            open(os.path.join(self.tmp, f"2020-{month}.tif"), "wb").close()
+        stack = {
+            "type": "stack",
+            "paths": os.path.join(self.tmp, "*.tif"),
+            "frame": 2,
+        }
+        with mock.patch("maeson.render._compose_tiles") as compose:
+            render_view([stack], (0, 0), 2, width=64, height=64, basemap=None)
+        self.assertEqual(
+            compose.call_args.args[2], os.path.join(self.tmp, "2020-03.tif")
+        )
+
+    def test_render_scene(self):
+        cache = TileCache(os.path.join(self.tmp, "cache"))
+        image = render_scene(self.scene, width=320, height=240, cache=cache)
+        self.assertEqual(image.size, (320, 240))
+        self.assertEqual(image.getpixel((0, 0)), RED)
+        # the point is drawn at the view center
+        self.assertNotEqual(image.getpixel((160, 120)), RED)
+
+    def test_render_story(self):
+        out = os.path.join(self.tmp, "frames")
+        paths = render_story(
+            Story([self.scene]),
+            out,
+            fmt="webp",
+            width=200,
+            height=100,
+            cache_dir=os.path.join(self.tmp, "cache"),
+        )
+        self.assertEqual(paths, [os.path.join(out, "scene_0000.webp")])
+        with Image.open(paths[0]) as im:
+            self.assertEqual(im.format, "WEBP")
+            self.assertEqual(im.size, (200, 100))
+
+        jpg = render_story(
+            [self.scene], out, fmt="jpg", width=64, height=64, processes=1
+        )
+        with Image.open(jpg[0]) as im:
+            self.assertEqual((im.format, im.size), ("JPEG", (64, 64)))
+
+
+class TestExportVideo(unittest.TestCase):
+    """Tests for `interpolate_views` and `export_video`."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = TileServer()
+        tile = _tile_png()
+        cls.basemap = cls.server.register(lambda z, x, y: tile)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.scenes = [
+            Scene(center=(10, -20), zoom=3, title="A"),
+            Scene(center=(40, 60), zoom=6, title="B"),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_interpolate_views(self):
+        views = list(
+            interpolate_views(
+                self.scenes, fps=4, transition_seconds=1, hold_seconds=0.5
+            )
+        )
+        # 2 held frames per scene and 4 in the flight between them
+        self.assertEqual(len(views), 8)
+        self.assertEqual(views[0], (0, (10, -20), 3))
+        self.assertEqual(views[-1], (1, (40, 60), 6))
+        flight = views[2:6]
+        zooms = [v[2] for v in flight]
+        self.assertEqual(zooms, sorted(zooms))
+        self.assertTrue(all(3 < z < 6 for z in zooms))
+        # eased: the first step moves less than the middle one
+        self.assertLess(zooms[0] - 3, zooms[2] - zooms[1])
+        self.assertEqual([v[0] for v in flight], [0, 0, 1, 1])
+
+    def test_export_video(self):
+        path = os.path.join(self.tmp, "story.mp4")
+        result = export_video(
+            self.scenes,
+            path,
+            fps=4,
+            transition_seconds=1,
+            hold_seconds=0.5,
+            width=160,
+            height=120,
+            basemap=self.basemap,
+            processes=2,
+            cache_dir=os.path.join(self.tmp, "cache"),
+        )
+        self.assertEqual(result, path)
+        probe = subprocess.run(
+            [_find_ffmpeg(), "-i", path, "-f", "null", "-"], capture_output=True
+        )
+        info = probe.stderr.decode(errors="replace")
+        self.assertIn("160x120", info)
+        self.assertIn("h264", info)
+        frames = re.findall(r"frame=\s*(\d+)", info)
+        self.assertEqual(int(frames[-1]), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
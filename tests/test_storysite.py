@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""Tests for the `storysite` module."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from maeson.gistory import Scene, Story
+from maeson.storysite import export_story_site
+
+
+class TestStorySite(unittest.TestCase):
+    """Tests for `maeson.storysite.export_story_site`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_shared_data_is_deduplicated(self):
+        points = {
+            "type": "geojson",
+            "name": "points",
+            "data": {
+                "type": "FeatureCollection",
+                "features": [
+                    {
+                        "type": "Feature",
+                        "properties": {"label": "unique-label"},
+                        "geometry": {"type": "Point", "coordinates": [1, 2]},
+                    }
+                ],
+            },
+        }
+        tiles = {"type": "tile", "url": "https://example.com/{z}/{x}/{y}.png"}
+        story = Story(
+            [
+                Scene((2, 1), 5, layers=[points], title="First"),
+                Scene((2, 1), 7, layers=[dict(points)], basemap="OpenTopoMap"),
+                Scene((0, 0), 3, layers=[points, tiles]),
+            ]
+        )
+        stats = export_story_site(story, self.tmp, title="Demo")
+        self.assertEqual(stats["scenes"], 3)
+        self.assertEqual(stats["payloads"], 2)
+        self.assertEqual(stats["assets"], 1)
+
+        with open(os.path.join(self.tmp, "manifest.json")) as f:
+            manifest = json.load(f)
+        first, second, third = manifest["scenes"]
+        self.assertEqual(first["title"], "First")
+        self.assertEqual(first["payload"], second["payload"])
+        self.assertIn("openstreetmap", first["basemap"]["url"])
+        self.assertIn("opentopomap", second["basemap"]["url"])
+        with open(os.path.join(self.tmp, third["payload"])) as f:
+            layers = json.load(f)["layers"]
+        self.assertEqual([ld["type"] for ld in layers], ["geojson", "tile"])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, layers[0]["url"])))
+
+        with open(stats["index"]) as f:
+            html = f.read()
+        self.assertIn("maesonDecodeSidecar", html)
+        self.assertNotIn("unique-label", html)
+
+    def _write_raster(self, name, bands):
+        import rasterio
+        from rasterio.transform import from_origin
+
+        path = os.path.join(self.tmp, name)
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            width=32,
+            height=32,
+            count=len(bands),
+            dtype="float32",
+            crs="EPSG:4326",
+            transform=from_origin(0, 1, 1 / 32, 1 / 32),
+        ) as dst:
+            dst.write(np.stack(bands).astype("float32"))
+        return path
+
+    def test_raster_layers(self):
+        ramp = np.tile(np.linspace(0, 1, 32), (32, 1))
+        bands = self._write_raster("bands.tif", [ramp, ramp.T])
+        for month in ("01", "02", "03"):
+            self._write_raster(f"2020-{month}.tif", [ramp])
+        layers = [
+            {"type": "raster", "path": bands},
+            {"type": "raster", "path": bands, "expression": "b2 - b1"},
+            {
+                "type": "stack",
+                "paths": os.path.join(self.tmp, "2020-*.tif"),
+                "frame": 1,
+            },
+        ]
+        out = os.path.join(self.tmp, "site")
+        export_story_site(Story([Scene((0.5, 0.5), 8, layers=layers)]), out)
+
+        with open(os.path.join(out, "manifest.json")) as f:
+            payload = json.load(f)["scenes"][0]["payload"]
+        with open(os.path.join(out, payload)) as f:
+            plain, derived, stack = json.load(f)["layers"]
+        self.assertEqual({plain["type"], derived["type"]}, {"image"})
+        # the expression is rendered, not the first band
+        self.assertNotEqual(plain["url"], derived["url"])
+        self.assertIn("2020-02", stack["url"])
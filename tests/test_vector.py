@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""Tests for the `vector` module."""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from maeson.vector import AggregatedPoints, PointAggregator, StreamingGeoJSON
+
+
+def _points(lonlats):
+    return {
+        "type": "FeatureCollection",
+        "features": [
+            {
+                "type": "Feature",
+                "properties": {},
+                "geometry": {"type": "Point", "coordinates": list(c)},
+            }
+            for c in lonlats
+        ],
+    }
+
+
+class TestPointAggregator(unittest.TestCase):
+    """Tests for `maeson.vector.PointAggregator`."""
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # two dense clusters, far apart
+        self.lonlats = np.concatenate(
+            [
+                rng.normal((10.0, 50.0), 0.05, (300, 2)),
+                rng.normal((-70.0, -30.0), 0.05, (200, 2)),
+            ]
+        )
+        self.data = _points(self.lonlats)
+
+    def test_bins_count_every_point(self):
+        for kind in ("hex", "grid"):
+            agg = PointAggregator(self.data, kind=kind)
+            for zoom in (2, 6, 10):
+                cells, counts = agg.bins(zoom)
+                self.assertEqual(counts.sum(), 500)
+                self.assertEqual(len(cells), len(counts))
+            self.assertLess(len(agg.bins(2)[1]), len(agg.bins(10)[1]))
+
+    def test_hex_cells_contain_their_points(self):
+        agg = PointAggregator(self.data, kind="hex", cell_size=32)
+        px = agg.xy * 2**8 / agg.cell_size
+        cells = agg._hex_round(px)
+        centers = agg._cell_centers(cells, 8) * 2**8 / agg.cell_size
+        # a point is never further from its cell center than the circumradius
+        self.assertLessEqual(np.hypot(*(px - centers).T).max(), 1.0 + 1e-9)
+
+    def test_grid_coarse_levels_reuse_finer_bins(self):
+        agg = PointAggregator(self.data, kind="grid", cell_size=30)
+        self.assertEqual(agg.cell_size, 32)
+        fine = agg.bins(9)
+        agg.xy = None  # coarser levels must not touch the points again
+        cells, counts = agg.bins(5)
+        self.assertIs(agg.bins(9), fine)
+        self.assertIs(agg.bins(5), agg._bins[5])
+        self.assertEqual(counts.sum(), 500)
+        self.assertTrue(np.array_equal(np.unique(fine[0] >> 4, axis=0), cells))
+
+    def test_geojson_is_cached_per_zoom(self):
+        agg = PointAggregator(self.data)
+        fc = agg.geojson(3)
+        self.assertIs(agg.geojson(3), fc)
+        self.assertEqual(sum(f["properties"]["count"] for f in fc["features"]), 500)
+        self.assertEqual(fc["features"][0]["geometry"]["type"], "Polygon")
+        view = agg.geojson(3, bounds=((45, 0), (55, 20)))
+        self.assertIsNot(agg.geojson(3, bounds=((45, 0), (55, 20))), view)
+
+    def test_geojson_clips_to_bounds(self):
+        agg = PointAggregator(self.data, kind="grid")
+        fc = agg.geojson(8, bounds=((49, 9), (51, 11)))
+        self.assertEqual(sum(f["properties"]["count"] for f in fc["features"]), 300)
+        self.assertLess(len(fc["features"]), len(agg.geojson(8)["features"]))
+        self.assertEqual(agg.geojson(8, bounds=((0, 100), (10, 110)))["features"], [])
+
+    def test_sparse_cells_fall_back_to_points(self):
+        agg = PointAggregator(self.data)
+        fc = agg.geojson(18, bounds=((49, 9), (51, 11)))
+        self.assertEqual(len(fc["features"]), 300)
+        self.assertEqual(fc["features"][0]["geometry"]["type"], "Point")
+        self.assertEqual({f["properties"]["count"] for f in fc["features"]}, {1})
+
+    def test_max_cells_keeps_the_densest(self):
+        agg = PointAggregator(self.data, kind="grid")
+        cells, counts = agg.bins(8)
+        fc = agg.geojson(8, bounds=((-85, -180), (85, 180)), max_cells=3)
+        kept = sorted(f["properties"]["count"] for f in fc["features"])
+        self.assertEqual(kept, sorted(counts)[-3:])
+
+    def test_layer_follows_the_view(self):
+        from maeson import Map
+
+        m = Map(center=(50, 10), zoom=8)
+        layer = AggregatedPoints(self.data, kind="grid")
+        layer.attach(m)
+        self.assertEqual(
+            sum(f["properties"]["count"] for f in layer.data["features"]), 300
+        )
+        m.center = (-30, -70)
+        self.assertEqual(
+            sum(f["properties"]["count"] for f in layer.data["features"]), 200
+        )
+        layer.detach()
+        m.center = (50, 10)
+        self.assertEqual(
+            sum(f["properties"]["count"] for f in layer.data["features"]), 200
+        )
+
+
+class TestStreamingGeoJSON(unittest.TestCase):
+    """Tests for `maeson.vector.StreamingGeoJSON`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        # a 40 x 25 grid of points, 0.1 degree apart, around (0, 0)
+        lon, lat = np.meshgrid(np.arange(-2, 2, 0.1), np.arange(-1.2, 1.3, 0.1))
+        self.path = os.path.join(self.tmp, "points.geojson")
+        with open(self.path, "w") as f:
+            json.dump(_points(np.column_stack([lon.ravel(), lat.ravel()])), f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _map(self):
+        from maeson import Map
+
+        # start far from the data so nothing is streamed before the test
+        return Map(center=(40, 40), zoom=8)
+
+    def test_streams_the_view_in_batches(self):
+        with open(self.path) as f:
+            data = json.load(f)
+        m = self._map()
+        layer = m.add_geojson(data, stream=True, batch_size=40, margin=0)
+        self.assertIsInstance(layer, StreamingGeoJSON)
+        self.assertIn(layer, m.layers)
+
+        (south, west), (north, east) = ((-0.5, -0.5), (0.5, 0.5))
+        layer.refresh(((south, west), (north, east)))
+        visible = [
+            c
+            for c in (feat["geometry"]["coordinates"] for feat in data["features"])
+            if west <= c[0] <= east and south <= c[1] <= north
+        ]
+        self.assertGreater(len(visible), 40)
+        self.assertEqual(layer.feature_count, len(visible))
+        self.assertEqual(len(layer.layers), -(-len(visible) // 40))
+        self.assertTrue(all(len(b.data["features"]) <= 40 for b in layer.layers))
+        self.assertEqual(
+            sum(len(b.data["features"]) for b in layer.layers), len(visible)
+        )
+
+        # moving the view streams in only the new features
+        first = layer.layers
+        layer.refresh(((south, west + 0.5), (north, east + 0.5)))
+        self.assertEqual(layer.layers[: len(first)], first)
+        self.assertGreater(layer.feature_count, len(visible))
+
+        # far away, everything is evicted
+        layer.refresh(((40, 40), (41, 41)))
+        self.assertEqual((layer.feature_count, layer.layers), (0, ()))
+
+    def test_cap_on_features(self):
+        import geopandas as gpd
+
+        m = self._map()
+        layer = m.add_vector(
+            gpd.read_file(self.path), stream=True, batch_size=100, max_features=250
+        )
+        layer.refresh(((-1.2, -2), (1.2, 2)))
+        self.assertEqual(layer.feature_count, 250)
+        self.assertEqual(
+            [len(b.data["features"]) for b in layer.layers], [100, 100, 50]
+        )
+        # the features kept are the ones nearest the view center
+        kept = np.array(
+            [
+                f["geometry"]["coordinates"]
+                for b in layer.layers
+                for f in b.data["features"]
+            ]
+        )
+        self.assertLess(np.hypot(*kept.T).max(), 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
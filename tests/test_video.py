@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+"""Tests for the `video` module and ranged file serving."""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests
+
+from maeson import video
+from maeson.render import _find_ffmpeg
+from maeson.tiles import TileServer
+
+BOUNDS = ((40.0, -100.0), (41.0, -98.0))
+
+
+class TestVideo(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.mkdtemp()
+        cls._cache = os.environ.get("MAESON_CACHE_DIR")
+        os.environ["MAESON_CACHE_DIR"] = cls.tmp
+        cls.src = os.path.join(cls.tmp, "clip.mp4")
+        subprocess.run(
+            [
+                _find_ffmpeg(),
+                "-loglevel",
+                "error",
+                "-f",
+                "lavfi",
+                "-i",
+                "testsrc=duration=1:size=640x480:rate=10",
+                "-pix_fmt",
+                "yuv420p",
+                cls.src,
+            ],
+            check=True,
+        )
+        cls.server = TileServer()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        if cls._cache is None:
+            os.environ.pop("MAESON_CACHE_DIR", None)
+        else:
+            os.environ["MAESON_CACHE_DIR"] = cls._cache
+        shutil.rmtree(cls.tmp)
+
+    def test_overlay_size(self):
+        width, height = video.overlay_size(BOUNDS, zoom=8)
+        self.assertEqual((width % 2, height % 2), (0, 0))
+        self.assertGreater(width, height)
+        self.assertLessEqual(max(video.overlay_size(BOUNDS, zoom=14)), 1280)
+
+    def test_prepare_and_serve(self):
+        path = video.prepare_video(self.src, BOUNDS, zoom=7, max_size=320)
+        self.assertTrue(os.path.exists(path))
+        # cached: the same call does not transcode again
+        mtime = os.path.getmtime(path)
+        self.assertEqual(video.prepare_video(self.src, BOUNDS, 7, 320), path)
+        self.assertEqual(os.path.getmtime(path), mtime)
+
+        url = video.video_url(self.src, BOUNDS, 7, 320, server=self.server)
+        size = os.path.getsize(path)
+        full = requests.get(url)
+        self.assertEqual(full.status_code, 200)
+        self.assertEqual(full.headers["Accept-Ranges"], "bytes")
+        self.assertEqual(len(full.content), size)
+
+        part = requests.get(url, headers={"Range": "bytes=10-19"})
+        self.assertEqual(part.status_code, 206)
+        self.assertEqual(part.headers["Content-Range"], f"bytes 10-19/{size}")
+        self.assertEqual(part.content, full.content[10:20])
+
+        bad = requests.get(url, headers={"Range": f"bytes={size}-"})
+        self.assertEqual(bad.status_code, 416)
+
+    def test_concurrent_prepare_transcodes_once(self):
+        with mock.patch.object(
+            video, "transcode_video", wraps=video.transcode_video
+        ) as transcode:
+            futures = video.prefetch_videos(
+                [
+                    {
+                        "type": "video",
+                        "path": self.src,
+                        "bounds": BOUNDS,
+                        "preprocess": True,
+                    }
+                ],
+                zoom=6,
+                max_size=160,
+                server=self.server,
+            )
+            with ThreadPoolExecutor(max_workers=3) as pool:
+                paths = list(
+                    pool.map(
+                        lambda _: video.prepare_video(self.src, BOUNDS, 6, 160),
+                        range(3),
+                    )
+                )
+            futures[0].result(timeout=60)
+        self.assertEqual(transcode.call_count, 1)
+        self.assertEqual(len(set(paths)), 1)
+        self.assertGreater(os.path.getsize(paths[0]), 0)
+
+    def test_prefetch_videos(self):
+        layers = [
+            {"type": "video", "path": self.src, "bounds": BOUNDS, "preprocess": True},
+            {"type": "video", "path": "skipped.mp4", "bounds": BOUNDS},
+        ]
+        futures = video.prefetch_videos(layers, seconds=1, server=self.server)
+        self.assertEqual(len(futures), 1)
+        url = futures[0].result(timeout=60)
+        key = url.rsplit("/", 2)[-2]
+        self.assertTrue(self.server.httpd.files[key].get("head"))
+        self.assertEqual(requests.get(url).status_code, 200)
+
+
+if __name__ == "__main__":
+    unittest.main()
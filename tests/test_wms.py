@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""Tests for the `wms` module against a local fake WMS."""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from maeson import wms
+from maeson.tiles import TileCache
+
+WMS_CAPABILITIES = """<?xml version="1.0"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms"
+    xmlns:xlink="http://www.w3.org/1999/xlink">
+  <Capability>
+    <Request>
+      <GetMap>
+        <Format>image/jpeg</Format>
+        <Format>image/png</Format>
+        <DCPType><HTTP><Get>
+          <OnlineResource xlink:href="{url}"/>
+        </Get></HTTP></DCPType>
+      </GetMap>
+    </Request>
+    <Layer>
+      <Title>Root</Title>
+      <CRS>EPSG:3857</CRS>
+      <Layer><Name>dem</Name><Title>Elevation</Title><CRS>EPSG:4326</CRS></Layer>
+      <Layer><Name>roads</Name><Title>Roads</Title></Layer>
+    </Layer>
+  </Capability>
+</WMS_Capabilities>
+"""
+
+WMTS_CAPABILITIES = """<?xml version="1.0"?>
+<Capabilities version="1.0.0" xmlns="http://www.opengis.net/wmts/1.0"
+    xmlns:ows="http://www.opengis.net/ows/1.1">
+  <Contents>
+    <Layer>
+      <ows:Identifier>dem</ows:Identifier>
+      <Style isDefault="true"><ows:Identifier>shaded</ows:Identifier></Style>
+      <Format>image/png</Format>
+      <TileMatrixSetLink><TileMatrixSet>gm</TileMatrixSet></TileMatrixSetLink>
+      <ResourceURL format="image/png" resourceType="tile"
+        template="{url}/{{Style}}/{{TileMatrixSet}}/{{TileMatrix}}/{{TileRow}}/{{TileCol}}.png"/>
+    </Layer>
+    <TileMatrixSet>
+      <ows:Identifier>gm</ows:Identifier>
+      <ows:SupportedCRS>urn:ogc:def:crs:EPSG::3857</ows:SupportedCRS>
+      <TileMatrix><ows:Identifier>gm:0</ows:Identifier>
+        <ScaleDenominator>559082264.0287178</ScaleDenominator></TileMatrix>
+      <TileMatrix><ows:Identifier>gm:1</ows:Identifier>
+        <ScaleDenominator>279541132.0143589</ScaleDenominator></TileMatrix>
+    </TileMatrixSet>
+  </Contents>
+</Capabilities>
+"""
+
+
+class _FakeWMS(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+        url = f"http://127.0.0.1:{self.server.server_address[1]}{parsed.path}"
+        self.server.requests.append(query)
+        if parsed.path == "/refused":
+            return self._send(b"Forbidden", "text/plain", 403)
+        if parsed.path == "/broken":
+            return self._send(b"<html><body>oops", "text/html")
+        if query.get("REQUEST") == "GetCapabilities":
+            if query["SERVICE"] == "WMTS" and parsed.path != "/wmts":
+                return self._send(b"<ServiceExceptionReport/>", "text/xml", 400)
+            template = (
+                WMTS_CAPABILITIES if query["SERVICE"] == "WMTS" else WMS_CAPABILITIES
+            )
+            return self._send(template.format(url=url).encode(), "text/xml")
+        if query.get("REQUEST") == "GetMap":
+            time.sleep(0.2)
+            return self._send(b"\x89PNG" + query["BBOX"].encode(), "image/png")
+        self._send(b"", "text/plain", 404)
+
+
+class TestWMS(unittest.TestCase):
+    """Tests for `maeson.wms`."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self._cache_dir = os.environ.get("MAESON_CACHE_DIR")
+        os.environ["MAESON_CACHE_DIR"] = self.tmp
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _FakeWMS)
+        self.httpd.requests = []
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self._cache_dir is None:
+            del os.environ["MAESON_CACHE_DIR"]
+        else:
+            os.environ["MAESON_CACHE_DIR"] = self._cache_dir
+        wms._CAPABILITIES.clear()
+        shutil.rmtree(self.tmp)
+
+    def test_capabilities_are_cached(self):
+        caps = wms.get_capabilities(self.base + "/wms")
+        self.assertEqual(set(caps["layers"]), {"dem", "roads"})
+        self.assertEqual(caps["layers"]["dem"]["crs"], {"EPSG:3857", "EPSG:4326"})
+        self.assertIsNone(caps["wmts"])
+        wms._CAPABILITIES.clear()
+        wms.get_capabilities(self.base + "/wms")
+        self.assertEqual(len(self.httpd.requests), 2)
+
+        info = wms.wms_layer_url(self.base + "/wms", proxy=False)
+        self.assertEqual(info["kind"], "wms")
+        self.assertEqual((info["layers"], info["format"]), ("dem", "image/png"))
+        with self.assertRaises(ValueError):
+            wms.wms_layer_url(self.base + "/wms", "rivers")
+
+    def test_proxy_coalesces_tile_requests(self):
+        caps = wms.get_capabilities(self.base + "/wms")
+        provider = wms.wms_tile_provider(
+            caps, "dem", "EPSG:3857", "image/png", cache=TileCache(self.tmp)
+        )
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(provider(0, 0, 0)))
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(set(results)), 1)
+        self.assertIsNotNone(provider(0, 0, 0))
+        getmaps = [q for q in self.httpd.requests if q.get("REQUEST") == "GetMap"]
+        self.assertEqual(len(getmaps), 1)
+        self.assertEqual(getmaps[0]["CRS"], "EPSG:3857")
+        self.assertEqual(getmaps[0]["WIDTH"], "256")
+        minx, miny, maxx, maxy = map(float, getmaps[0]["BBOX"].split(","))
+        self.assertAlmostEqual(maxx, -minx, places=3)
+        self.assertAlmostEqual(maxx, 20037508.343, places=2)
+
+    def test_prefers_wmts(self):
+        info = wms.wms_layer_url(self.base + "/wmts", "dem", proxy=False)
+        self.assertEqual(info["kind"], "wmts")
+        self.assertEqual(info["url"], self.base + "/wmts/shaded/gm/gm:{z}/{y}/{x}.png")
+
+    def test_refused_capabilities_expire(self):
+        url = self.base + "/refused"
+        with self.assertRaises(ValueError):
+            wms.get_capabilities(url)
+        with self.assertRaises(ValueError):
+            wms.get_capabilities(url)
+        self.assertEqual(len(self.httpd.requests), 1)
+        # after REFUSED_TTL the service is asked again
+        cache = os.path.join(self.tmp, "capabilities")
+        old = time.time() - wms.REFUSED_TTL - 1
+        for name in os.listdir(cache):
+            os.utime(os.path.join(cache, name), (old, old))
+        with self.assertRaises(ValueError):
+            wms.get_capabilities(url)
+        self.assertEqual(len(self.httpd.requests), 2)
+
+    def test_add_wms_layer_falls_back(self):
+        from ipyleaflet import WMSLayer
+
+        from maeson import Map
+
+        m = Map()
+        for path in ("/refused", "/broken"):
+            layer = m.add_wms_layer(self.base + path, layers="dem")
+            self.assertIsInstance(layer, WMSLayer)
+            self.assertEqual(layer.url, self.base + path)
+
+    def test_transparency_is_part_of_the_tile_key(self):
+        caps = wms.get_capabilities(self.base + "/wms")
+        cache = TileCache(self.tmp)
+        for transparent in (True, False, True):
+            provider = wms.wms_tile_provider(
+                caps, "dem", "EPSG:3857", "image/png", transparent, cache=cache
+            )
+            self.assertIsNotNone(provider(0, 0, 0))
+        getmaps = [q for q in self.httpd.requests if q.get("REQUEST") == "GetMap"]
+        self.assertEqual([q["TRANSPARENT"] for q in getmaps], ["TRUE", "FALSE"])
+        self.assertNotEqual(
+            wms.wms_layer_url(self.base + "/wms", "dem", proxy=True)["url"],
+            wms.wms_layer_url(self.base + "/wms", "dem", transparent=False, proxy=True)[
+                "url"
+            ],
+        )